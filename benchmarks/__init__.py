@@ -0,0 +1,14 @@
+"""
+Benchmarks for mailiness at realistic scale.
+
+Run them from the repository root with::
+
+    PYTHONPATH=src python -m benchmarks --sizes 1000,100000 --output results.json
+
+and compare a later run against a saved baseline with::
+
+    PYTHONPATH=src python -m benchmarks --baseline results.json --threshold 0.2
+
+Everything runs against temporary files. Nothing touches the network or the
+configured mail server.
+"""
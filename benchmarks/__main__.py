@@ -0,0 +1,63 @@
+import argparse
+import sys
+import tempfile
+
+from . import environment, harness
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Benchmark mailiness."
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1000",
+        help="Comma separated numbers of users and aliases, e.g. 1000,100000,1000000. Default: 1000",
+    )
+    parser.add_argument(
+        "--repeat", "-r", type=int, default=5, help="Runs per benchmark. Default: 5"
+    )
+    parser.add_argument("--output", "-o", help="Save the results to this JSON file.")
+    parser.add_argument("--baseline", "-b", help="Compare against this results file.")
+    parser.add_argument(
+        "--threshold",
+        "-t",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown against the baseline, as a fraction. Default: 0.2",
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment.configure(directory)
+        # These modules read the configuration at import time.
+        from . import bench_cli, bench_crypto, bench_repo
+
+        results = harness.Results()
+        for size in sizes:
+            bench_repo.run(results, size, args.repeat)
+            bench_crypto.run_dkim(results, size, args.repeat)
+        bench_crypto.run_hashing(results, args.repeat)
+        bench_cli.run(results, args.repeat)
+
+    data = results.to_dict(sizes)
+    if args.output:
+        harness.save(args.output, data)
+
+    if args.baseline:
+        regressions = harness.compare(data, harness.load(args.baseline), args.threshold)
+        for name, before, after, ratio in regressions:
+            print(
+                f"REGRESSION {name}: {1000 * before:.3f} ms -> {1000 * after:.3f} ms ({ratio:.2f}x)"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+import subprocess
+import sys
+
+from .harness import Results
+
+
+def run(results: Results, repeat: int):
+    results.measure(
+        "cli.startup",
+        lambda: subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from mailiness.cli import main; main(['--version'])",
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        ),
+        repeat,
+    )
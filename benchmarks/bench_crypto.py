@@ -0,0 +1,36 @@
+import functools
+from unittest.mock import patch
+
+import bcrypt
+
+from mailiness import dkim, g
+from mailiness.repo import UserRepository
+
+from .harness import Results
+
+BCRYPT_COSTS = (4, 8, 10, 12)
+
+
+def run_hashing(results: Results, repeat: int):
+    user_repo = UserRepository()
+    for cost in BCRYPT_COSTS:
+        gensalt = functools.partial(bcrypt.gensalt, rounds=cost)
+        with patch("mailiness.repo.bcrypt.gensalt", gensalt):
+            results.measure(
+                f"hash.bcrypt[cost={cost}]",
+                lambda: user_repo._hash_password("secret"),
+                repeat,
+            )
+
+
+def run_dkim(results: Results, size: int, repeat: int):
+    key = dkim.DKIM(domain="bench.com")
+    results.measure("dkim.generate_key", key.generate_key, repeat)
+
+    dkim_map = {f"domain{i}.com": "20220101" for i in range(size)}
+    path = g.config["spam"]["dkim_maps_path"]
+    results.measure(
+        f"dkim.map_write[{size}]", lambda: dkim.write_dkim_map(dkim_map), repeat
+    )
+    results.measure(f"dkim.map_read[{size}]", dkim.read_dkim_map, repeat)
+    open(path, "w").close()
@@ -0,0 +1,117 @@
+import itertools
+
+from mailiness import g
+from mailiness.repo import AliasRepository, DomainRepository, UserRepository
+
+from . import environment
+from .harness import Results
+
+
+def run(results: Results, size: int, repeat: int):
+    conn = environment.build_database(g.config["db"]["connection_string"], size)
+    domain_repo = DomainRepository(conn=conn)
+    user_repo = UserRepository(conn=conn)
+    alias_repo = AliasRepository(conn=conn)
+    # Hashing has its own benchmark, keep it out of the database timings.
+    user_repo._hash_password = lambda password: environment.PASSWORD_HASH
+    counter = itertools.count()
+    domain = environment.domain_name(0)
+
+    def new_domain():
+        name = f"new{next(counter)}.com"
+        domain_repo.create(name, pretty=False)
+        return name
+
+    results.measure(
+        f"repo.domain.create[{size}]",
+        lambda: domain_repo.create(f"bench{next(counter)}.com", pretty=False),
+        repeat,
+    )
+    results.measure(
+        f"repo.domain.index[{size}]", lambda: domain_repo.index(pretty=False), repeat
+    )
+
+    names = [domain, "renamed.com"]
+
+    def rename_domain():
+        domain_repo.edit("name", names[0], names[1], pretty=False)
+        names.reverse()
+
+    results.measure(f"repo.domain.edit[{size}]", rename_domain, repeat)
+    if names[0] != domain:
+        rename_domain()
+
+    pending = []
+    results.measure(
+        f"repo.domain.delete[{size}]",
+        lambda: domain_repo.delete(pending.pop()),
+        repeat,
+        setup=lambda: pending.append(new_domain()),
+    )
+
+    results.measure(
+        f"repo.user.create[{size}]",
+        lambda: user_repo.create(
+            f"bench{next(counter)}@{domain}", "secret", 1, pretty=False
+        ),
+        repeat,
+    )
+    results.measure(
+        f"repo.user.index[{size}]", lambda: user_repo.index(pretty=False), repeat
+    )
+    results.measure(
+        f"repo.user.index_domain[{size}]",
+        lambda: user_repo.index(domain=domain, pretty=False),
+        repeat,
+    )
+    results.measure(
+        f"repo.user.edit[{size}]",
+        lambda: user_repo.edit(environment.user_email(0), quota=2),
+        repeat,
+    )
+    results.measure(
+        f"repo.user.delete[{size}]",
+        lambda: user_repo.delete(pending.pop()),
+        repeat,
+        setup=lambda: pending.append(
+            user_repo.create(
+                f"gone{next(counter)}@{domain}", "secret", 1, pretty=False
+            )["rows"][0][1]
+        ),
+    )
+
+    results.measure(
+        f"repo.alias.create[{size}]",
+        lambda: alias_repo.create(
+            f"bench{next(counter)}@{domain}", environment.user_email(0), pretty=False
+        ),
+        repeat,
+    )
+    results.measure(
+        f"repo.alias.index[{size}]", lambda: alias_repo.index(pretty=False), repeat
+    )
+    results.measure(
+        f"repo.alias.index_to[{size}]",
+        lambda: alias_repo.index(to_address=environment.user_email(1), pretty=False),
+        repeat,
+    )
+    results.measure(
+        f"repo.alias.edit[{size}]",
+        lambda: alias_repo.edit(
+            environment.alias_address(0),
+            to_address=environment.user_email(next(counter) % size),
+            pretty=False,
+        ),
+        repeat,
+    )
+    results.measure(
+        f"repo.alias.delete[{size}]",
+        lambda: alias_repo.delete(pending.pop()),
+        repeat,
+        setup=lambda: pending.append(
+            alias_repo.create(
+                f"gone{next(counter)}@{domain}", environment.user_email(0), pretty=False
+            )["rows"][0][1]
+        ),
+    )
+    conn.close()
@@ -0,0 +1,78 @@
+import os
+import sqlite3
+from configparser import ConfigParser
+
+from mailiness import g, settings
+
+DOMAINS = 100
+
+# A valid bcrypt hash of "secret" so rows look real without paying for hashing.
+PASSWORD_HASH = (
+    "{BLF-CRYPT}$2b$04$yIEKc0YvZMgz9OgvfE0BNuJnwWVgJP0VKdCaSg6gGHZCtkvw3rraG"
+)
+
+
+def configure(directory: str) -> ConfigParser:
+    """
+    Point the configuration at files inside directory.
+
+    This must run before the mailiness modules reading the configuration
+    at import time are imported.
+    """
+    config = settings.get_default_config()
+    config["mail"]["vmail_directory"] = os.path.join(directory, "vmail")
+    config["mail"]["usage_index_path"] = os.path.join(directory, "usage.db")
+    config["db"]["connection_string"] = os.path.join(directory, "mailserver.db")
+    config["spam"]["dkim_private_key_directory"] = os.path.join(directory, "dkim")
+    config["spam"]["dkim_maps_path"] = os.path.join(directory, "dkim_selectors.map")
+    os.makedirs(config["mail"]["vmail_directory"])
+    os.makedirs(config["spam"]["dkim_private_key_directory"])
+    open(config["spam"]["dkim_maps_path"], "w").close()
+    config_file = os.path.join(directory, "mailiness.ini")
+    with open(config_file, "w", encoding="utf-8") as fp:
+        config.write(fp)
+    os.environ["CONFIG_FILE"] = config_file
+    g.config = config
+    return config
+
+
+def domain_name(i: int) -> str:
+    return f"domain{i}.com"
+
+
+def user_email(i: int) -> str:
+    return f"user{i}@{domain_name(i % DOMAINS)}"
+
+
+def alias_address(i: int) -> str:
+    return f"alias{i}@{domain_name(i % DOMAINS)}"
+
+
+def build_database(path: str, size: int) -> sqlite3.Connection:
+    """
+    Create a database holding size users and size aliases spread over DOMAINS domains.
+    """
+    from mailiness import migrations
+
+    if os.path.exists(path):
+        os.unlink(path)
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn)
+    domains_table = g.config["db"]["domains_table_name"]
+    conn.executemany(
+        f"INSERT INTO {domains_table} VALUES (?)",
+        ((domain_name(i),) for i in range(DOMAINS)),
+    )
+    conn.executemany(
+        f"INSERT INTO {g.config['db']['users_table_name']} VALUES (?,?,?,?)",
+        (
+            (i % DOMAINS + 1, user_email(i), PASSWORD_HASH, 1_000_000_000)
+            for i in range(size)
+        ),
+    )
+    conn.executemany(
+        f"INSERT INTO {g.config['db']['aliases_table_name']} VALUES (?,?,?)",
+        ((i % DOMAINS + 1, alias_address(i), user_email(i)) for i in range(size)),
+    )
+    conn.commit()
+    return conn
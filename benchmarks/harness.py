@@ -0,0 +1,79 @@
+import json
+import platform
+import sqlite3
+import statistics
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+
+class Results:
+    """
+    Timings collected during a run, keyed by benchmark name.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    def measure(
+        self,
+        name: str,
+        fn: Callable[[], None],
+        repeat: int = 5,
+        setup: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Time fn repeat times, calling setup untimed before every run.
+        """
+        samples = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        self.timings[name] = {
+            "min": min(samples),
+            "median": statistics.median(samples),
+            "max": max(samples),
+            "repeat": repeat,
+        }
+        print(f"{name:<50} {1000 * self.timings[name]['median']:>12.3f} ms")
+
+    def to_dict(self, sizes: list) -> dict:
+        return {
+            "meta": {
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "sizes": sizes,
+            },
+            "timings": self.timings,
+        }
+
+
+def save(path: str, data: dict):
+    with open(path, "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """
+    Return (name, baseline median, current median, ratio) for every benchmark
+    whose median grew by more than threshold, a fraction of the baseline.
+    """
+    regressions = []
+    for name, timing in current["timings"].items():
+        previous = baseline["timings"].get(name)
+        if previous is None or not previous["median"]:
+            continue
+        ratio = timing["median"] / previous["median"]
+        if ratio > 1 + threshold:
+            regressions.append((name, previous["median"], timing["median"], ratio))
+    return regressions
@@ -1,5 +1,6 @@
-from threading import local
+from types import SimpleNamespace
 
 __version__ = "0.2.3"
 
-g = local()
+# Shared by every thread of the process.
+g = SimpleNamespace()
@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from . import connections, repo
+
+DEFAULT_READERS = 4
+
+# Jobs submitted to an executor at once, per worker thread.
+DEFAULT_PENDING_PER_WORKER = 4
+
+
+def _copy(data: dict) -> dict:
+    # Repositories reuse a per-thread dict, hand the caller its own.
+    return {"headers": data["headers"], "rows": list(data["rows"])}
+
+
+class Workers:
+    """
+    The threads async repository calls run on.
+
+    Nothing touches SQLite or bcrypt on the event loop. Writes run on a
+    single writer thread since SQLite only allows one writer at a time,
+    reads on a pool of reader threads with a connection each, and password
+    hashing on its own executor so bcrypt rounds never hold up database
+    work. Both release the GIL while they run.
+
+    Every executor admits a bounded number of jobs, callers past that wait
+    on the event loop instead of piling up in the executor's queue.
+
+    Create one per process, share it between repositories and use it from a
+    single event loop:
+
+        async with aio.Workers() as workers:
+            users = aio.UserRepository(workers)
+            await users.create("john@smith.com", "secret", 1)
+    """
+
+    def __init__(
+        self,
+        provider: Optional[connections.ConnectionProvider] = None,
+        readers: int = DEFAULT_READERS,
+        hashers: Optional[int] = None,
+        pending_per_worker: int = DEFAULT_PENDING_PER_WORKER,
+    ):
+        hashers = hashers or os.cpu_count() or 1
+        # One connection per reader and one for the writer.
+        self.provider = provider or connections.ConnectionProvider(
+            max_connections=readers + 1
+        )
+        self._executors = {
+            "write": ThreadPoolExecutor(1, thread_name_prefix="mailiness-writer"),
+            "read": ThreadPoolExecutor(readers, thread_name_prefix="mailiness-reader"),
+            "hash": ThreadPoolExecutor(hashers, thread_name_prefix="mailiness-hasher"),
+        }
+        self._limits = {
+            "write": pending_per_worker,
+            "read": readers * pending_per_worker,
+            "hash": hashers * pending_per_worker,
+        }
+        # Created on first use so they belong to the running loop.
+        self._semaphores = {}
+
+    async def _run(self, kind: str, fn: Callable, *args, **kwargs):
+        semaphore = self._semaphores.get(kind)
+        if semaphore is None:
+            semaphore = self._semaphores[kind] = asyncio.Semaphore(self._limits[kind])
+        async with semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executors[kind], functools.partial(fn, *args, **kwargs)
+            )
+
+    async def read(self, fn: Callable, *args, **kwargs):
+        """
+        Run fn on a reader thread.
+        """
+        return await self._run("read", fn, *args, **kwargs)
+
+    async def write(self, fn: Callable, *args, **kwargs):
+        """
+        Run fn on the writer thread.
+        """
+        return await self._run("write", fn, *args, **kwargs)
+
+    async def hash(self, fn: Callable, *args, **kwargs):
+        """
+        Run fn on a hashing thread.
+        """
+        return await self._run("hash", fn, *args, **kwargs)
+
+    def close(self):
+        """
+        Wait for running jobs and close the connections.
+        """
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+        self.provider.close()
+
+    async def __aenter__(self) -> "Workers":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+class DomainRepository:
+    def __init__(self, workers: Workers):
+        self.workers = workers
+        self._repo = repo.DomainRepository(provider=workers.provider)
+
+    def _index(self) -> dict:
+        return _copy(self._repo.index(pretty=False))
+
+    async def index(self) -> dict:
+        return await self.workers.read(self._index)
+
+    def _create(self, name: str) -> dict:
+        return _copy(self._repo.create(name, pretty=False))
+
+    async def create(self, name: str) -> dict:
+        return await self.workers.write(self._create, name)
+
+    def _edit(self, what: str, old: str, new: str) -> dict:
+        return _copy(self._repo.edit(what, old, new, pretty=False))
+
+    async def edit(self, what: str, old: str, new: str) -> dict:
+        return await self.workers.write(self._edit, what, old, new)
+
+    async def delete(self, name: str, batch_size: Optional[int] = None):
+        await self.workers.write(self._repo.delete, name, batch_size=batch_size)
+
+
+class UserRepository:
+    def __init__(self, workers: Workers):
+        self.workers = workers
+        self._repo = repo.UserRepository(provider=workers.provider)
+
+    def _index(self, domain: Optional[str]) -> dict:
+        return _copy(self._repo.index(domain, pretty=False))
+
+    async def index(self, domain: Optional[str] = None) -> dict:
+        return await self.workers.read(self._index, domain)
+
+    async def hash_password(self, password: str) -> str:
+        return await self.workers.hash(self._repo._hash_password, password)
+
+    async def verify_password(self, email: str, password: str) -> bool:
+        """
+        Check a user's password. Unknown users never match.
+        """
+        password_hash = await self.workers.read(self._repo.get_password_hash, email)
+        if password_hash is None:
+            return False
+        return await self.workers.hash(
+            self._repo.verify_password, password, password_hash
+        )
+
+    def _create(self, email: str, password_hash: str, quota: int) -> dict:
+        return _copy(
+            self._repo.create(
+                email, None, quota, pretty=False, password_hash=password_hash
+            )
+        )
+
+    async def create(self, email: str, password: str, quota: int) -> dict:
+        """
+        Create a user. The password is hashed before the writer is involved.
+        """
+        password_hash = await self.hash_password(password)
+        return await self.workers.write(self._create, email, password_hash, quota)
+
+    async def edit(
+        self,
+        email: str,
+        new_email: Optional[str] = None,
+        password: Optional[str] = None,
+        quota: Optional[int] = None,
+    ):
+        password_hash = await self.hash_password(password) if password else None
+        await self.workers.write(
+            self._repo.edit,
+            email,
+            new_email=new_email,
+            quota=quota,
+            password_hash=password_hash,
+        )
+
+    async def delete(self, email: str):
+        await self.workers.write(self._repo.delete, email)
+
+
+class AliasRepository:
+    def __init__(self, workers: Workers):
+        self.workers = workers
+        self._repo = repo.AliasRepository(provider=workers.provider)
+
+    def _index(self, domain: Optional[str], to_address: Optional[str]) -> dict:
+        return _copy(self._repo.index(domain, to_address, pretty=False))
+
+    async def index(
+        self, domain: Optional[str] = None, to_address: Optional[str] = None
+    ) -> dict:
+        return await self.workers.read(self._index, domain, to_address)
+
+    def _resolve(self, address: str) -> dict:
+        return _copy(self._repo.resolve(address, pretty=False))
+
+    async def resolve(self, address: str) -> dict:
+        return await self.workers.read(self._resolve, address)
+
+    def _create(self, from_address: str, to_address: str) -> dict:
+        return _copy(self._repo.create(from_address, to_address, pretty=False))
+
+    async def create(self, from_address: str, to_address: str) -> dict:
+        return await self.workers.write(self._create, from_address, to_address)
+
+    def _edit(
+        self, from_address: str, new_from: Optional[str], to_address: Optional[str]
+    ) -> dict:
+        return _copy(self._repo.edit(from_address, new_from, to_address, pretty=False))
+
+    async def edit(
+        self,
+        from_address: str,
+        new_from: Optional[str] = None,
+        to_address: Optional[str] = None,
+    ) -> dict:
+        return await self.workers.write(self._edit, from_address, new_from, to_address)
+
+    async def delete(self, from_address: str):
+        await self.workers.write(self._repo.delete, from_address)
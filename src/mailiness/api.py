@@ -0,0 +1,439 @@
+import ipaddress
+import json
+import os
+import sqlite3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, Optional
+from urllib.parse import unquote, urlsplit
+
+from mailiness import __version__, g
+
+from . import connections, dkim, metrics, repo, settings
+
+DEFAULT_BIND = settings.API_BIND
+
+# Larger bodies are refused, split big bulk requests instead.
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Rows read per query and written per chunk of a streamed list.
+STREAM_BATCH_SIZE = 1000
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Uncommitted:
+    """
+    Connection whose commit() does nothing so several repository calls end
+    up in the caller's transaction.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        pass
+
+
+def parse_bind(bind: str) -> tuple:
+    host, _, port = bind.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Expected HOST:PORT, got {bind}.")
+    return host.strip("[]"), int(port)
+
+
+def is_loopback(host: str) -> bool:
+    """
+    Whether only this machine can connect to host. Host names other than
+    localhost aren't resolved and count as remote.
+    """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _domain(row: tuple) -> dict:
+    return {"id": row[0], "name": row[1]}
+
+
+def _user(row: tuple) -> dict:
+    return {"id": row[0], "email": row[1], "quota": row[2]}
+
+
+def _alias(row: tuple) -> dict:
+    return {"id": row[0], "from": row[1], "to": row[2]}
+
+
+def _field(body: dict, name: str, kind=str, required=True):
+    value = body.get(name)
+    if value is None:
+        if required:
+            raise ApiError(400, f"{name} is required.")
+        return None
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ApiError(400, f"{name} must be a {kind.__name__}.")
+    return value
+
+
+def _move_domain_files(old: str, new: str):
+    """
+    Follow a domain rename on disk, like domain edit name does.
+    """
+    vmail_directory = Path(g.config["mail"]["vmail_directory"])
+    if (vmail_directory / old).exists():
+        os.rename(vmail_directory / old, vmail_directory / new)
+    dkim.rename_domain(old, new)
+
+
+class Api:
+    """
+    JSON operations behind the HTTP server, independent of HTTP itself.
+
+    route() returns the status and a payload: a dict for JSON, an iterator
+    of dicts streamed as NDJSON, a string sent as plain text or None for an
+    empty response.
+
+    Writes to the database are the same as the CLI's. POST /bulk takes a
+    list of {"method", "path", "body"} requests and runs them in a single
+    transaction, either all of them are applied or none.
+    """
+
+    def __init__(self, provider: connections.ConnectionProvider):
+        self.provider = provider
+        self.repositories = self._repositories(provider=provider)
+
+    @staticmethod
+    def _repositories(**kwargs) -> dict:
+        return {
+            "domains": repo.DomainRepository(**kwargs),
+            "users": repo.UserRepository(**kwargs),
+            "aliases": repo.AliasRepository(**kwargs),
+        }
+
+    def route(self, method: str, parts: list, body) -> tuple:
+        try:
+            if parts == ["metrics"] and method == "GET":
+                return 200, metrics.render()
+            if parts == ["bulk"] and method == "POST":
+                return 200, self._bulk(body)
+            if parts and parts[0] == "dkim" and len(parts) == 2:
+                return self._dkim(method, parts[1], body)
+            if parts and parts[0] in self.repositories and len(parts) <= 2:
+                if method == "GET" and len(parts) == 1:
+                    return 200, self._list(parts[0])
+                renamed = []
+                result = self._write(
+                    self.repositories,
+                    method,
+                    parts,
+                    body,
+                    self._password_hash(method, parts, body),
+                    renamed,
+                )
+                for old, new in renamed:
+                    _move_domain_files(old, new)
+                return result
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        except sqlite3.IntegrityError as e:
+            raise ApiError(409, str(e))
+        raise ApiError(404, "Not found.")
+
+    def _password_hash(self, method: str, parts: list, body) -> Optional[str]:
+        """
+        Hash the password a user write sets. bcrypt is slow, so writes hash
+        before taking the write lock and hand the repository the hash.
+        """
+        if (
+            method in ("POST", "PATCH")
+            and parts[0] == "users"
+            and isinstance(body, dict)
+            and isinstance(body.get("password"), str)
+        ):
+            return self.repositories["users"]._hash_password(body["password"])
+        return None
+
+    def _list(self, resource: str) -> Iterator[dict]:
+        rows = self.repositories[resource].iterate(batch_size=STREAM_BATCH_SIZE)
+        if resource == "domains":
+            return (_domain(row) for row in rows)
+        if resource == "users":
+            # Never hand out password hashes.
+            return (
+                _user((rowid, email, int(quota or 0) / 1_000_000_000))
+                for rowid, email, _, quota in rows
+            )
+        return (_alias(row) for row in rows)
+
+    def _write(
+        self,
+        repositories: dict,
+        method: str,
+        parts: list,
+        body,
+        password_hash: Optional[str] = None,
+        renamed: Optional[list] = None,
+    ) -> tuple:
+        resource = parts[0]
+        key = parts[1] if len(parts) == 2 else None
+        body = body if isinstance(body, dict) else {}
+        if method == "POST" and key is None:
+            return 201, self._create(
+                repositories[resource], resource, body, password_hash
+            )
+        if method == "PATCH" and key is not None:
+            return self._edit(
+                repositories[resource], resource, key, body, password_hash, renamed
+            )
+        if method == "DELETE" and key is not None:
+            repositories[resource].delete(key)
+            return 204, None
+        raise ApiError(405, f"{method} is not allowed here.")
+
+    def _create(
+        self, repository, resource: str, body: dict, password_hash: Optional[str]
+    ) -> dict:
+        if resource == "domains":
+            data = repository.create(_field(body, "name"), pretty=False)
+            return _domain(data["rows"][0])
+        if resource == "users":
+            data = repository.create(
+                _field(body, "email"),
+                None if password_hash else _field(body, "password"),
+                _field(body, "quota", int),
+                pretty=False,
+                password_hash=password_hash,
+            )
+            return _user(data["rows"][0])
+        data = repository.create(_field(body, "from"), _field(body, "to"), pretty=False)
+        return _alias(data["rows"][0])
+
+    def _edit(
+        self,
+        repository,
+        resource: str,
+        key: str,
+        body: dict,
+        password_hash: Optional[str],
+        renamed: Optional[list],
+    ) -> tuple:
+        if resource == "domains":
+            old = repository.get_name(key)
+            if old is None:
+                raise ApiError(404, f"Domain {key} doesn't exist.")
+            new = repo.normalize_address(_field(body, "name"))
+            if (Path(g.config["mail"]["vmail_directory"]) / new).exists():
+                raise ApiError(409, f"The mail directory of {new} already exists.")
+            data = repository.edit("name", old, new, pretty=False)
+            if renamed is not None:
+                renamed.append((old, new))
+            return 200, _domain(data["rows"][0])
+        if resource == "users":
+            if not body:
+                raise ApiError(400, "Nothing to change.")
+            repository.edit(
+                key,
+                new_email=_field(body, "email", required=False),
+                password=None
+                if password_hash
+                else _field(body, "password", required=False),
+                quota=_field(body, "quota", int, required=False),
+                password_hash=password_hash,
+            )
+            return 204, None
+        new_from = _field(body, "from", required=False)
+        to_address = _field(body, "to", required=False)
+        if not new_from and not to_address:
+            raise ApiError(400, "Nothing to change.")
+        data = repository.edit(key, new_from, to_address, pretty=False)
+        if not data["rows"]:
+            raise ApiError(404, f"Alias {key} doesn't exist.")
+        return 200, _alias(data["rows"][0])
+
+    def _bulk(self, requests) -> dict:
+        if not isinstance(requests, list):
+            raise ApiError(400, "Expected a list of requests.")
+        operations = []
+        for i, request in enumerate(requests):
+            if not isinstance(request, dict):
+                raise ApiError(400, f"Request {i} isn't an object.")
+            method = request.get("method", "")
+            parts = [unquote(part) for part in request.get("path", "").split("/")]
+            parts = [part for part in parts if part]
+            if method not in ("POST", "PATCH", "DELETE") or not (
+                parts and parts[0] in self.repositories and len(parts) <= 2
+            ):
+                raise ApiError(400, f"Request {i} can't be part of a bulk request.")
+            operations.append((method, parts, request.get("body") or {}))
+
+        hashes = [
+            self._password_hash(method, parts, body)
+            for method, parts, body in operations
+        ]
+
+        results = []
+        renamed = []
+        with self.provider.writing() as conn:
+            repositories = self._repositories(conn=_Uncommitted(conn))
+            for i, ((method, parts, body), password_hash) in enumerate(
+                zip(operations, hashes)
+            ):
+                try:
+                    status, result = self._write(
+                        repositories, method, parts, body, password_hash, renamed
+                    )
+                except ApiError as e:
+                    raise ApiError(e.status, f"Request {i}: {e}")
+                except ValueError as e:
+                    raise ApiError(400, f"Request {i}: {e}")
+                except sqlite3.IntegrityError as e:
+                    raise ApiError(409, f"Request {i}: {e}")
+                results.append({"status": status, "body": result})
+        for old, new in renamed:
+            _move_domain_files(old, new)
+        return {"results": results}
+
+    def _dkim(self, method: str, domain: str, body) -> tuple:
+        # Keys and the DKIM map use names as the database stores them.
+        domain = repo.normalize_address(domain)
+        selector = dkim.read_dkim_map().get(domain)
+        if method == "GET":
+            if selector is None:
+                raise ApiError(404, f"{domain} doesn't have a DKIM key.")
+            key = dkim.DKIM(domain=domain)
+            return 200, {
+                "domain": domain,
+                "selector": key.selector,
+                "record": key.dns_txt_record(),
+            }
+        if method == "POST":
+            if selector is not None:
+                raise ApiError(409, f"{domain} already has a DKIM key.")
+            body = body if isinstance(body, dict) else {}
+            key = dkim.DKIM(
+                domain=domain, selector=_field(body, "selector", required=False)
+            )
+            key.save_private_key()
+            return 201, {
+                "domain": domain,
+                "selector": key.selector,
+                "record": key.dns_txt_record(),
+            }
+        if method == "DELETE":
+            if selector is None:
+                raise ApiError(404, f"{domain} doesn't have a DKIM key.")
+            dkim.DKIM(domain=domain).delete_key()
+            return 204, None
+        raise ApiError(405, f"{method} is not allowed here.")
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests.
+    protocol_version = "HTTP/1.1"
+    server_version = f"mailiness/{__version__}"
+
+    def _read_body(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Where the body ends is unknown, the connection can't be reused.
+            self.close_connection = True
+            raise ApiError(400, "Invalid Content-Length.")
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            raise ApiError(413, "Request body too large.")
+        if not length:
+            return None
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ApiError(400, "Request body isn't valid JSON.")
+
+    def _dispatch(self, method: str):
+        path = urlsplit(self.path).path
+        parts = [unquote(part) for part in path.split("/") if part]
+        try:
+            status, payload = self.server.api.route(method, parts, self._read_body())
+        except ApiError as e:
+            status, payload = e.status, {"error": str(e)}
+        except Exception as e:
+            self.log_error("%s: %s", type(e).__name__, e)
+            status, payload = 500, {"error": "Internal error."}
+        finally:
+            # Clients keep their connection open, don't hog the pool.
+            self.server.api.provider.release()
+
+        if payload is None:
+            self._send(status, b"", None)
+        elif isinstance(payload, str):
+            self._send(status, payload.encode("utf-8"), "text/plain; version=0.0.4")
+        elif isinstance(payload, dict):
+            self._send(status, json.dumps(payload).encode("utf-8"), "application/json")
+        else:
+            try:
+                self._stream(status, payload)
+            finally:
+                self.server.api.provider.release()
+
+    def _send(self, status: int, data: bytes, content_type: Optional[str]):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, status: int, records: Iterator[dict]):
+        """
+        Send records as NDJSON in chunks so lists of any size use little memory.
+        """
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        while True:
+            batch = list(islice(records, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            data = "".join(json.dumps(record) + "\n" for record in batch)
+            data = data.encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, api: Api, quiet: bool = False):
+        self.api = api
+        self.quiet = quiet
+        super().__init__(address, ApiRequestHandler)
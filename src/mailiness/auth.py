@@ -0,0 +1,218 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Optional
+
+from . import cache, connections, metrics, repo
+
+# Status codes understood by Dovecot's checkpassword passdb.
+CHECKPASSWORD_FAIL = 1
+CHECKPASSWORD_TEMPFAIL = 111
+
+
+class Authenticator:
+    """
+    Verify credentials against the users table.
+
+    Successful verifications are remembered in a CredentialCache so that
+    clients reconnecting with the same password skip the bcrypt check.
+    """
+
+    def __init__(
+        self,
+        credential_cache: Optional[cache.CredentialCache] = None,
+        conn=None,
+        provider: Optional[connections.ConnectionProvider] = None,
+    ):
+        self.cache = (
+            credential_cache if credential_cache is not None else cache.credentials
+        )
+        if conn is None and provider is None:
+            provider = connections.get_provider()
+        # Every server thread gets its own connection from the provider.
+        self.user_repo = repo.UserRepository(conn=conn, provider=provider)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.verifications = 0
+        self.verification_seconds = 0.0
+        self.verification_seconds_max = 0.0
+        self.request_seconds = 0.0
+
+    def verify(self, email: str, password: str) -> bool:
+        start = time.perf_counter()
+        user_repo = self.user_repo
+        password_hash = user_repo.get_password_hash(email)
+
+        if password_hash is None:
+            ok = False
+        elif self.cache.get(email, password, password_hash):
+            ok = True
+        else:
+            verify_start = time.perf_counter()
+            ok = user_repo.verify_password(password, password_hash)
+            elapsed = time.perf_counter() - verify_start
+            with self._lock:
+                self.verifications += 1
+                self.verification_seconds += elapsed
+                self.verification_seconds_max = max(
+                    self.verification_seconds_max, elapsed
+                )
+            if ok:
+                self.cache.put(email, password, password_hash)
+
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += time.perf_counter() - start
+            if not ok:
+                self.failures += 1
+        if user_repo.provider is not None:
+            # Clients may keep their connection open, don't hog the pool.
+            user_repo.provider.release()
+        return ok
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "cache_size": len(self.cache),
+                "cache_hits": self.cache.hits,
+                "cache_misses": self.cache.misses,
+                "cache_evictions": self.cache.evictions,
+                "cache_hit_rate": round(self.cache.hit_rate, 4),
+                "verifications": self.verifications,
+                "verification_ms_avg": round(
+                    1000 * self.verification_seconds / self.verifications, 3
+                )
+                if self.verifications
+                else 0.0,
+                "verification_ms_max": round(1000 * self.verification_seconds_max, 3),
+                "request_ms_avg": round(1000 * self.request_seconds / self.requests, 3)
+                if self.requests
+                else 0.0,
+            }
+
+
+def render_metrics(authenticator: Authenticator) -> str:
+    stats = authenticator.stats()
+    return metrics.render(
+        extra={
+            "mailiness_auth_requests_total": (
+                "counter",
+                "Authentication requests.",
+                stats["requests"],
+            ),
+            "mailiness_auth_failures_total": (
+                "counter",
+                "Failed authentication requests.",
+                stats["failures"],
+            ),
+            "mailiness_auth_cache_hits_total": (
+                "counter",
+                "Requests answered from the credential cache.",
+                stats["cache_hits"],
+            ),
+            "mailiness_auth_cache_misses_total": (
+                "counter",
+                "Requests that needed a bcrypt verification.",
+                stats["cache_misses"],
+            ),
+            "mailiness_auth_cache_entries": (
+                "gauge",
+                "Credentials in the cache.",
+                stats["cache_size"],
+            ),
+            "mailiness_auth_verification_seconds_total": (
+                "counter",
+                "Time spent in bcrypt verifications.",
+                authenticator.verification_seconds,
+            ),
+        }
+    )
+
+
+class AuthRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Line based protocol.
+
+    AUTH<TAB>email<TAB>password answers OK or FAIL.
+    STATS answers STATS<TAB>json.
+    METRICS answers with Prometheus metrics followed by a line holding a
+    single dot.
+    """
+
+    def handle(self):
+        for raw in self.rfile:
+            line = raw.decode("utf-8").rstrip("\r\n")
+            command, _, rest = line.partition("\t")
+            if command == "AUTH":
+                email, _, password = rest.partition("\t")
+                ok = self.server.authenticator.verify(email, password)
+                self.wfile.write(b"OK\n" if ok else b"FAIL\n")
+            elif command == "STATS":
+                stats = json.dumps(self.server.authenticator.stats())
+                self.wfile.write(f"STATS\t{stats}\n".encode("utf-8"))
+            elif command == "METRICS":
+                text = render_metrics(self.server.authenticator)
+                self.wfile.write(text.encode("utf-8") + b".\n")
+            else:
+                self.wfile.write(b"ERROR\tunknown command\n")
+
+
+class AuthServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, authenticator: Authenticator):
+        self.authenticator = authenticator
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, AuthRequestHandler)
+
+
+def request(socket_path: str, line: str, timeout: float = 10.0) -> str:
+    """
+    Send a single request line to a running auth server and return the reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(line.encode("utf-8") + b"\n")
+        with sock.makefile("rb") as fp:
+            return fp.readline().decode("utf-8").rstrip("\n")
+
+
+def request_metrics(socket_path: str, timeout: float = 10.0) -> str:
+    """
+    Return the Prometheus metrics of a running auth server.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(b"METRICS\n")
+        lines = []
+        with sock.makefile("rb") as fp:
+            for raw in fp:
+                line = raw.decode("utf-8")
+                if line == ".\n":
+                    break
+                lines.append(line)
+        return "".join(lines)
+
+
+def read_checkpassword_input(fd: int = 3) -> tuple:
+    """
+    Read "username\\0password\\0..." as passed by Dovecot's checkpassword passdb.
+    """
+    data = b""
+    while len(data) < 512:
+        chunk = os.read(fd, 512 - len(data))
+        if not chunk:
+            break
+        data += chunk
+    os.close(fd)
+    username, password = data.split(b"\0")[:2]
+    return username.decode("utf-8"), password.decode("utf-8")
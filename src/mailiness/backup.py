@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+BACKUP_PREFIX = "mailiness-"
+BACKUP_SUFFIX = ".db"
+
+
+def get_backup_path(dest: str) -> Path:
+    """
+    Return dest, or a timestamped file inside dest if it's a directory.
+    """
+    path = Path(dest)
+    if path.is_dir():
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        return path / f"{BACKUP_PREFIX}{timestamp}{BACKUP_SUFFIX}"
+    return path
+
+
+def backup(
+    conn: sqlite3.Connection,
+    dest: Path,
+    pages: int = 1024,
+    sleep: float = 0.05,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> tuple:
+    """
+    Copy the database behind conn to dest while it stays in use.
+
+    The backup API copies pages at a time and the source is only locked
+    while a step runs. Sleeping between steps gives Postfix, Dovecot and
+    other mailiness commands room to read and write. progress is called with
+    the number of pages copied and the total after every step.
+
+    The copy is written next to dest and renamed when complete so dest is
+    never a partial backup. Return the number of pages copied and the time
+    taken in seconds.
+    """
+    tmp_path = dest.with_name(f".{dest.name}.tmp")
+    copied = 0
+
+    def on_step(status, remaining, total):
+        nonlocal copied
+        copied = total - remaining
+        if progress is not None:
+            progress(copied, total)
+        if remaining:
+            time.sleep(sleep)
+
+    start = time.perf_counter()
+    target = sqlite3.connect(tmp_path)
+    try:
+        conn.backup(target, pages=pages, progress=on_step)
+    except BaseException:
+        target.close()
+        os.unlink(tmp_path)
+        raise
+    target.close()
+    os.replace(tmp_path, dest)
+    return copied, time.perf_counter() - start
+
+
+def verify(path: Path) -> list[str]:
+    """
+    Run an integrity check on a backup and return the problems found.
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+    return [] if rows == [("ok",)] else [row[0] for row in rows]
+
+
+def rotate(directory: Path, keep: int) -> list[Path]:
+    """
+    Delete all but the newest keep backups in directory and return the deleted paths.
+
+    Only files named like the ones get_backup_path creates are considered.
+    """
+    backups = sorted(
+        path
+        for path in directory.iterdir()
+        if path.name.startswith(BACKUP_PREFIX) and path.name.endswith(BACKUP_SUFFIX)
+    )
+    # Timestamps sort chronologically so the oldest come first.
+    deleted = backups[: max(len(backups) - keep, 0)]
+    for path in deleted:
+        path.unlink()
+    return deleted
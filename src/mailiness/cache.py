@@ -0,0 +1,88 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+
+class CredentialCache:
+    """
+    Bounded LRU cache of recently verified credentials.
+
+    Entries are keyed on the email address and hold a keyed digest of the
+    password, never the plaintext. Each entry also remembers the password hash
+    it was verified against so that a hash changed behind our back is never
+    answered from the cache.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        ttl: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._key = secrets.token_bytes(32)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _digest(self, email: str, password: str) -> bytes:
+        return hmac.new(
+            self._key, f"{email}\0{password}".encode("utf-8"), hashlib.sha256
+        ).digest()
+
+    def get(self, email: str, password: str, password_hash: str) -> bool:
+        """
+        Return True if this password was recently verified against password_hash.
+        """
+        digest = self._digest(email, password)
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is not None:
+                cached_digest, cached_hash, expires = entry
+                if expires <= self.clock() or cached_hash != password_hash:
+                    del self._entries[email]
+                elif hmac.compare_digest(cached_digest, digest):
+                    self._entries.move_to_end(email)
+                    self.hits += 1
+                    return True
+            self.misses += 1
+            return False
+
+    def put(self, email: str, password: str, password_hash: str):
+        """
+        Remember a successful verification.
+        """
+        digest = self._digest(email, password)
+        with self._lock:
+            self._entries[email] = (digest, password_hash, self.clock() + self.ttl)
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, email: str):
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+credentials = CredentialCache()
@@ -1,16 +1,27 @@
 import argparse
+import sys
+import time
 from typing import Optional, Sequence
 
 from mailiness import g
 
-from . import settings
+from . import profiling, settings
 
+_start = time.perf_counter()
 g.config = settings.get_config()
+profiling.timings.record("config load", time.perf_counter() - _start)
 
-from . import commands, dkim, handlers  # noqa: E402
+_start = time.perf_counter()
+# Only what building the parser needs, handlers import the rest when a
+# command runs. Defaults of the other modules are in settings.
+from . import commands, connections, dkim, handlers, repo  # noqa: E402
+
+profiling.timings.record("imports", time.perf_counter() - _start)
 
 selector_timestamp = dkim.get_default_selector()
 
+AUTH_SOCKET = "/run/mailiness/auth.sock"
+
 
 def add_dkim_parser(parser):
     dkim_parser = parser.add_parser("dkim", help="dkim commands")
@@ -92,6 +103,12 @@ def add_domain_parser(parser):
         default=False,
         help="Delete domain and mailboxes, DKIM keys, etc.",
     )
+    domain_delete.add_argument(
+        "--batch-size",
+        type=int,
+        help="Delete users and aliases this many rows at a time in short transactions. "
+        "Run the command again to resume an interrupted delete.",
+    )
     domain_delete.add_argument(
         "--yes",
         "-y",
@@ -156,6 +173,22 @@ def add_user_parser(parser):
     user_list.add_argument("--domain", "-d", help="List users for this domain only.")
     user_list.set_defaults(func=handlers.handle_user_list, func_args=True)
 
+    user_search = user_subparsers.add_parser(
+        "search", help="Find users by email address."
+    )
+    user_search.add_argument(
+        "pattern",
+        help="Glob pattern like 'john*' or '*@example.com'. Without * or ? matches emails containing it.",
+    )
+    user_search.add_argument(
+        "--limit",
+        "-l",
+        type=int,
+        default=repo.DEFAULT_SEARCH_LIMIT,
+        help=f"Show at most this many users, 0 for all. Default: {repo.DEFAULT_SEARCH_LIMIT}",
+    )
+    user_search.set_defaults(func=handlers.handle_user_search, func_args=True)
+
     user_delete = user_subparsers.add_parser("delete", help="Delete a user.")
     user_delete.add_argument("email", help="The target's email address.")
     user_delete.add_argument(
@@ -182,8 +215,34 @@ def add_alias_parser(parser):
     alias_list.add_argument(
         "--domain", "-d", type=str, help="Show aliases from this domain only."
     )
+    alias_list.add_argument(
+        "--to", "-t", type=str, help="Show aliases delivering to this address only."
+    )
     alias_list.set_defaults(func=handlers.handle_alias_list, func_args=True)
 
+    alias_search = alias_subparsers.add_parser(
+        "search", help="Find aliases by address."
+    )
+    alias_search.add_argument(
+        "pattern",
+        help="Glob pattern like 'info@*' or '*@example.com'. Without * or ? matches addresses containing it.",
+    )
+    alias_search.add_argument(
+        "--to",
+        "-t",
+        action="store_true",
+        default=False,
+        help="Match the targets instead of the from address.",
+    )
+    alias_search.add_argument(
+        "--limit",
+        "-l",
+        type=int,
+        default=repo.DEFAULT_SEARCH_LIMIT,
+        help=f"Show at most this many aliases, 0 for all. Default: {repo.DEFAULT_SEARCH_LIMIT}",
+    )
+    alias_search.set_defaults(func=handlers.handle_alias_search, func_args=True)
+
     alias_edit = alias_subparsers.add_parser("edit", help="Edit an alias.")
     alias_edit.add_argument("from_address", help="The target from_address.")
     alias_edit.add_argument(
@@ -196,6 +255,25 @@ def add_alias_parser(parser):
     alias_delete.add_argument("from_address", help="The from address.")
     alias_delete.set_defaults(func=handlers.handle_alias_delete, func_args=True)
 
+    alias_resolve = alias_subparsers.add_parser(
+        "resolve", help="Show where mail for an address ends up."
+    )
+    alias_resolve.add_argument("address", help="The address to resolve.")
+    alias_resolve.set_defaults(func=handlers.handle_alias_resolve, func_args=True)
+
+    alias_check = alias_subparsers.add_parser(
+        "check", help="Find alias cycles and dangling targets."
+    )
+    alias_check.add_argument("addresses", nargs="*", help="Addresses to check.")
+    alias_check.add_argument(
+        "--all",
+        "-a",
+        action="store_true",
+        default=False,
+        help="Check every alias in the database.",
+    )
+    alias_check.set_defaults(func=handlers.handle_alias_check, func_args=True)
+
 
 def add_config_parser(parser):
     config_parser = parser.add_parser("config", help="Configuration commands")
@@ -207,6 +285,446 @@ def add_config_parser(parser):
     config_show.set_defaults(func=handlers.handle_config_show, func_args=True)
 
 
+def add_mailbox_parser(parser):
+    mailbox_parser = parser.add_parser("mailbox", help="Mailbox commands")
+    mailbox_parser.set_defaults(func=mailbox_parser.print_help, func_args=False)
+    mailbox_subparsers = mailbox_parser.add_subparsers()
+
+    mailbox_purge = mailbox_subparsers.add_parser(
+        "purge", help="Permanently delete mailboxes moved to the trash."
+    )
+    mailbox_purge.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=4,
+        help="Number of directories to scan in parallel (default: 4)",
+    )
+    mailbox_purge.add_argument(
+        "--rate",
+        "-r",
+        type=float,
+        help="Delete at most this many files per second (default: unlimited)",
+    )
+    mailbox_purge.set_defaults(func=handlers.handle_mailbox_purge, func_args=True)
+
+    mailbox_index = mailbox_subparsers.add_parser(
+        "index", help="Manage the incremental mailbox usage index."
+    )
+    mailbox_index.set_defaults(func=mailbox_index.print_help, func_args=False)
+    mailbox_index_subparsers = mailbox_index.add_subparsers()
+
+    for name, help_text, func in (
+        (
+            "rebuild",
+            "Scan every mailbox from scratch.",
+            handlers.handle_mailbox_index_rebuild,
+        ),
+        (
+            "update",
+            "Rescan only directories that changed since the last run.",
+            handlers.handle_mailbox_index_update,
+        ),
+    ):
+        mailbox_index_command = mailbox_index_subparsers.add_parser(
+            name, help=help_text
+        )
+        mailbox_index_command.add_argument(
+            "--workers",
+            "-w",
+            type=int,
+            default=8,
+            help="Number of mailboxes to scan in parallel (default: 8)",
+        )
+        mailbox_index_command.set_defaults(func=func, func_args=True)
+
+    mailbox_index_stats = mailbox_index_subparsers.add_parser(
+        "stats", help="Show what the index holds."
+    )
+    mailbox_index_stats.set_defaults(
+        func=handlers.handle_mailbox_index_stats, func_args=True
+    )
+
+
+def add_quota_parser(parser):
+    quota_parser = parser.add_parser("quota", help="Quota commands")
+    quota_parser.set_defaults(func=quota_parser.print_help, func_args=False)
+    quota_subparsers = quota_parser.add_subparsers()
+
+    quota_report = quota_subparsers.add_parser(
+        "report", help="Show the users closest to their quota."
+    )
+    quota_report.add_argument("--domain", "-d", help="Report on this domain only.")
+    quota_report.add_argument(
+        "--top",
+        "-n",
+        type=int,
+        default=10,
+        help="Number of users to show (default: 10)",
+    )
+    quota_report.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=8,
+        help="Number of mailboxes to measure in parallel (default: 8)",
+    )
+    quota_report.add_argument(
+        "--no-index",
+        action="store_true",
+        default=False,
+        help="Walk every mailbox instead of using the usage index.",
+    )
+    quota_report.set_defaults(func=handlers.handle_quota_report, func_args=True)
+
+
+def add_db_parser(parser):
+    db_parser = parser.add_parser("db", help="Database commands")
+    db_parser.set_defaults(func=db_parser.print_help, func_args=False)
+    db_subparsers = db_parser.add_subparsers()
+
+    db_migrate = db_subparsers.add_parser(
+        "migrate", help="Create missing tables, indexes and lookup tables."
+    )
+    db_migrate.add_argument(
+        "--dry-run",
+        "-n",
+        action="store_true",
+        default=False,
+        help="Show the pending migrations and the rows they'd touch, change nothing.",
+    )
+    db_migrate.add_argument(
+        "--batch-size",
+        type=int,
+        default=settings.MIGRATION_BATCH_SIZE,
+        help=f"Rows backfilled per transaction. Default: {settings.MIGRATION_BATCH_SIZE}",
+    )
+    db_migrate.set_defaults(func=handlers.handle_db_migrate, func_args=True)
+
+    db_backup = db_subparsers.add_parser(
+        "backup", help="Copy the database while it's in use."
+    )
+    db_backup.add_argument(
+        "dest",
+        help="Backup file, or a directory to create a timestamped backup in.",
+    )
+    db_backup.add_argument(
+        "--pages",
+        "-p",
+        type=int,
+        default=1024,
+        help="Pages copied per step. Default: 1024",
+    )
+    db_backup.add_argument(
+        "--sleep",
+        "-s",
+        type=float,
+        default=0.05,
+        help="Seconds to wait between steps. Default: 0.05",
+    )
+    db_backup.add_argument(
+        "--verify",
+        action="store_true",
+        default=False,
+        help="Run an integrity check on the backup.",
+    )
+    db_backup.add_argument(
+        "--keep",
+        "-k",
+        type=int,
+        help="Keep only this many backups when dest is a directory.",
+    )
+    db_backup.set_defaults(func=handlers.handle_db_backup, func_args=True)
+
+
+def add_doctor_parser(parser):
+    doctor_parser = parser.add_parser(
+        "doctor",
+        help="Find differences between the database, mailboxes and DKIM keys.",
+    )
+    doctor_parser.add_argument(
+        "--fix",
+        action="store_true",
+        default=False,
+        help="Delete orphan users and aliases, trash orphan mailboxes and drop DKIM map entries without a key.",
+    )
+    doctor_parser.set_defaults(func=handlers.handle_doctor, func_args=True)
+
+
+def add_stats_parser(parser):
+    stats_parser = parser.add_parser(
+        "stats", help="Show users, aliases, quota and DKIM status per domain."
+    )
+    stats_parser.add_argument("--domain", "-d", help="Show this domain only.")
+    stats_parser.set_defaults(func=handlers.handle_stats, func_args=True)
+
+
+def add_changes_parser(parser):
+    changes_parser = parser.add_parser(
+        "changes", help="Read the journal of changes to domains, users and aliases."
+    )
+    changes_parser.set_defaults(func=changes_parser.print_help, func_args=False)
+    changes_subparsers = changes_parser.add_subparsers()
+
+    changes_since = changes_subparsers.add_parser(
+        "since", help="Stream the changes after a sequence number as JSON lines."
+    )
+    changes_since.add_argument(
+        "seq", type=int, help="Last sequence number already processed, 0 for all."
+    )
+    changes_since.set_defaults(func=handlers.handle_changes_since, func_args=True)
+
+    changes_head = changes_subparsers.add_parser(
+        "head", help="Print the sequence number of the latest change."
+    )
+    changes_head.set_defaults(func=handlers.handle_changes_head, func_args=True)
+
+    changes_compact = changes_subparsers.add_parser(
+        "compact", help="Delete old changes."
+    )
+    changes_compact.add_argument(
+        "--before", "-b", type=int, help="Delete changes up to this sequence number."
+    )
+    changes_compact.add_argument(
+        "--older-than",
+        "-o",
+        type=float,
+        help="Delete changes older than this many days.",
+    )
+    changes_compact.set_defaults(func=handlers.handle_changes_compact, func_args=True)
+
+
+def add_sync_parser(parser):
+    sync_parser = parser.add_parser(
+        "sync", help="Bring domains, users and aliases in line with an inventory file."
+    )
+    sync_parser.set_defaults(func=sync_parser.print_help, func_args=False)
+    sync_subparsers = sync_parser.add_subparsers()
+
+    for name, help_text, handler in (
+        ("plan", "Print the changes as JSON.", handlers.handle_sync_plan),
+        (
+            "apply",
+            "Apply the changes in a single transaction.",
+            handlers.handle_sync_apply,
+        ),
+    ):
+        sync_command = sync_subparsers.add_parser(name, help=help_text)
+        sync_command.add_argument("file", help="Path to the JSON inventory.")
+        sync_command.add_argument(
+            "--keep-unmanaged",
+            action="store_true",
+            default=False,
+            help="Don't delete domains, users and aliases missing from the inventory.",
+        )
+        sync_command.add_argument(
+            "--check-passwords",
+            action="store_true",
+            default=False,
+            help="Update existing users whose plaintext password changed. "
+            "Costs a bcrypt verification per user.",
+        )
+        sync_command.set_defaults(func=handler, func_args=True)
+
+
+def add_export_parser(parser):
+    export_parser = parser.add_parser("export", help="Export commands")
+    export_parser.set_defaults(func=export_parser.print_help, func_args=False)
+    export_subparsers = export_parser.add_subparsers()
+
+    export_all = export_subparsers.add_parser(
+        "all", help="Stream every domain, user and alias."
+    )
+    export_all.add_argument(
+        "--format",
+        "-f",
+        choices=settings.EXPORT_FORMATS,
+        default="jsonl",
+        help="Default: jsonl",
+    )
+    export_all.add_argument(
+        "--output", "-o", default="-", help="Write to this file instead of stdout."
+    )
+    export_all.add_argument(
+        "--compress",
+        "-c",
+        choices=settings.EXPORT_COMPRESSIONS.keys(),
+        help="Compress the output. Guessed from the output file's extension by default.",
+    )
+    export_all.set_defaults(func=handlers.handle_export_all, func_args=True)
+
+
+def add_import_parser(parser):
+    import_parser = parser.add_parser("import", help="Import commands")
+    import_parser.set_defaults(func=import_parser.print_help, func_args=False)
+    import_subparsers = import_parser.add_subparsers()
+
+    import_all = import_subparsers.add_parser(
+        "all", help="Import the output of export all in a single transaction."
+    )
+    import_all.add_argument(
+        "file", help="File to import, - for stdin. Compression is detected."
+    )
+    import_all.add_argument(
+        "--batch-size",
+        type=int,
+        default=10_000,
+        help="Rows inserted per statement batch. Default: 10000",
+    )
+    import_all.set_defaults(func=handlers.handle_import_all, func_args=True)
+
+
+def add_dev_parser(parser):
+    dev_parser = parser.add_parser("dev", help="Development and load testing helpers")
+    dev_parser.set_defaults(func=dev_parser.print_help, func_args=False)
+    dev_subparsers = dev_parser.add_subparsers()
+
+    dev_generate = dev_subparsers.add_parser(
+        "generate",
+        help="Fill an empty database with synthetic domains, users and aliases.",
+    )
+    dev_generate.add_argument(
+        "--domains", "-d", type=int, default=10, help="Default: 10"
+    )
+    dev_generate.add_argument(
+        "--users-per-domain", "-u", type=int, default=100, help="Default: 100"
+    )
+    dev_generate.add_argument(
+        "--aliases", "-a", type=int, default=0, help="Total number of aliases."
+    )
+    dev_generate.add_argument(
+        "--seed", "-s", type=int, default=0, help="Same seed, same data. Default: 0"
+    )
+    dev_generate.add_argument(
+        "--maildirs",
+        action="store_true",
+        default=False,
+        help="Create a Maildir with dummy messages for every user.",
+    )
+    dev_generate.add_argument(
+        "--messages",
+        type=int,
+        default=3,
+        help="Messages per Maildir. Default: 3",
+    )
+    dev_generate.add_argument(
+        "--message-size",
+        type=int,
+        default=4096,
+        help="Maximum message size in bytes. Default: 4096",
+    )
+    dev_generate.add_argument(
+        "--dkim",
+        action="store_true",
+        default=False,
+        help="Save a DKIM key for every domain.",
+    )
+    dev_generate.set_defaults(func=handlers.handle_dev_generate, func_args=True)
+
+
+def add_auth_parser(parser):
+    auth_parser = parser.add_parser("auth", help="Authentication helpers")
+    auth_parser.set_defaults(func=auth_parser.print_help, func_args=False)
+    auth_subparsers = auth_parser.add_subparsers()
+
+    auth_serve = auth_subparsers.add_parser(
+        "serve", help="Verify credentials for Dovecot over a unix socket."
+    )
+    auth_serve.add_argument(
+        "--socket", "-s", default=AUTH_SOCKET, help=f"Default: {AUTH_SOCKET}"
+    )
+    auth_serve.add_argument(
+        "--mode", default="660", help="Permissions of the socket file (default: 660)"
+    )
+    auth_serve.add_argument(
+        "--cache-size",
+        type=int,
+        default=10_000,
+        help="Maximum number of verified credentials to remember (default: 10000)",
+    )
+    auth_serve.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=300,
+        help="Seconds to remember a verified credential (default: 300)",
+    )
+    auth_serve.add_argument(
+        "--max-connections",
+        type=int,
+        default=connections.DEFAULT_MAX_CONNECTIONS,
+        help=f"Database connections shared by the server's threads. Default: {connections.DEFAULT_MAX_CONNECTIONS}",
+    )
+    auth_serve.set_defaults(func=handlers.handle_auth_serve, func_args=True)
+
+    auth_checkpassword = auth_subparsers.add_parser(
+        "checkpassword",
+        help="Dovecot checkpassword program backed by a running auth server.",
+    )
+    auth_checkpassword.add_argument(
+        "--socket", "-s", default=AUTH_SOCKET, help=f"Default: {AUTH_SOCKET}"
+    )
+    auth_checkpassword.add_argument(
+        "reply",
+        nargs=argparse.REMAINDER,
+        help="Program to execute on success, supplied by Dovecot.",
+    )
+    auth_checkpassword.set_defaults(
+        func=handlers.handle_auth_checkpassword, func_args=True
+    )
+
+    auth_stats = auth_subparsers.add_parser(
+        "stats", help="Show cache hit rate and verification latency."
+    )
+    auth_stats.add_argument(
+        "--socket", "-s", default=AUTH_SOCKET, help=f"Default: {AUTH_SOCKET}"
+    )
+    auth_stats.set_defaults(func=handlers.handle_auth_stats, func_args=True)
+
+    auth_metrics = auth_subparsers.add_parser(
+        "metrics", help="Print the auth server's Prometheus metrics."
+    )
+    auth_metrics.add_argument(
+        "--socket", "-s", default=AUTH_SOCKET, help=f"Default: {AUTH_SOCKET}"
+    )
+    auth_metrics.set_defaults(func=handlers.handle_auth_metrics, func_args=True)
+
+
+def add_api_parser(parser):
+    api_parser = parser.add_parser("api", help="HTTP API")
+    api_parser.set_defaults(func=api_parser.print_help, func_args=False)
+    api_subparsers = api_parser.add_subparsers()
+
+    api_serve = api_subparsers.add_parser(
+        "serve", help="Serve a JSON API for domains, users, aliases and DKIM keys."
+    )
+    api_serve.add_argument(
+        "--bind",
+        "-b",
+        default=settings.API_BIND,
+        help=f"HOST:PORT to listen on. Default: {settings.API_BIND}",
+    )
+    api_serve.add_argument(
+        "--allow-remote",
+        action="store_true",
+        default=False,
+        help="Listen on an address other machines can reach. The API has no authentication.",
+    )
+    api_serve.add_argument(
+        "--max-connections",
+        type=int,
+        default=connections.DEFAULT_MAX_CONNECTIONS,
+        help=f"Database connections shared by the server's threads. Default: {connections.DEFAULT_MAX_CONNECTIONS}",
+    )
+    api_serve.add_argument(
+        "--quiet",
+        "-q",
+        action="store_true",
+        default=False,
+        help="Don't log requests.",
+    )
+    api_serve.set_defaults(func=handlers.handle_api_serve, func_args=True)
+
+
 def get_parser():
     parser = argparse.ArgumentParser(description="Manage your mail server.")
     parser.add_argument(
@@ -222,6 +740,21 @@ def get_parser():
         default=False,
         help="Work in debug mode. Most destructive actions will be prevented.",
     )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="timings",
+        choices=profiling.MODES,
+        help="Show where the command spends its time. Default: timings",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write SQL query metrics to this file for node_exporter's textfile collector.",
+    )
+    parser.add_argument(
+        "--profile-output",
+        help="Append timings as a JSON line, or save cprofile stats, to this file instead of printing them.",
+    )
     subparsers = parser.add_subparsers()
 
     add_dkim_parser(subparsers)
@@ -234,14 +767,92 @@ def get_parser():
 
     add_config_parser(subparsers)
 
+    add_auth_parser(subparsers)
+
+    add_api_parser(subparsers)
+
+    add_db_parser(subparsers)
+
+    add_mailbox_parser(subparsers)
+
+    add_quota_parser(subparsers)
+
+    add_doctor_parser(subparsers)
+
+    add_stats_parser(subparsers)
+
+    add_changes_parser(subparsers)
+
+    add_sync_parser(subparsers)
+
+    add_export_parser(subparsers)
+
+    add_import_parser(subparsers)
+
+    add_dev_parser(subparsers)
+
     return parser
 
 
+def dispatch(args: argparse.Namespace):
+    if args.func_args:
+        args.func(args)
+    else:
+        args.func()
+
+
+def dispatch_with_timings(args: argparse.Namespace, argv: list):
+    timings = profiling.timings
+    timings.enabled = True
+    console_print = handlers.console.print
+    handlers.console.print = timings.timed("rendering", console_print)
+    try:
+        with timings.phase("command"):
+            dispatch(args)
+    finally:
+        timings.enabled = False
+        handlers.console.print = console_print
+        if args.profile_output:
+            with open(args.profile_output, "a", encoding="utf-8") as fp:
+                timings.write_json_line(fp, argv)
+        else:
+            timings.write_report(sys.stderr)
+
+
+def write_metrics(path: str, seconds: float, success: bool):
+    from . import metrics
+
+    text = metrics.render(
+        extra={
+            "mailiness_command_duration_seconds": (
+                "gauge",
+                "Duration of the last run.",
+                seconds,
+            ),
+            "mailiness_command_success": (
+                "gauge",
+                "1 if the last run succeeded.",
+                int(success),
+            ),
+            "mailiness_command_last_run_timestamp_seconds": (
+                "gauge",
+                "When the last run finished.",
+                time.time(),
+            ),
+        }
+    )
+    metrics.write_textfile(path, text)
+
+
 def main(args: Optional[Sequence] = None):
 
     parser = get_parser()
 
-    args = parser.parse_args(args=args)
+    argv = list(sys.argv[1:] if args is None else args)
+    # A bare --profile would swallow the command name as its value.
+    argv = ["--profile=timings" if arg == "--profile" else arg for arg in argv]
+
+    args = parser.parse_args(args=argv)
 
     g.debug = args.debug
 
@@ -249,10 +860,21 @@ def main(args: Optional[Sequence] = None):
         commands.print_version()
 
     if getattr(args, "func", None):
-        if args.func_args:
-            args.func(args)
-        else:
-            args.func()
+        start = time.perf_counter()
+        success = False
+        try:
+            if args.profile == "cprofile":
+                profiling.run_cprofile(
+                    lambda: dispatch(args), args.profile_output, sys.stderr
+                )
+            elif args.profile == "timings":
+                dispatch_with_timings(args, argv)
+            else:
+                dispatch(args)
+            success = True
+        finally:
+            if args.metrics_file:
+                write_metrics(args.metrics_file, time.perf_counter() - start, success)
     else:
         parser.print_help()
 
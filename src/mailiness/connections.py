@@ -0,0 +1,206 @@
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from mailiness import g
+
+from . import profiling
+
+DEFAULT_MAX_CONNECTIONS = 8
+
+# Seconds SQLite waits on a lock held by Postfix, Dovecot or another thread.
+DEFAULT_BUSY_TIMEOUT = 30.0
+
+# Negative values are in KiB.
+DEFAULT_CACHE_SIZE = -16_000
+
+# Read-only connections serve a single command scanning whole tables.
+READ_ONLY_CACHE_SIZE = -64_000
+
+# Bytes of the database file read-only connections map into memory.
+READ_ONLY_MMAP_SIZE = 256 * 1024 * 1024
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class _Lease:
+    """
+    A thread's hold on a pooled connection.
+
+    It lives in thread local storage so the connection goes back to the pool
+    when the thread ends, even if release() was never called.
+    """
+
+    def __init__(self, provider: "ConnectionProvider", conn: sqlite3.Connection):
+        self.provider = provider
+        self.conn = conn
+
+    def __del__(self):
+        self.provider._return(self.conn)
+
+
+class ConnectionProvider:
+    """
+    Hand every thread its own SQLite connection from a bounded pool.
+
+    Connections are created on demand, up to max_connections, and reused
+    once their thread releases them or ends. Threads asking for a connection
+    when all of them are in use wait up to timeout seconds.
+
+    SQLite allows a single writer at a time, so writes go through writing()
+    which serialises them inside the process instead of letting threads spin
+    on the database lock.
+    """
+
+    def __init__(
+        self,
+        dsn: Optional[str] = None,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        timeout: float = DEFAULT_BUSY_TIMEOUT,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self.dsn = dsn or g.config["db"]["connection_string"]
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.write_lock = threading.RLock()
+        self._local = threading.local()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections move between threads as they're pooled.
+        conn = profiling.connect(
+            self.dsn, timeout=self.timeout, check_same_thread=False
+        )
+        conn.execute(f"PRAGMA cache_size={int(self.cache_size)}")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Return the calling thread's connection, taking one from the pool if needed.
+        """
+        lease = getattr(self._local, "lease", None)
+        if lease is not None:
+            return lease.conn
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhausted(
+                f"All {self.max_connections} database connections are in use."
+            )
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except BaseException:
+                self._slots.release()
+                raise
+        self._local.lease = _Lease(self, conn)
+        return conn
+
+    def release(self):
+        """
+        Give the calling thread's connection back to the pool.
+        """
+        lease = getattr(self._local, "lease", None)
+        if lease is not None:
+            del self._local.lease
+
+    def _return(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def writing(self) -> Iterator[sqlite3.Connection]:
+        """
+        Hold the process wide write lock and yield the thread's connection.
+
+        The transaction is committed when the block ends and rolled back if
+        it raises.
+        """
+        conn = self.connection()
+        with self.write_lock:
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self):
+        """
+        Close idle connections. Connections still leased are closed when returned.
+        """
+        self._closed = True
+        self.release()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def read_only_uri(dsn: str) -> str:
+    """
+    Turn a path or a file: URI into a URI opening the database read-only.
+    """
+    if dsn.startswith("file:"):
+        return dsn + ("&" if "?" in dsn else "?") + "mode=ro"
+    return f"file:{urllib.parse.quote(os.path.abspath(dsn))}?mode=ro"
+
+
+def connect_read_only(
+    dsn: Optional[str] = None, timeout: float = DEFAULT_BUSY_TIMEOUT
+) -> sqlite3.Connection:
+    """
+    Open a connection for commands that only read.
+
+    The file is opened with mode=ro so the connection can't take a write
+    lock, and query_only refuses writes should it have to be opened
+    read-write. That happens with in memory databases, or WAL databases
+    whose -shm file is missing and can't be created. Pages are read
+    through a memory map and the cache is larger than usual.
+    """
+    dsn = dsn or g.config["db"]["connection_string"]
+    conn = None
+    if dsn != ":memory:":
+        try:
+            conn = profiling.connect(read_only_uri(dsn), uri=True, timeout=timeout)
+            # Opening is lazy, read the header to find out whether it worked.
+            conn.execute("PRAGMA schema_version")
+        except sqlite3.OperationalError:
+            conn = None
+    if conn is None:
+        conn = profiling.connect(dsn, timeout=timeout)
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute(f"PRAGMA cache_size={READ_ONLY_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={READ_ONLY_MMAP_SIZE}")
+    return conn
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider() -> ConnectionProvider:
+    """
+    Return the process wide provider for the configured database.
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = ConnectionProvider()
+        return _provider
@@ -1,4 +1,5 @@
 import base64
+import os
 import shutil
 import subprocess
 from datetime import datetime
@@ -10,7 +11,7 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 
 from mailiness import g
 
-from . import settings
+from . import profiling, settings
 
 debug = getattr(g, "debug", False)
 
@@ -19,6 +20,76 @@ def get_default_selector():
     return datetime.now().strftime("%Y%m%d")
 
 
+def parse_dkim_map(data: str) -> dict:
+    result = {}
+    for line in data.splitlines():
+        domain, selector = line.split(" ")
+        result[domain] = selector
+    return result
+
+
+def read_dkim_map(path: Optional[str] = None) -> dict:
+    dkim_map_file = Path(path or g.config["spam"]["dkim_maps_path"])
+
+    with profiling.timings.phase("file i/o"):
+        if dkim_map_file.exists():
+            with dkim_map_file.open("r", encoding="utf-8") as fp:
+                return parse_dkim_map(fp.read())
+    return {}
+
+
+def write_dkim_map(data: dict, path: Optional[str] = None):
+    path = path or g.config["spam"]["dkim_maps_path"]
+
+    new_map = ""
+    for domain, selector in data.items():
+        new_map += f"{domain} {selector}\n"
+
+    with profiling.timings.phase("file i/o"):
+        # A first key has no map to back up yet.
+        if os.path.exists(path):
+            shutil.copy2(path, path + ".bak")
+        with Path(path).open("w", encoding="utf-8") as fp:
+            fp.write(new_map)
+
+
+def list_key_files(directory: Optional[str] = None) -> set:
+    """
+    Return the names of the private key files, named {domain}.{selector}.key
+    """
+    key_directory = directory or g.config["spam"]["dkim_private_key_directory"]
+    try:
+        with os.scandir(key_directory) as entries:
+            return {entry.name for entry in entries if entry.name.endswith(".key")}
+    except FileNotFoundError:
+        return set()
+
+
+def rename_domain(old_name: str, new_name: str) -> bool:
+    """
+    Move a domain's private key and map entry over to its new name.
+
+    Return False if the domain doesn't have a DKIM key.
+    """
+    dkim_map = read_dkim_map()
+    if old_name not in dkim_map:
+        return False
+
+    selector = dkim_map.pop(old_name)
+    dkim_map[new_name] = selector
+
+    key_dir = Path(g.config["spam"]["dkim_private_key_directory"])
+    old_key_file = key_dir / f"{old_name}.{selector}.key"
+    if old_key_file.exists():
+        os.rename(old_key_file, key_dir / f"{new_name}.{selector}.key")
+
+    write_dkim_map(dkim_map)
+
+    if not debug:
+        subprocess.run(["systemctl", "reload", "rspamd"])
+    return True
+
+
 class DKIM:
     def __init__(self, domain: str, selector: Optional[str] = None):
         self.dkim_maps_path = g.config["spam"]["dkim_maps_path"]
@@ -43,10 +114,11 @@ class DKIM:
         self.domain = domain
 
     def generate_key(self):
-        self.private_key = rsa.generate_private_key(
-            public_exponent=settings.RSA_PUBLIC_EXPONENT,
-            key_size=settings.DKIM_KEY_SIZE,
-        )
+        with profiling.timings.phase("rsa"):
+            self.private_key = rsa.generate_private_key(
+                public_exponent=settings.RSA_PUBLIC_EXPONENT,
+                key_size=settings.DKIM_KEY_SIZE,
+            )
 
     def private_key_as_pem(self) -> str:
         as_bytes = self.private_key.private_bytes(
@@ -63,21 +135,10 @@ class DKIM:
         )
 
     def load_dkim_map(self, data: str) -> dict:
-        result = {}
-        for line in data.splitlines():
-            domain, selector = line.split(" ")
-            result[domain] = selector
-        return result
+        return parse_dkim_map(data)
 
     def write_dkim_map(self, data: dict):
-        shutil.copy2(self.dkim_maps_path, self.dkim_maps_path + ".bak")
-
-        new_map = ""
-        for domain, selector in data.items():
-            new_map += f"{domain} {selector}\n"
-
-        with Path(self.dkim_maps_path).open("w", encoding="utf-8") as fp:
-            fp.write(new_map)
+        write_dkim_map(data, self.dkim_maps_path)
 
     def dns_txt_record(self) -> str:
         b64_der_pubkey = base64.b64encode(self.public_key_as_der())
@@ -102,19 +163,16 @@ class DKIM:
             self._run_system_hooks()
 
     def load_from_dkim_map_file(self) -> dict:
-        dkim_map_file = Path(self.dkim_maps_path)
-
-        if dkim_map_file.exists():
-            with dkim_map_file.open("r", encoding="utf-8") as fp:
-                return self.load_dkim_map(fp.read())
-        return {}
+        return read_dkim_map(self.dkim_maps_path)
 
     def save_private_key(self):
         dest = Path(self.dkim_private_key_dir) / Path(
             f"{self.domain}.{self.selector}.key"
         )
 
-        with dest.open("w", encoding="utf-8") as fp:
+        with profiling.timings.phase("file i/o"), dest.open(
+            "w", encoding="utf-8"
+        ) as fp:
             fp.write(self.private_key_as_pem())
 
         dkim_map = self.load_from_dkim_map_file()
@@ -0,0 +1,170 @@
+import os
+import subprocess
+from pathlib import Path
+
+from mailiness import g
+
+from . import dkim, mailbox, migrations, repo
+
+CHECKS = {
+    "users_without_mailbox": "Users without a mailbox directory",
+    "mailboxes_without_user": "Mailbox directories without a user",
+    "domain_directories_without_domain": "Domain directories without a domain",
+    "orphan_users": "Users whose domain doesn't exist",
+    "orphan_aliases": "Aliases whose domain doesn't exist",
+    "case_duplicates": "Domains and addresses only differing in case",
+    "dkim_map_missing_key": "DKIM map entries without a key file",
+    "dkim_map_unknown_domain": "DKIM map entries for unknown domains",
+    "dkim_keys_unknown_domain": "DKIM key files for unknown domains",
+    "dkim_keys_not_in_map": "DKIM key files missing from the map",
+}
+
+
+def _list_directories(path: str) -> list:
+    try:
+        with os.scandir(path) as entries:
+            return [
+                entry.name
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False)
+                and not entry.name.startswith(".")
+            ]
+    except FileNotFoundError:
+        return []
+
+
+class Doctor:
+    """
+    Compare the database, the vmail tree, the DKIM map and the DKIM key files.
+
+    Each source is loaded once into sets, one query per table and one
+    directory listing per level, and problems are found with set operations.
+    """
+
+    def __init__(self, conn=None):
+        self.db_conn = conn if conn is not None else repo.get_db_conn()
+        self.cursor = self.db_conn.cursor()
+
+    def _load(self):
+        domains_table = g.config["db"]["domains_table_name"]
+        self.domains = dict(
+            self.cursor.execute(f"SELECT rowid, name FROM {domains_table}")
+        )
+        self.domain_names = set(self.domains.values())
+        self.users = {}
+        for domain_id, email in self.cursor.execute(
+            f"SELECT domain_id, email FROM {g.config['db']['users_table_name']}"
+        ):
+            self.users[email] = domain_id
+        self.alias_domains = {}
+        for domain_id, from_address in self.cursor.execute(
+            f"SELECT domain_id, from_address FROM {g.config['db']['aliases_table_name']}"
+        ):
+            self.alias_domains[from_address] = domain_id
+
+        vmail_directory = g.config["mail"]["vmail_directory"]
+        self.domain_directories = set(_list_directories(vmail_directory))
+        self.mailboxes = {
+            f"{user}@{domain}"
+            for domain in self.domain_directories
+            for user in _list_directories(os.path.join(vmail_directory, domain))
+        }
+
+        self.dkim_map = dkim.read_dkim_map()
+        self.key_files = dkim.list_key_files()
+
+    def diagnose(self) -> dict:
+        """
+        Return the problems found for every check, as sorted lists.
+        """
+        self._load()
+        domain_ids = self.domains.keys()
+        mapped_key_files = {
+            f"{domain}.{selector}.key" for domain, selector in self.dkim_map.items()
+        }
+        # Key files are named {domain}.{selector}.key
+        key_file_domains = {
+            key_file: key_file.rsplit(".", 2)[0] for key_file in self.key_files
+        }
+        problems = {
+            "users_without_mailbox": self.users.keys() - self.mailboxes,
+            "mailboxes_without_user": self.mailboxes - self.users.keys(),
+            "domain_directories_without_domain": self.domain_directories
+            - self.domain_names,
+            "orphan_users": {
+                email
+                for email, domain_id in self.users.items()
+                if domain_id not in domain_ids
+            },
+            "orphan_aliases": {
+                from_address
+                for from_address, domain_id in self.alias_domains.items()
+                if domain_id not in domain_ids
+            },
+            "case_duplicates": {
+                " = ".join(group)
+                for groups in migrations.find_case_duplicates(self.cursor).values()
+                for group in groups
+            },
+            "dkim_map_missing_key": {
+                f"{domain} {selector}"
+                for domain, selector in self.dkim_map.items()
+                if f"{domain}.{selector}.key" not in self.key_files
+            },
+            "dkim_map_unknown_domain": self.dkim_map.keys() - self.domain_names,
+            "dkim_keys_unknown_domain": {
+                key_file
+                for key_file, domain in key_file_domains.items()
+                if domain not in self.domain_names
+            },
+            "dkim_keys_not_in_map": self.key_files - mapped_key_files,
+        }
+        return {check: sorted(items) for check, items in problems.items()}
+
+    def fix(self, problems: dict) -> dict:
+        """
+        Repair what can be repaired safely and return how many items were fixed per check.
+
+        Orphan users and aliases are deleted, mailbox directories without a
+        user are moved to the trash and DKIM map entries without a key file
+        are removed from the map. Everything else is left for a human.
+        """
+        fixed = {}
+        domains_table = g.config["db"]["domains_table_name"]
+        aliases_table = g.config["db"]["aliases_table_name"]
+        if problems["orphan_aliases"]:
+            self.cursor.execute(
+                f"DELETE FROM {repo.alias_targets_table_name()} WHERE alias_id IN "
+                f"(SELECT rowid FROM {aliases_table} WHERE domain_id NOT IN (SELECT rowid FROM {domains_table}))"
+            )
+            result = self.cursor.execute(
+                f"DELETE FROM {aliases_table} WHERE domain_id NOT IN (SELECT rowid FROM {domains_table})"
+            )
+            fixed["orphan_aliases"] = result.rowcount
+        if problems["orphan_users"]:
+            result = self.cursor.execute(
+                f"DELETE FROM {g.config['db']['users_table_name']} WHERE domain_id NOT IN (SELECT rowid FROM {domains_table})"
+            )
+            fixed["orphan_users"] = result.rowcount
+        self.db_conn.commit()
+
+        vmail_directory = Path(g.config["mail"]["vmail_directory"])
+        for email in problems["mailboxes_without_user"]:
+            user, domain = email.split("@")
+            mailbox.move_to_trash(vmail_directory / domain / user)
+        fixed["mailboxes_without_user"] = len(problems["mailboxes_without_user"])
+
+        if problems["dkim_map_missing_key"]:
+            stale = {entry.split(" ")[0] for entry in problems["dkim_map_missing_key"]}
+            dkim.write_dkim_map(
+                {
+                    domain: selector
+                    for domain, selector in self.dkim_map.items()
+                    if domain not in stale
+                }
+            )
+            fixed["dkim_map_missing_key"] = len(stale)
+            if not dkim.debug:
+                subprocess.run(["systemctl", "reload", "rspamd"])
+
+        return fixed
@@ -0,0 +1,184 @@
+import random
+from itertools import islice
+from pathlib import Path
+from typing import Iterator
+
+from mailiness import g
+
+from . import dkim, mailbox, migrations, repo
+
+# Every generated user logs in with this password. The hash uses bcrypt's
+# lowest cost and a fixed salt so generating a million users costs nothing.
+# Never use it outside of test installations.
+TEST_PASSWORD = "password"
+TEST_PASSWORD_HASH = "$2b$04$mailinessTESTONLYsaltu/i6fPpd08OwX2odtMNV179EV23N/606"
+
+TEST_TLD = "test"
+
+# Generated messages are all delivered at this time so paths are deterministic.
+MESSAGE_TIMESTAMP = 1_600_000_000
+
+INSERT_BATCH_SIZE = 50_000
+
+
+def get_test_password_hash() -> str:
+    if g.config.getboolean("users", "insert_password_hash_prefix"):
+        return g.config["users"]["password_hash_prefix"] + TEST_PASSWORD_HASH
+    return TEST_PASSWORD_HASH
+
+
+def domain_name(i: int) -> str:
+    return f"domain{i}.{TEST_TLD}"
+
+
+def user_email(domain: int, user: int) -> str:
+    return f"user{user}@{domain_name(domain)}"
+
+
+def _batches(rows: Iterator[tuple], size: int = INSERT_BATCH_SIZE) -> Iterator[list]:
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Generator:
+    """
+    Fill an empty database with synthetic domains, users and aliases.
+
+    Everything is derived from seed so two runs with the same arguments
+    produce the same data.
+    """
+
+    def __init__(
+        self,
+        domains: int,
+        users_per_domain: int,
+        aliases: int = 0,
+        seed: int = 0,
+        conn=None,
+    ):
+        self.db_conn = conn if conn is not None else repo.get_db_conn()
+        self.cursor = self.db_conn.cursor()
+        self.domains = domains
+        self.users_per_domain = users_per_domain
+        self.aliases = aliases
+        self.seed = seed
+
+    def _random(self, purpose: str) -> random.Random:
+        # Separate streams keep users identical whether or not aliases are generated.
+        return random.Random(f"{self.seed}-{purpose}")
+
+    def _users(self) -> Iterator[tuple]:
+        rng = self._random("users")
+        password_hash = get_test_password_hash()
+        for domain in range(self.domains):
+            for user in range(self.users_per_domain):
+                quota = rng.choice((1, 2, 5, 10)) * 1_000_000_000
+                yield domain + 1, user_email(domain, user), password_hash, quota
+
+    def _aliases(self) -> Iterator[tuple]:
+        rng = self._random("aliases")
+        for i in range(self.aliases):
+            domain = i % self.domains
+            targets = [
+                user_email(
+                    rng.randrange(self.domains), rng.randrange(self.users_per_domain)
+                )
+                for _ in range(2 if rng.random() < 0.1 else 1)
+            ]
+            yield domain + 1, f"alias{i}@{domain_name(domain)}", ",".join(targets)
+
+    def run(self) -> dict:
+        """
+        Insert everything in a single transaction and return how many rows of each kind were created.
+        """
+        domains_table = g.config["db"]["domains_table_name"]
+        users_table = g.config["db"]["users_table_name"]
+        aliases_table = g.config["db"]["aliases_table_name"]
+        targets_table = repo.alias_targets_table_name()
+        if self.cursor.execute(f"SELECT 1 FROM {domains_table} LIMIT 1").fetchone():
+            raise ValueError(
+                "Refusing to generate data in a database that has domains."
+            )
+        if not self.users_per_domain and self.aliases:
+            raise ValueError("Aliases need users to point to.")
+
+        # The search triggers are dropped inside this transaction.
+        self.cursor.execute("BEGIN")
+        try:
+            with migrations.search_indexes_suspended(self.cursor):
+                self.cursor.executemany(
+                    f"INSERT INTO {domains_table}(rowid, name) VALUES (?,?)",
+                    ((i + 1, domain_name(i)) for i in range(self.domains)),
+                )
+                for batch in _batches(self._users()):
+                    self.cursor.executemany(
+                        f"INSERT INTO {users_table} VALUES (?,?,?,?)", batch
+                    )
+                for batch in _batches(self._aliases()):
+                    self.cursor.executemany(
+                        f"INSERT INTO {aliases_table} VALUES (?,?,?)", batch
+                    )
+                    self.cursor.executemany(
+                        f"INSERT INTO {targets_table} SELECT rowid, ? FROM {aliases_table} WHERE from_address=?",
+                        [
+                            (target, from_address)
+                            for _, from_address, to_address in batch
+                            if "," in to_address
+                            for target in repo.split_alias_targets(to_address)
+                        ],
+                    )
+        except Exception:
+            self.db_conn.rollback()
+            raise
+        self.db_conn.commit()
+        return {
+            "domains": self.domains,
+            "users": self.domains * self.users_per_domain,
+            "aliases": self.aliases,
+        }
+
+    def create_maildirs(self, messages: int = 3, message_size: int = 4096) -> int:
+        """
+        Create a Maildir for every user holding messages dummy messages of
+        up to message_size bytes. Return the number of messages written.
+        """
+        rng = self._random("maildirs")
+        vmail_directory = Path(g.config["mail"]["vmail_directory"])
+        written = 0
+        for domain in range(self.domains):
+            for user in range(self.users_per_domain):
+                path = vmail_directory / domain_name(domain) / f"user{user}"
+                for subdirectory in mailbox.MAILDIR_SUBDIRECTORIES:
+                    (path / subdirectory).mkdir(parents=True, exist_ok=True)
+                for n in range(messages):
+                    size = rng.randint(message_size // 4, message_size)
+                    body = (
+                        f"From: generator@{domain_name(domain)}\r\n"
+                        f"To: user{user}@{domain_name(domain)}\r\n"
+                        f"Subject: Generated message {n}\r\n\r\n"
+                    ).encode("utf-8")
+                    body += b"x" * max(size - len(body), 0)
+                    name = f"{MESSAGE_TIMESTAMP + n}.M{n}P0.mailiness,S={len(body)}:2,S"
+                    (path / "cur" / name).write_bytes(body)
+                    written += 1
+        return written
+
+    def create_dkim_keys(self, selector: str = "generated") -> int:
+        """
+        Save a DKIM key for every domain and add them to the DKIM map.
+
+        RSA key generation can't be seeded and takes a while, so a single
+        key is generated and shared by every domain.
+        """
+        key = dkim.DKIM(domain=domain_name(0), selector=selector)
+        pem = key.private_key_as_pem()
+        key_directory = Path(g.config["spam"]["dkim_private_key_directory"])
+        dkim_map = dkim.read_dkim_map()
+        for domain in range(self.domains):
+            (key_directory / f"{domain_name(domain)}.{selector}.key").write_text(pem)
+            dkim_map[domain_name(domain)] = selector
+        dkim.write_dkim_map(dkim_map)
+        return self.domains
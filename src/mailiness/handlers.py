@@ -1,21 +1,41 @@
 import io
+import json
+import os
 import secrets
-import shutil
+import sys
 from argparse import Namespace
 from getpass import getpass
 from pathlib import Path
 
 from rich.console import Console
+from rich.table import Table
 
 from mailiness import g
 
-from . import dkim, repo
+# Other modules are imported by the handlers using them, so a command only
+# pays for importing what it runs.
+from . import connections, dkim, repo
 
 console = Console()
 
 
+def _require_schema(version: int, conn=None):
+    """
+    Exit with a hint to migrate when the database predates version.
+    """
+    from . import migrations
+
+    if conn is None:
+        conn = repo.get_db_conn(read_only=True)
+    try:
+        migrations.require_version(conn, version)
+    except migrations.SchemaOutdated as e:
+        console.print(str(e))
+        sys.exit(1)
+
+
 def handle_dkim_keygen(args: Namespace):
-    key = dkim.DKIM(domain=args.domain, selector=args.selector)
+    key = dkim.DKIM(domain=repo.normalize_address(args.domain), selector=args.selector)
 
     print(key.private_key_as_pem())
 
@@ -27,32 +47,60 @@ def handle_dkim_keygen(args: Namespace):
 
 
 def handle_dkim_show(args: Namespace):
-    key = dkim.DKIM(domain=args.domain)
+    key = dkim.DKIM(domain=repo.normalize_address(args.domain))
     print(key.private_key_as_pem())
     print(key.dns_txt_record())
 
 
 def handle_domain_add(args: Namespace):
+    name = repo.normalize_address(args.name)
     domain_repo = repo.DomainRepository()
-    tbl = domain_repo.create(args.name)
-    console.print(f"{args.name} added to database")
+    tbl = domain_repo.create(name)
+    console.print(f"{name} added to database")
     console.print(tbl)
 
     if args.dkim:
-        key = dkim.DKIM(domain=args.name, selector=args.selector)
+        key = dkim.DKIM(domain=name, selector=args.selector)
         key.save_private_key()
         print(key.dns_txt_record())
 
 
 def handle_domain_edit_name(args: Namespace):
+    from . import migrations
+
     domain_repo = repo.DomainRepository()
-    tbl = domain_repo.edit("name", args.old_name, args.new_name)
-    console.print(f"{args.old_name} changed to {args.new_name}")
+    _require_schema(migrations.ALIAS_TARGETS_VERSION, domain_repo.db_conn)
+    old_name = domain_repo.get_name(args.old_name)
+    if old_name is None:
+        console.print(f"Domain {args.old_name} doesn't exist.")
+        sys.exit(1)
+    new_name = repo.normalize_address(args.new_name)
+    vmail_directory = Path(g.config["mail"]["vmail_directory"])
+    if (vmail_directory / new_name).exists():
+        console.print(f"{vmail_directory / new_name} already exists, nothing renamed.")
+        sys.exit(1)
+
+    tbl = domain_repo.edit("name", old_name, new_name)
+    console.print(f"{old_name} changed to {new_name}")
     console.print(tbl)
 
+    if (vmail_directory / old_name).exists():
+        os.rename(vmail_directory / old_name, vmail_directory / new_name)
+        console.print("Mailboxes moved.")
+
+    if dkim.rename_domain(old_name, new_name):
+        console.print(
+            f"DKIM key moved. Publish its TXT record for {new_name} (see dkim show)."
+        )
+
 
 def handle_domain_delete(args: Namespace):
+    from . import mailbox, migrations
+
     domain_repo = repo.DomainRepository()
+    _require_schema(migrations.ALIAS_TARGETS_VERSION, domain_repo.db_conn)
+    # The key and mailboxes are named after the domain as stored.
+    name = domain_repo.get_name(args.name) or repo.normalize_address(args.name)
     if args.yes:
         answer = "y"
     else:
@@ -62,8 +110,16 @@ def handle_domain_delete(args: Namespace):
         answer = input(f"Are you sure you want to delete {args.name}? (y/n)")
 
     if answer == "y":
-        domain_repo.delete(args.name)
-        console.print(f"{args.name} deleted.")
+
+        def _report_progress(table, deleted):
+            console.print(f"{deleted} rows deleted from {table}.")
+
+        domain_repo.delete(
+            name,
+            batch_size=args.batch_size,
+            progress=_report_progress if args.batch_size else None,
+        )
+        console.print(f"{name} deleted.")
 
         def _delete_dkim_key(domain):
             key = dkim.DKIM(domain=domain)
@@ -72,23 +128,25 @@ def handle_domain_delete(args: Namespace):
 
         def _delete_mailbox_directory(domain):
             vmail_directory = Path(g.config["mail"]["vmail_directory"])
-            shutil.rmtree(vmail_directory / domain)
-            print("Mailboxes deleted.")
+            mailbox.move_to_trash(vmail_directory / domain)
+            print(
+                "Mailboxes moved to trash. Run 'mailiness mailbox purge' to free the space."
+            )
 
         if args.all:
-            _delete_dkim_key(args.name)
-            _delete_mailbox_directory(args.name)
+            _delete_dkim_key(name)
+            _delete_mailbox_directory(name)
         else:
             if args.dkim:
-                _delete_dkim_key(args.name)
+                _delete_dkim_key(name)
             elif args.mailbox:
-                _delete_mailbox_directory(args.name)
+                _delete_mailbox_directory(name)
     else:
         console.print(f"{args.name} not deleted.")
 
 
 def handle_domain_list(args: Namespace):
-    domain_repo = repo.DomainRepository()
+    domain_repo = repo.DomainRepository(read_only=True)
     tbl = domain_repo.index()
     console.print(tbl)
 
@@ -122,20 +180,29 @@ def handle_user_edit(args: Namespace):
 
 
 def handle_user_list(args: Namespace):
-    user_repo = repo.UserRepository()
+    user_repo = repo.UserRepository(read_only=True)
     tbl = user_repo.index(domain=args.domain)
     console.print(tbl)
 
 
+def handle_user_search(args: Namespace):
+    user_repo = repo.UserRepository(read_only=True)
+    tbl = user_repo.search(args.pattern, limit=args.limit or None)
+    console.print(tbl)
+
+
 def handle_user_delete(args: Namespace):
+    from . import mailbox
+
+    email = repo.normalize_address(args.email)
     user_repo = repo.UserRepository()
-    user_repo.delete(email=args.email)
+    user_repo.delete(email=email)
 
-    console.print(f"User {args.email} was deleted.")
+    console.print(f"User {email} was deleted.")
 
     if args.mail:
 
-        user, domain = args.email.split("@")
+        user, domain = email.split("@")
 
         vmail_directory = Path(g.config["mail"]["vmail_directory"])
 
@@ -143,37 +210,476 @@ def handle_user_delete(args: Namespace):
 
         user_vmail_directory = vmail_domain_directory / user
 
-        shutil.rmtree(user_vmail_directory)
+        mailbox.move_to_trash(user_vmail_directory)
 
-        console.print("User's mailbox deleted.")
+        console.print(
+            "User's mailbox moved to trash. Run 'mailiness mailbox purge' to free the space."
+        )
 
 
 def handle_alias_add(args: Namespace):
+    from . import migrations
+
     alias_repo = repo.AliasRepository()
+    _require_schema(migrations.ALIAS_TARGETS_VERSION, alias_repo.db_conn)
     tbl = alias_repo.create(args.from_address, args.to_address)
     console.print(tbl)
 
 
 def handle_alias_list(args: Namespace):
-    alias_repo = repo.AliasRepository()
-    tbl = alias_repo.index(args.domain)
+    from . import migrations
+
+    alias_repo = repo.AliasRepository(read_only=True)
+    if args.to:
+        _require_schema(migrations.ALIAS_TARGETS_VERSION, alias_repo.db_conn)
+    tbl = alias_repo.index(args.domain, to_address=args.to)
     console.print(tbl)
 
 
 def handle_alias_edit(args: Namespace):
+    from . import migrations
+
     alias_repo = repo.AliasRepository()
+    _require_schema(migrations.ALIAS_TARGETS_VERSION, alias_repo.db_conn)
     tbl = alias_repo.edit(args.from_address, args.new_from, args.to)
     console.print(tbl)
 
 
 def handle_alias_delete(args: Namespace):
+    from . import migrations
+
     alias_repo = repo.AliasRepository()
+    _require_schema(migrations.ALIAS_TARGETS_VERSION, alias_repo.db_conn)
     alias_repo.delete(args.from_address)
 
 
+def handle_alias_search(args: Namespace):
+    alias_repo = repo.AliasRepository(read_only=True)
+    tbl = alias_repo.search(args.pattern, to=args.to, limit=args.limit or None)
+    console.print(tbl)
+
+
+def handle_alias_resolve(args: Namespace):
+    alias_repo = repo.AliasRepository(read_only=True)
+    tbl = alias_repo.resolve(args.address)
+    console.print(tbl)
+
+
+def handle_alias_check(args: Namespace):
+    alias_repo = repo.AliasRepository(read_only=True)
+    if args.all:
+        data = alias_repo.check(pretty=False)
+        rows = data["rows"]
+    elif args.addresses:
+        rows = []
+        for address in args.addresses:
+            data = alias_repo.resolve(address, pretty=False)
+            for target, status, via in data["rows"]:
+                if status in ("cycle", "dangling", "too deep"):
+                    rows.append((address, status, target))
+    else:
+        console.print("Provide addresses to check or use --all.")
+        sys.exit(2)
+
+    if not rows:
+        console.print("No problems found.")
+        return
+
+    tbl = Table(title="Alias problems")
+    for header in ("From", "Problem", "Detail"):
+        tbl.add_column(header)
+    for row in rows:
+        tbl.add_row(*row)
+    console.print(tbl)
+    sys.exit(1)
+
+
+def handle_db_migrate(args: Namespace):
+    from . import migrations
+
+    conn = repo.get_db_conn(read_only=args.dry_run)
+    if args.dry_run:
+        console.print(
+            f"Schema version {migrations.get_version(conn)}, "
+            f"latest is {len(migrations.get_migrations())}."
+        )
+        steps = migrations.plan(conn)
+        if not steps:
+            console.print("Nothing to migrate.")
+            return
+        tbl = Table(title="Migration plan")
+        for header in ("Version", "Migration", "Step", "Estimated rows"):
+            tbl.add_column(header)
+        for version, migration, step, rows in steps:
+            tbl.add_row(str(version or ""), migration, step, str(rows))
+        console.print(tbl)
+        return
+
+    duplicates = migrations.migrate(
+        conn, batch_size=args.batch_size, progress=console.print
+    )
+    console.print("Database schema is up to date.")
+    for table, groups in duplicates.items():
+        for group in groups:
+            console.print(f"{table} differing only in case: {', '.join(group)}")
+    if any(duplicates.values()):
+        console.print(
+            "Lookups ignore case, rename or delete the duplicates and migrate again."
+        )
+
+
+def handle_doctor(args: Namespace):
+    from . import doctor, migrations
+
+    if args.fix:
+        _require_schema(migrations.ALIAS_TARGETS_VERSION)
+    checker = doctor.Doctor()
+    problems = checker.diagnose()
+
+    tbl = Table(title="Consistency checks")
+    for header in ("Check", "Count", "Examples"):
+        tbl.add_column(header)
+    for check, items in problems.items():
+        tbl.add_row(doctor.CHECKS[check], str(len(items)), ", ".join(items[:5]))
+    console.print(tbl)
+
+    if args.fix:
+        fixed = checker.fix(problems)
+        for check, count in fixed.items():
+            if count:
+                console.print(f"Fixed {count}: {doctor.CHECKS[check]}")
+    elif any(problems.values()):
+        sys.exit(1)
+
+
+def handle_stats(args: Namespace):
+    from . import stats
+
+    try:
+        rows = stats.domain_stats(domain=args.domain)
+    except ValueError as e:
+        console.print(str(e))
+        sys.exit(2)
+
+    tbl = Table(title="Domains")
+    for header in stats.HEADERS:
+        tbl.add_column(header)
+    for name, users, aliases, quota, dkim_status in rows:
+        tbl.add_row(
+            name, str(users), str(aliases), str(quota / 1_000_000_000), dkim_status
+        )
+    if len(rows) > 1:
+        tbl.add_section()
+        tbl.add_row(
+            "Total",
+            str(sum(row[1] for row in rows)),
+            str(sum(row[2] for row in rows)),
+            str(sum(row[3] for row in rows) / 1_000_000_000),
+            "",
+        )
+    console.print(tbl)
+
+
+def _sync(args: Namespace, apply: bool):
+    from . import migrations, sync
+
+    synchronizer = sync.Synchronizer(
+        delete=not args.keep_unmanaged, check_passwords=args.check_passwords
+    )
+    if apply:
+        _require_schema(migrations.ALIAS_TARGETS_VERSION)
+    try:
+        inventory = sync.load_inventory(args.file)
+        plan = synchronizer.apply(inventory) if apply else synchronizer.plan(inventory)
+    except ValueError as e:
+        console.print(str(e))
+        sys.exit(2)
+    print(json.dumps(plan, indent=2))
+
+
+def handle_changes_since(args: Namespace):
+    from . import journal, migrations
+
+    conn = repo.get_db_conn(read_only=True)
+    try:
+        # Errors go to stderr, stdout only carries changes.
+        migrations.require_version(conn, migrations.JOURNAL_VERSION)
+        for row in journal.since(conn, args.seq):
+            sys.stdout.write(json.dumps(dict(zip(journal.HEADERS, row))) + "\n")
+    except (ValueError, migrations.SchemaOutdated) as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+
+def handle_changes_head(args: Namespace):
+    from . import journal, migrations
+
+    conn = repo.get_db_conn(read_only=True)
+    _require_schema(migrations.JOURNAL_VERSION, conn)
+    print(journal.head(conn))
+
+
+def handle_changes_compact(args: Namespace):
+    from . import journal, migrations
+
+    if args.before is None and args.older_than is None:
+        console.print("Give --before, --older-than or both.")
+        sys.exit(2)
+    older_than = None if args.older_than is None else args.older_than * 86400
+    conn = repo.get_db_conn()
+    _require_schema(migrations.JOURNAL_VERSION, conn)
+    deleted = journal.compact(conn, before=args.before, older_than=older_than)
+    console.print(f"Deleted {deleted} changes.")
+
+
+def handle_sync_plan(args: Namespace):
+    _sync(args, apply=False)
+
+
+def handle_sync_apply(args: Namespace):
+    _sync(args, apply=True)
+
+
+def handle_export_all(args: Namespace):
+    from . import transfer
+
+    compression = args.compress or transfer.compression_from_path(args.output)
+    fp = transfer.open_output(args.output, compression)
+    try:
+        count = transfer.export_all(repo.get_db_conn(read_only=True), fp)
+    finally:
+        fp.close()
+    if args.output != "-":
+        console.print(f"Exported {count} records to {args.output}.")
+
+
+def handle_import_all(args: Namespace):
+    from . import migrations, transfer
+
+    _require_schema(migrations.ALIAS_TARGETS_VERSION)
+    fp = transfer.open_input(args.file)
+    try:
+        counts = transfer.import_all(repo.get_db_conn(), fp, batch_size=args.batch_size)
+    finally:
+        fp.close()
+    console.print(
+        f"Imported {counts['domain']} domains, {counts['user']} users and "
+        f"{counts['alias']} aliases."
+    )
+
+
+def handle_db_backup(args: Namespace):
+    from . import backup
+
+    dest = backup.get_backup_path(args.dest)
+    pages, seconds = backup.backup(
+        repo.get_db_conn(), dest, pages=args.pages, sleep=args.sleep
+    )
+    rate = pages / seconds if seconds else pages
+    console.print(
+        f"Copied {pages} pages to {dest} in {seconds:.2f}s ({rate:.0f} pages/s)."
+    )
+
+    if args.verify:
+        problems = backup.verify(dest)
+        if problems:
+            for problem in problems:
+                console.print(problem)
+            sys.exit(1)
+        console.print("Integrity check passed.")
+
+    if args.keep is not None and Path(args.dest).is_dir():
+        for path in backup.rotate(Path(args.dest), args.keep):
+            console.print(f"Deleted old backup {path}.")
+
+
+def handle_dev_generate(args: Namespace):
+    from . import generate, migrations
+
+    _require_schema(migrations.ALIAS_TARGETS_VERSION)
+    generator = generate.Generator(
+        domains=args.domains,
+        users_per_domain=args.users_per_domain,
+        aliases=args.aliases,
+        seed=args.seed,
+    )
+    try:
+        counts = generator.run()
+    except ValueError as e:
+        console.print(str(e))
+        sys.exit(2)
+    console.print(
+        f"Generated {counts['domains']} domains, {counts['users']} users and "
+        f"{counts['aliases']} aliases. Every user's password is "
+        f"'{generate.TEST_PASSWORD}'."
+    )
+    if args.maildirs:
+        messages = generator.create_maildirs(args.messages, args.message_size)
+        console.print(f"Wrote {messages} messages.")
+    if args.dkim:
+        keys = generator.create_dkim_keys()
+        console.print(f"Saved {keys} DKIM keys.")
+
+
+def handle_mailbox_purge(args: Namespace):
+    from . import mailbox
+
+    files, directories = mailbox.purge_trash(workers=args.workers, rate=args.rate)
+    console.print(f"Purged {files} files and {directories} directories from the trash.")
+
+
+def handle_quota_report(args: Namespace):
+    from . import mailbox
+
+    user_repo = repo.UserRepository(read_only=True)
+    users = user_repo.quotas(domain=args.domain)
+    index = None if args.no_index else mailbox.UsageIndex()
+    rows = mailbox.top_usage(users, top=args.top, workers=args.workers, index=index)
+
+    tbl = Table(title="Quota usage")
+    for header in ("Email", "Used (GB)", "Quota (GB)", "Used (%)"):
+        tbl.add_column(header)
+    for email, used, quota in rows:
+        percent = f"{100 * used / quota:.1f}" if quota else "-"
+        tbl.add_row(
+            email,
+            f"{used / 1_000_000_000:.2f}",
+            f"{quota / 1_000_000_000:.2f}",
+            percent,
+        )
+    console.print(tbl)
+    if index is not None:
+        console.print(
+            f"{index.scanned} directories scanned, {index.skipped} unchanged directories skipped."
+        )
+        index.close()
+
+
+def _update_usage_index(rebuild: bool, workers: int):
+    from . import mailbox
+
+    user_repo = repo.UserRepository(read_only=True)
+    paths = [mailbox.get_mailbox_path(email) for email, _ in user_repo.quotas()]
+    index = mailbox.UsageIndex()
+    if rebuild:
+        index.rebuild(paths, workers=workers)
+    else:
+        index.update(paths, workers=workers)
+    console.print(
+        f"{len(paths)} mailboxes indexed. {index.scanned} directories scanned, "
+        f"{index.skipped} unchanged directories skipped."
+    )
+    index.close()
+
+
+def handle_mailbox_index_rebuild(args: Namespace):
+    _update_usage_index(rebuild=True, workers=args.workers)
+
+
+def handle_mailbox_index_update(args: Namespace):
+    _update_usage_index(rebuild=False, workers=args.workers)
+
+
+def handle_mailbox_index_stats(args: Namespace):
+    from . import mailbox
+
+    index = mailbox.UsageIndex()
+    tbl = Table(title="Mailbox usage index")
+    tbl.add_column("Metric")
+    tbl.add_column("Value")
+    for key, value in index.stats().items():
+        tbl.add_row(key, str(value))
+    index.close()
+    console.print(tbl)
+
+
 def handle_config_show(args: Namespace):
     dest = io.StringIO()
     g.config.write(dest)
     dest.seek(0)
     print(dest.read())
     dest.close()
+
+
+def handle_auth_serve(args: Namespace):
+    from . import auth, cache
+
+    credential_cache = cache.credentials
+    credential_cache.max_size = args.cache_size
+    credential_cache.ttl = args.cache_ttl
+    provider = connections.ConnectionProvider(max_connections=args.max_connections)
+    authenticator = auth.Authenticator(credential_cache, provider=provider)
+    server = auth.AuthServer(args.socket, authenticator)
+    os.chmod(args.socket, int(args.mode, 8))
+    console.print(f"Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+def handle_auth_checkpassword(args: Namespace):
+    from . import auth
+
+    try:
+        email, password = auth.read_checkpassword_input()
+        if "\n" in password:
+            sys.exit(auth.CHECKPASSWORD_FAIL)
+        reply = auth.request(args.socket, f"AUTH\t{email}\t{password}")
+    except (OSError, ValueError):
+        sys.exit(auth.CHECKPASSWORD_TEMPFAIL)
+
+    if reply != "OK":
+        sys.exit(auth.CHECKPASSWORD_FAIL)
+
+    if args.reply:
+        os.execvp(args.reply[0], args.reply)
+
+
+def handle_auth_stats(args: Namespace):
+    from . import auth
+
+    reply = auth.request(args.socket, "STATS")
+    _, _, stats = reply.partition("\t")
+    tbl = Table(title="Auth server")
+    tbl.add_column("Metric")
+    tbl.add_column("Value")
+    for key, value in json.loads(stats).items():
+        tbl.add_row(key, str(value))
+    console.print(tbl)
+
+
+def handle_auth_metrics(args: Namespace):
+    from . import auth
+
+    print(auth.request_metrics(args.socket), end="")
+
+
+def handle_api_serve(args: Namespace):
+    from . import api, migrations
+
+    try:
+        address = api.parse_bind(args.bind)
+    except ValueError as e:
+        console.print(str(e))
+        sys.exit(2)
+    if not args.allow_remote and not api.is_loopback(address[0]):
+        console.print(
+            f"The API has no authentication, {address[0]} isn't a loopback "
+            f"address. Pass --allow-remote to listen on it anyway."
+        )
+        sys.exit(2)
+    _require_schema(migrations.ALIAS_TARGETS_VERSION)
+    provider = connections.ConnectionProvider(max_connections=args.max_connections)
+    server = api.ApiServer(address, api.Api(provider), quiet=args.quiet)
+    console.print(f"Listening on http://{args.bind}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        provider.close()
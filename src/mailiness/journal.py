@@ -0,0 +1,138 @@
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+from mailiness import g
+
+HEADERS = ("seq", "op", "table", "key", "old_key", "at")
+
+# Entries deleted per transaction when compacting.
+DEFAULT_COMPACT_BATCH_SIZE = 5000
+
+
+def changes_table_name() -> str:
+    return "mailiness_changes"
+
+
+def _key_columns() -> list[tuple]:
+    return [
+        (g.config["db"]["domains_table_name"], "name"),
+        (g.config["db"]["users_table_name"], "email"),
+        (g.config["db"]["aliases_table_name"], "from_address"),
+    ]
+
+
+def get_statements() -> list[str]:
+    """
+    The change journal and the triggers appending to it.
+
+    Triggers run inside the transaction of the statement that fired them, so
+    every write, whether from mailiness, an import or plain SQL, is recorded
+    if and only if it commits. AUTOINCREMENT keeps sequence numbers growing
+    after entries are compacted away.
+
+    Updates record the new key, and the old one when the key changed.
+    """
+    changes_table = changes_table_name()
+    statements = [
+        f"CREATE TABLE IF NOT EXISTS {changes_table}(seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, tbl TEXT NOT NULL, key TEXT NOT NULL, old_key TEXT, at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)))",
+    ]
+    for table, column in _key_columns():
+        insert = f"INSERT INTO {changes_table}(op, tbl, key, old_key) VALUES"
+        statements += [
+            f"CREATE TRIGGER IF NOT EXISTS {changes_table}_{table}_insert AFTER INSERT ON {table} BEGIN {insert} ('insert', '{table}', new.{column}, NULL); END",
+            f"CREATE TRIGGER IF NOT EXISTS {changes_table}_{table}_delete AFTER DELETE ON {table} BEGIN {insert} ('delete', '{table}', old.{column}, NULL); END",
+            f"CREATE TRIGGER IF NOT EXISTS {changes_table}_{table}_update AFTER UPDATE ON {table} BEGIN {insert} ('update', '{table}', new.{column}, CASE WHEN old.{column} IS NOT new.{column} THEN old.{column} END); END",
+        ]
+    return statements
+
+
+def head(conn: sqlite3.Connection) -> int:
+    """
+    The sequence number of the latest change, 0 if there's none yet.
+    """
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name=?", [changes_table_name()]
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def _compacted_up_to(conn: sqlite3.Connection) -> int:
+    oldest = conn.execute(f"SELECT min(seq) FROM {changes_table_name()}").fetchone()[0]
+    return head(conn) if oldest is None else oldest - 1
+
+
+def since(
+    conn: sqlite3.Connection, seq: int, batch_size: int = 1000
+) -> Iterator[tuple]:
+    """
+    Yield the changes after seq, oldest first, as HEADERS tuples.
+
+    Raise ValueError if some of them were compacted away, or seq is past the
+    latest change. The caller has to read the tables again, then continue
+    from head().
+    """
+    compacted = _compacted_up_to(conn)
+    if seq < compacted:
+        raise ValueError(
+            f"Changes up to {compacted} were compacted, read the tables again "
+            f"and continue from the latest change."
+        )
+    latest = head(conn)
+    if seq > latest:
+        # A database restored from a backup for instance.
+        raise ValueError(
+            f"The latest change is {latest}, read the tables again and "
+            f"continue from there."
+        )
+    # Pages of the primary key so the scan never holds a read open for long.
+    while True:
+        rows = conn.execute(
+            f"SELECT seq, op, tbl, key, old_key, at FROM {changes_table_name()} WHERE seq > ? ORDER BY seq LIMIT ?",
+            [seq, batch_size],
+        ).fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        seq = rows[-1][0]
+
+
+def compact(
+    conn: sqlite3.Connection,
+    before: Optional[int] = None,
+    older_than: Optional[float] = None,
+    batch_size: int = DEFAULT_COMPACT_BATCH_SIZE,
+) -> int:
+    """
+    Delete the changes up to and including seq before, and those older than
+    older_than seconds. Return how many were deleted.
+
+    Entries are deleted oldest first, batch_size per transaction, so the
+    journal never has gaps and writers only wait for a single batch.
+    """
+    changes_table = changes_table_name()
+    limits = []
+    if before is not None:
+        limits.append(before)
+    if older_than is not None:
+        cutoff = int(time.time() - older_than)
+        limits.append(
+            conn.execute(
+                f"SELECT coalesce(max(seq), 0) FROM {changes_table} WHERE at < ?",
+                [cutoff],
+            ).fetchone()[0]
+        )
+    if not limits:
+        return 0
+    up_to = max(limits)
+
+    deleted = 0
+    while True:
+        cursor = conn.execute(
+            f"DELETE FROM {changes_table} WHERE seq IN (SELECT seq FROM {changes_table} WHERE seq <= ? ORDER BY seq LIMIT ?)",
+            [up_to, batch_size],
+        )
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return deleted
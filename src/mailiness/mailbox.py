@@ -0,0 +1,371 @@
+import heapq
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+
+from mailiness import g
+
+TRASH_DIRECTORY_NAME = ".trash"
+
+DEFAULT_USAGE_INDEX_PATH = "/var/local/mailiness-usage.db"
+
+MAILDIR_SUBDIRECTORIES = ("cur", "new", "tmp")
+
+# Directories modified this recently may still change within the same mtime
+# tick, so they're never trusted on the next run.
+MTIME_GRACE_NS = 2_000_000_000
+
+
+def get_trash_directory() -> Path:
+    return Path(g.config["mail"]["vmail_directory"]) / TRASH_DIRECTORY_NAME
+
+
+def move_to_trash(path: Path) -> Path:
+    """
+    Move a mailbox directory into the trash and return its new location.
+
+    The trash lives inside the vmail directory so this is a single atomic
+    rename no matter how many messages the mailbox holds.
+    """
+    trash = get_trash_directory()
+    trash.mkdir(mode=0o700, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    dest = trash / f"{timestamp}-{secrets.token_hex(4)}-{path.name}"
+    os.rename(path, dest)
+    return dest
+
+
+class RateLimiter:
+    """
+    Allow at most rate operations per second across all threads.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _unlink_files(path: str, limiter: RateLimiter) -> tuple:
+    files = 0
+    subdirectories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            else:
+                limiter.wait()
+                os.unlink(entry.path)
+                files += 1
+    return path, files, subdirectories
+
+
+def purge_trash(workers: int = 4, rate: Optional[float] = None) -> tuple:
+    """
+    Delete everything in the trash and return the number of files and
+    directories removed.
+
+    Directories are scanned by a pool of threads. rate limits the number of
+    files unlinked per second to leave disk I/O for live delivery.
+    """
+    trash = get_trash_directory()
+    if not trash.exists():
+        return 0, 0
+
+    limiter = RateLimiter(rate)
+    files = 0
+    directories = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        with os.scandir(trash) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.add(executor.submit(_unlink_files, entry.path, limiter))
+                else:
+                    os.unlink(entry.path)
+                    files += 1
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, unlinked, subdirectories = future.result()
+                files += unlinked
+                directories.append(path)
+                for subdirectory in subdirectories:
+                    pending.add(executor.submit(_unlink_files, subdirectory, limiter))
+
+    # Every file is gone, remove the now empty directories deepest first.
+    directories.sort(key=lambda path: path.count(os.sep), reverse=True)
+    for path in directories:
+        os.rmdir(path)
+
+    return files, len(directories)
+
+
+def get_mailbox_path(email: str) -> Path:
+    user, domain = email.split("@")
+    return Path(g.config["mail"]["vmail_directory"]) / domain / user
+
+
+def read_maildirsize(path: Path) -> Optional[int]:
+    """
+    Return the bytes used according to a Dovecot maildirsize file.
+
+    The first line holds the quota definition, every following line a
+    "bytes count" delta. Return None if the file doesn't exist.
+    """
+    try:
+        with path.open("r", encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+    except FileNotFoundError:
+        return None
+
+    used = 0
+    for line in lines[1:]:
+        fields = line.split()
+        if fields:
+            used += int(fields[0])
+    return used
+
+
+def directory_size(path: Path) -> int:
+    """
+    Return the size of every file below path.
+    """
+    size = 0
+    stack = [str(path)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+def mailbox_usage(path: Path) -> int:
+    """
+    Return the disk space used by the mailbox at path.
+
+    Dovecot's maildirsize file is used when present to avoid walking the
+    mailbox.
+    """
+    used = read_maildirsize(path / "maildirsize")
+    if used is None:
+        used = directory_size(path)
+    return used
+
+
+def _scan_maildir_directory(path: str) -> tuple:
+    size = 0
+    files = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+                files += 1
+    return size, files
+
+
+def _scan_mailbox(path: Path, known: dict) -> tuple:
+    """
+    Measure a mailbox, reusing known cur/new/tmp entries whose mtime didn't change.
+
+    Return the mailbox's usage, its directory entries (None when Dovecot's
+    maildirsize file was used instead) and the number of directories scanned
+    and skipped.
+    """
+    used = read_maildirsize(path / "maildirsize")
+    if used is not None:
+        return used, None, 0, 0
+
+    entries = {}
+    scanned = 0
+    skipped = 0
+    recent = time.time_ns() - MTIME_GRACE_NS
+    stack = [str(path)]
+    while stack:
+        try:
+            children = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with children:
+            for child in children:
+                if not child.is_dir(follow_symlinks=False):
+                    continue
+                if child.name not in MAILDIR_SUBDIRECTORIES:
+                    stack.append(child.path)
+                    continue
+                mtime_ns = child.stat(follow_symlinks=False).st_mtime_ns
+                previous = known.get(child.path)
+                if previous is not None and previous[0] == mtime_ns:
+                    entries[child.path] = previous
+                    skipped += 1
+                    continue
+                size, files = _scan_maildir_directory(child.path)
+                scanned += 1
+                entries[child.path] = (
+                    0 if mtime_ns > recent else mtime_ns,
+                    size,
+                    files,
+                )
+
+    used = sum(size for _, size, _ in entries.values())
+    return used, entries, scanned, skipped
+
+
+class UsageIndex:
+    """
+    Persistent record of the size, file count and mtime of every Maildir
+    cur/new/tmp directory.
+
+    Adding, removing or flagging a message always changes the mtime of the
+    directory holding it, so directories with an unchanged mtime are never
+    rescanned.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or g.config.get(
+            "mail", "usage_index_path", fallback=DEFAULT_USAGE_INDEX_PATH
+        )
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS directories(path TEXT PRIMARY KEY, mailbox TEXT NOT NULL, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, files INTEGER NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS directories_mailbox_idx ON directories(mailbox)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.commit()
+        self.scanned = 0
+        self.skipped = 0
+
+    def _known(self) -> dict:
+        known = {}
+        for path, mailbox, mtime_ns, size, files in self.conn.execute(
+            "SELECT path, mailbox, mtime_ns, size, files FROM directories"
+        ):
+            known.setdefault(mailbox, {})[path] = (mtime_ns, size, files)
+        return known
+
+    def update(self, mailboxes: Iterable[Path], workers: int = 8) -> list:
+        """
+        Bring the index up to date for these mailboxes and return their usage
+        in the same order.
+        """
+        mailboxes = list(mailboxes)
+        known = self._known()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    _scan_mailbox,
+                    mailboxes,
+                    [known.get(str(mailbox), {}) for mailbox in mailboxes],
+                )
+            )
+
+        usages = []
+        for mailbox, (used, entries, scanned, skipped) in zip(mailboxes, results):
+            usages.append(used)
+            self.scanned += scanned
+            self.skipped += skipped
+            if entries is None:
+                continue
+            previous = known.get(str(mailbox), {})
+            self.conn.executemany(
+                "DELETE FROM directories WHERE path=?",
+                [(path,) for path in previous.keys() - entries.keys()],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?,?,?,?,?)",
+                [
+                    (path, str(mailbox), mtime_ns, size, files)
+                    for path, (mtime_ns, size, files) in entries.items()
+                    if previous.get(path) != (mtime_ns, size, files)
+                ],
+            )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?,?)",
+            [
+                ("updated_at", datetime.now().isoformat(timespec="seconds")),
+                ("scanned", str(self.scanned)),
+                ("skipped", str(self.skipped)),
+            ],
+        )
+        self.conn.commit()
+        return usages
+
+    def rebuild(self, mailboxes: Iterable[Path], workers: int = 8) -> list:
+        """
+        Forget everything and scan every directory again.
+        """
+        self.conn.execute("DELETE FROM directories")
+        return self.update(mailboxes, workers=workers)
+
+    def stats(self) -> dict:
+        mailboxes, directories, size, files = self.conn.execute(
+            "SELECT count(DISTINCT mailbox), count(*), coalesce(sum(size), 0), coalesce(sum(files), 0) FROM directories"
+        ).fetchone()
+        stats = {
+            "path": self.path,
+            "mailboxes": mailboxes,
+            "directories": directories,
+            "size": size,
+            "files": files,
+        }
+        for key, value in self.conn.execute("SELECT key, value FROM meta"):
+            stats[f"last_{key}"] = value
+        return stats
+
+    def close(self):
+        self.conn.close()
+
+
+def top_usage(
+    users: Iterable[tuple],
+    top: int = 10,
+    workers: int = 8,
+    index: Optional[UsageIndex] = None,
+) -> list:
+    """
+    Return the top users closest to their quota as (email, used, quota) tuples.
+
+    users is an iterable of (email, quota) tuples. Mailboxes are measured by a
+    pool of threads, through the usage index if one is given, and only the top
+    entries are kept in a heap.
+    """
+    users = list(users)
+    paths = [get_mailbox_path(email) for email, _ in users]
+    if index is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            usages = list(executor.map(mailbox_usage, paths))
+    else:
+        usages = index.update(paths, workers=workers)
+    rows = ((email, used, quota) for (email, quota), used in zip(users, usages))
+    return heapq.nlargest(
+        top,
+        rows,
+        key=lambda row: (row[1] / row[2] if row[2] else 0, row[1]),
+    )
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Iterator, Optional
+
+from . import profiling
+
+
+def _is_lock_error(error: sqlite3.OperationalError) -> bool:
+    message = str(error)
+    return "database is locked" in message or "database table is locked" in message
+
+
+class QueryStats:
+    """
+    Counters for statements executed by the repositories, per statement template.
+
+    Statements are already templates since values are always bound as
+    parameters. Shared by every thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.lock_timeouts = 0
+        self.lock_wait_seconds = 0.0
+
+    def record(self, statement: str, seconds: float, rows: int = 0, error=False):
+        with self._lock:
+            count, total, maximum, total_rows, errors = self.statements.get(
+                statement, (0, 0.0, 0.0, 0, 0)
+            )
+            self.statements[statement] = (
+                count + 1,
+                total + seconds,
+                max(maximum, seconds),
+                total_rows + rows,
+                errors + int(error),
+            )
+
+    def add_rows(self, statement: str, rows: int):
+        with self._lock:
+            count, total, maximum, total_rows, errors = self.statements[statement]
+            self.statements[statement] = (
+                count,
+                total,
+                maximum,
+                total_rows + rows,
+                errors,
+            )
+
+    def record_lock_wait(self, seconds: float):
+        with self._lock:
+            self.lock_timeouts += 1
+            self.lock_wait_seconds += seconds
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return dict(self.statements), self.lock_timeouts, self.lock_wait_seconds
+
+    def clear(self):
+        with self._lock:
+            self.statements = {}
+            self.lock_timeouts = 0
+            self.lock_wait_seconds = 0.0
+
+
+queries = QueryStats()
+
+
+class InstrumentedCursor:
+    """
+    Cursor wrapper feeding QueryStats.
+
+    Statements are never retried: SQLite already waits for locks held by
+    other processes, usually Postfix or Dovecot, up to the connection's busy
+    timeout, and re-running an executemany would apply its rows twice. A
+    statement failing because the database is locked spent that whole time
+    waiting, so it's recorded as a lock wait. Rows are counted as they're
+    fetched.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor, stats: Optional[QueryStats] = None):
+        self._cursor = cursor
+        self._stats = stats if stats is not None else queries
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _run(self, method, sql: str, parameters):
+        statement = profiling.statement_phase(sql)[len("sql: ") :]
+        self._statement = statement
+        start = time.perf_counter()
+        try:
+            method(sql, parameters)
+        except sqlite3.OperationalError as e:
+            seconds = time.perf_counter() - start
+            self._stats.record(statement, seconds, error=True)
+            if _is_lock_error(e):
+                self._stats.record_lock_wait(seconds)
+            raise
+        self._stats.record(statement, time.perf_counter() - start)
+        return self
+
+    def execute(self, sql: str, parameters=()):
+        return self._run(self._cursor.execute, sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        return self._run(self._cursor.executemany, sql, seq_of_parameters)
+
+    def _count(self, rows: int):
+        if self._statement is not None and rows:
+            self._stats.add_rows(self._statement, rows)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._count(row is not None)
+        return row
+
+    def fetchmany(self, size: int = None):
+        rows = self._cursor.fetchmany(size or self._cursor.arraysize)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self) -> Iterator[tuple]:
+        rows = 0
+        try:
+            for row in self._cursor:
+                rows += 1
+                yield row
+        finally:
+            self._count(rows)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric(lines: list, name: str, metric_type: str, help_text: str, samples: list):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in samples:
+        if labels:
+            rendered = ",".join(
+                f'{key}="{_escape_label(str(label))}"' for key, label in labels.items()
+            )
+            lines.append(f"{name}{{{rendered}}} {value}")
+        else:
+            lines.append(f"{name} {value}")
+
+
+def render(stats: Optional[QueryStats] = None, extra: Optional[dict] = None) -> str:
+    """
+    Render the query statistics in the Prometheus text exposition format.
+
+    extra maps metric names to (type, help, value) for gauges and counters
+    without labels.
+    """
+    statements, lock_timeouts, lock_wait_seconds = (stats or queries).snapshot()
+    lines = []
+    for suffix, metric_type, help_text, index in (
+        ("queries_total", "counter", "Statements executed.", 0),
+        ("query_seconds_total", "counter", "Time spent executing statements.", 1),
+        ("query_seconds_max", "gauge", "Slowest execution of the statement.", 2),
+        ("rows_total", "counter", "Rows fetched from the statement's results.", 3),
+        ("errors_total", "counter", "Statements that raised an error.", 4),
+    ):
+        _metric(
+            lines,
+            f"mailiness_sql_{suffix}",
+            metric_type,
+            help_text,
+            [
+                ({"statement": statement}, values[index])
+                for statement, values in sorted(statements.items())
+            ],
+        )
+    _metric(
+        lines,
+        "mailiness_sql_lock_timeouts_total",
+        "counter",
+        "Statements that gave up waiting for a lock held by another process.",
+        [({}, lock_timeouts)],
+    )
+    _metric(
+        lines,
+        "mailiness_sql_lock_wait_seconds_total",
+        "counter",
+        "Time spent by those statements waiting for the lock.",
+        [({}, lock_wait_seconds)],
+    )
+    for name, (metric_type, help_text, value) in (extra or {}).items():
+        _metric(lines, name, metric_type, help_text, [({}, value)])
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str, text: str):
+    """
+    Write metrics for node_exporter's textfile collector.
+
+    The file is written next to path and renamed so the collector never
+    reads a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".mailiness-metrics-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
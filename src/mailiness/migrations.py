@@ -0,0 +1,505 @@
+import abc
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from mailiness import g
+
+from . import journal, repo, settings
+
+DEFAULT_BATCH_SIZE = settings.MIGRATION_BATCH_SIZE
+
+# SQLite virtual machine instructions between progress checks.
+PROGRESS_STEPS = 100_000
+
+# Seconds between progress reports of a long statement.
+PROGRESS_INTERVAL = 2.0
+
+# Migrations code outside this module relies on, see get_migrations().
+ALIAS_TARGETS_VERSION = 2
+JOURNAL_VERSION = 4
+
+
+class SchemaOutdated(Exception):
+    pass
+
+
+def get_statements() -> list[str]:
+    """
+    Statements bringing a database up to the schema mailiness expects.
+
+    Every statement is idempotent so migrating twice is harmless.
+    """
+    return get_table_statements() + get_alias_targets_statements()
+
+
+def get_table_statements() -> list[str]:
+    domains_table = g.config["db"]["domains_table_name"]
+    users_table = g.config["db"]["users_table_name"]
+    aliases_table = g.config["db"]["aliases_table_name"]
+    return [
+        f"CREATE TABLE IF NOT EXISTS {domains_table}(name TEXT NOT NULL UNIQUE)",
+        f"CREATE TABLE IF NOT EXISTS {users_table}(domain_id INTEGER NOT NULL, email TEXT NOT NULL UNIQUE, password TEXT, quota INTEGER NOT NULL, FOREIGN KEY(domain_id) REFERENCES {domains_table}(rowid) ON DELETE CASCADE)",
+        f"CREATE TABLE IF NOT EXISTS {aliases_table}(domain_id INTEGER NOT NULL, from_address TEXT NOT NULL UNIQUE, to_address TEXT NOT NULL, FOREIGN KEY(domain_id) REFERENCES {domains_table}(rowid) ON DELETE CASCADE)",
+        f"CREATE INDEX IF NOT EXISTS {users_table}_domain_id_idx ON {users_table}(domain_id)",
+        f"CREATE INDEX IF NOT EXISTS {aliases_table}_domain_id_idx ON {aliases_table}(domain_id)",
+        f"CREATE INDEX IF NOT EXISTS {aliases_table}_to_address_idx ON {aliases_table}(to_address)",
+    ]
+
+
+def get_alias_targets_statements() -> list[str]:
+    targets_table = repo.alias_targets_table_name()
+    return [
+        f"CREATE TABLE IF NOT EXISTS {targets_table}(alias_id INTEGER NOT NULL, address TEXT NOT NULL)",
+        f"CREATE INDEX IF NOT EXISTS {targets_table}_address_idx ON {targets_table}(address)",
+        f"CREATE INDEX IF NOT EXISTS {targets_table}_alias_id_idx ON {targets_table}(alias_id)",
+    ]
+
+
+def get_search_statements() -> list[str]:
+    """
+    FTS5 trigram indexes over the addresses of users and aliases.
+
+    They're external content tables kept in sync by triggers so every write
+    path, including imports and sync, updates them. The trigram tokenizer
+    needs SQLite 3.34.
+    """
+    statements = []
+    for table, columns in (
+        (g.config["db"]["users_table_name"], ("email",)),
+        (
+            g.config["db"]["aliases_table_name"],
+            ("from_address", "to_address"),
+        ),
+    ):
+        search_table = repo.search_table_name(table)
+        names = ", ".join(columns)
+        new_values = ", ".join(f"new.{column}" for column in columns)
+        old_values = ", ".join(f"old.{column}" for column in columns)
+        insert = f"INSERT INTO {search_table}(rowid, {names}) VALUES (new.rowid, {new_values});"
+        delete = (
+            f"INSERT INTO {search_table}({search_table}, rowid, {names}) "
+            f"VALUES ('delete', old.rowid, {old_values});"
+        )
+        statements += [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {search_table} USING fts5({names}, content='{table}', content_rowid='rowid', tokenize='trigram')",
+            f"CREATE TRIGGER IF NOT EXISTS {search_table}_insert AFTER INSERT ON {table} BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {search_table}_delete AFTER DELETE ON {table} BEGIN {delete} END",
+            f"CREATE TRIGGER IF NOT EXISTS {search_table}_update AFTER UPDATE OF {names} ON {table} BEGIN {delete} {insert} END",
+        ]
+    return statements
+
+
+def _case_insensitive_columns() -> list[tuple]:
+    return [
+        (g.config["db"]["domains_table_name"], "name"),
+        (g.config["db"]["users_table_name"], "email"),
+        (g.config["db"]["aliases_table_name"], "from_address"),
+    ]
+
+
+def find_case_duplicates(cursor: sqlite3.Cursor) -> dict:
+    """
+    Map each table to the groups of its domain names or addresses that only
+    differ in case. A single GROUP BY per table finds them.
+    """
+    return {
+        table: _case_duplicates(cursor, table, column)
+        for table, column in _case_insensitive_columns()
+    }
+
+
+def _case_duplicates(cursor: sqlite3.Cursor, table: str, column: str) -> list:
+    return sorted(
+        sorted(values.split("\n"))
+        for (values,) in cursor.execute(
+            f"SELECT group_concat({column}, char(10)) FROM {table} "
+            f"GROUP BY lower({column}) HAVING count(*) > 1"
+        )
+    )
+
+
+def _search_tables() -> list[str]:
+    return [
+        repo.search_table_name(g.config["db"]["users_table_name"]),
+        repo.search_table_name(g.config["db"]["aliases_table_name"]),
+    ]
+
+
+@contextmanager
+def search_indexes_suspended(cursor: sqlite3.Cursor):
+    """
+    Drop the search triggers for a bulk insert and rebuild the indexes after it.
+
+    Rebuilding once is several times faster than updating the indexes row by
+    row. Use it inside the insert's transaction so a rollback brings the
+    triggers back.
+    """
+    triggers = [
+        f"{search_table}_{event}"
+        for search_table in _search_tables()
+        for event in ("insert", "delete", "update")
+    ]
+    existing = {
+        row[0]
+        for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger'")
+    }
+    suspended = [trigger for trigger in triggers if trigger in existing]
+    for trigger in suspended:
+        cursor.execute(f"DROP TRIGGER {trigger}")
+    yield
+    if suspended:
+        for stmt in get_search_statements():
+            cursor.execute(stmt)
+        for search_table in _search_tables():
+            cursor.execute(
+                f"INSERT INTO {search_table}({search_table}) VALUES ('rebuild')"
+            )
+
+
+def _table_exists(cursor: sqlite3.Cursor, name: str) -> bool:
+    return (
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name=?", [name]).fetchone()
+        is not None
+    )
+
+
+def _count_rows(cursor: sqlite3.Cursor, *tables: str) -> int:
+    return sum(
+        cursor.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+        for table in tables
+        if _table_exists(cursor, table)
+    )
+
+
+@contextmanager
+def _reporting(conn: sqlite3.Connection, progress: Optional[Callable], what: str):
+    """
+    Report how long the statements run inside the block have been running.
+
+    SQLite calls the handler every PROGRESS_STEPS instructions, a report is
+    sent every PROGRESS_INTERVAL seconds.
+    """
+    if progress is None:
+        yield
+        return
+    started = reported = time.monotonic()
+
+    def handler() -> int:
+        nonlocal reported
+        now = time.monotonic()
+        if now - reported >= PROGRESS_INTERVAL:
+            reported = now
+            progress(f"{what}: {now - started:.0f}s")
+        return 0
+
+    conn.set_progress_handler(handler, PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+class Step(abc.ABC):
+    """
+    Part of a migration. Steps commit their own work.
+    """
+
+    description = ""
+
+    def estimate(self, cursor: sqlite3.Cursor) -> int:
+        """
+        Rows the step reads or writes.
+        """
+        return 0
+
+    @abc.abstractmethod
+    def run(
+        self,
+        conn: sqlite3.Connection,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        progress: Optional[Callable] = None,
+    ):
+        """
+        Apply the step, batch_size rows per transaction where it backfills,
+        calling progress with messages about long statements.
+        """
+
+
+class Statement(Step):
+    """
+    An idempotent DDL statement. Index builds report progress and estimate
+    the rows of their table, unless the index already exists.
+    """
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        words = sql.replace("(", " ").split()
+        self.index = self.table = None
+        if words[:2] == ["CREATE", "INDEX"]:
+            self.index, self.table = words[5], words[7]
+            self.description = f"Build index {self.index}"
+        else:
+            self.description = f"Create {words[1].lower()} {words[5]}"
+
+    def estimate(self, cursor: sqlite3.Cursor) -> int:
+        if self.index is None or _table_exists(cursor, self.index):
+            return 0
+        return _count_rows(cursor, self.table)
+
+    def run(self, conn, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        with _reporting(conn, progress, self.description):
+            conn.execute(self.sql)
+        conn.commit()
+
+
+class Backfill(Step):
+    """
+    Fill a table from the rows of another, batch_size rows per transaction,
+    so Postfix and Dovecot lookups only ever wait for a single batch.
+
+    fill(cursor, after, batch_size) handles the next batch of rows whose rowid
+    is greater than after and returns the last rowid handled, or None once
+    there are none left. Batches must be safe to run again.
+    """
+
+    def __init__(self, description: str, table: str, fill: Callable):
+        self.description = description
+        self.table = table
+        self.fill = fill
+
+    def estimate(self, cursor: sqlite3.Cursor) -> int:
+        return _count_rows(cursor, self.table)
+
+    def run(self, conn, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        total = self.estimate(conn.cursor())
+        done = 0
+        after = 0
+        reported = time.monotonic()
+        while True:
+            try:
+                last = self.fill(conn.cursor(), after, batch_size)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            if last is None:
+                break
+            after = last
+            done = min(done + batch_size, total)
+            if progress and time.monotonic() - reported >= PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                progress(f"{self.description}: {done}/{total} rows")
+
+
+def _fill_alias_targets(cursor: sqlite3.Cursor, after: int, batch_size: int):
+    aliases_table = g.config["db"]["aliases_table_name"]
+    targets_table = repo.alias_targets_table_name()
+    rows = cursor.execute(
+        f"SELECT rowid, to_address FROM {aliases_table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+        [after, batch_size],
+    ).fetchall()
+    if not rows:
+        return None
+    last = rows[-1][0]
+    cursor.execute(
+        f"DELETE FROM {targets_table} WHERE alias_id > ? AND alias_id <= ?",
+        [after, last],
+    )
+    cursor.executemany(
+        f"INSERT INTO {targets_table} VALUES (?,?)",
+        (
+            (alias_id, target)
+            for alias_id, to_address in rows
+            if "," in to_address
+            for target in repo.split_alias_targets(to_address)
+        ),
+    )
+    return last
+
+
+class SearchIndexes(Step):
+    """
+    Create the search indexes and fill them from their tables.
+
+    Searches scan the tables instead when SQLite can't create them.
+    """
+
+    description = "Build search indexes"
+
+    def estimate(self, cursor: sqlite3.Cursor) -> int:
+        return _count_rows(
+            cursor,
+            g.config["db"]["users_table_name"],
+            g.config["db"]["aliases_table_name"],
+        )
+
+    def run(self, conn, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        cursor = conn.cursor()
+        try:
+            for stmt in get_search_statements():
+                cursor.execute(stmt)
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if progress:
+                progress(f"Skipped search indexes, searches scan the tables: {e}")
+            return
+        for search_table in _search_tables():
+            with _reporting(conn, progress, f"Build index {search_table}"):
+                cursor.execute(
+                    f"INSERT INTO {search_table}({search_table}) VALUES ('rebuild')"
+                )
+            conn.commit()
+
+
+class CaseInsensitiveIndexes(Step):
+    """
+    Index lower() of every domain name and address so case-insensitive
+    lookups, from mailiness or the MTA, don't scan the tables.
+
+    The indexes are unique, unless the table holds case duplicates. Then
+    they're plain indexes until the duplicates are gone and migrate runs
+    again, which is why this step runs on every migration.
+    """
+
+    description = "Build case-insensitive indexes"
+
+    def _pending(self, cursor: sqlite3.Cursor) -> list[tuple]:
+        # Columns whose index is missing or not unique yet.
+        pending = []
+        for table, column in _case_insensitive_columns():
+            existing = {
+                row[1]: bool(row[2])
+                for row in cursor.execute(f"PRAGMA index_list({table})")
+            }
+            index = f"{table}_{column}_lower_idx"
+            if not existing.get(index):
+                pending.append((table, column, index, index in existing))
+        return pending
+
+    def estimate(self, cursor: sqlite3.Cursor) -> int:
+        return _count_rows(cursor, *(table for table, *_ in self._pending(cursor)))
+
+    def run(self, conn, batch_size=DEFAULT_BATCH_SIZE, progress=None) -> dict:
+        """
+        Return the groups of values only differing in case, per table.
+        """
+        cursor = conn.cursor()
+        duplicates = {table: [] for table, _ in _case_insensitive_columns()}
+        for table, column, index, exists in self._pending(cursor):
+            duplicates[table] = _case_duplicates(cursor, table, column)
+            unique = not duplicates[table]
+            if exists and not unique:
+                continue
+            # Swap a plain index for a unique one without a window where
+            # lookups have none.
+            cursor.execute("BEGIN")
+            if exists:
+                cursor.execute(f"DROP INDEX {index}")
+            with _reporting(conn, progress, f"Build index {index}"):
+                try:
+                    cursor.execute(
+                        f"CREATE {'UNIQUE ' if unique else ''}INDEX {index} ON {table}(lower({column}))"
+                    )
+                except BaseException:
+                    conn.rollback()
+                    raise
+            conn.commit()
+        return duplicates
+
+
+def get_migrations() -> list[tuple]:
+    """
+    (description, steps) of every migration. A migration's version is its
+    position in the list, starting at 1, so only ever append to it.
+    """
+    return [
+        (
+            "Domains, users and aliases tables",
+            [Statement(stmt) for stmt in get_table_statements()],
+        ),
+        (
+            "Alias targets lookup table",
+            [Statement(stmt) for stmt in get_alias_targets_statements()]
+            + [
+                Backfill(
+                    "Fill alias targets",
+                    g.config["db"]["aliases_table_name"],
+                    _fill_alias_targets,
+                )
+            ],
+        ),
+        ("Search indexes", [SearchIndexes()]),
+        ("Change journal", [Statement(stmt) for stmt in journal.get_statements()]),
+    ]
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def require_version(conn: sqlite3.Connection, version: int):
+    """
+    Raise SchemaOutdated unless migration version has run on the database.
+    """
+    current = get_version(conn)
+    if current < version:
+        raise SchemaOutdated(
+            f"The database schema is at version {current}, this command needs "
+            f"version {version}. Run 'mailiness db migrate' first."
+        )
+
+
+def plan(conn: sqlite3.Connection) -> list[tuple]:
+    """
+    (version, migration, step, estimated rows) of every step migrate would
+    run. The case-insensitive indexes have no version.
+    """
+    cursor = conn.cursor()
+    current = get_version(conn)
+    rows = []
+    for version, (description, steps) in enumerate(get_migrations(), start=1):
+        if version > current:
+            rows += [
+                (version, description, step.description, step.estimate(cursor))
+                for step in steps
+            ]
+    case_indexes = CaseInsensitiveIndexes()
+    estimate = case_indexes.estimate(cursor)
+    if estimate:
+        rows.append(
+            (None, "Case-insensitive lookups", case_indexes.description, estimate)
+        )
+    return rows
+
+
+def migrate(
+    conn: sqlite3.Connection,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    progress: Optional[Callable] = None,
+) -> dict:
+    """
+    Run the migrations newer than the database's user_version, recording
+    each one once it's done, then create or upgrade the case-insensitive
+    indexes.
+
+    progress is called with a message while long steps run.
+
+    Return the domains and addresses only differing in case, as
+    find_case_duplicates does, for tables without a unique case-insensitive
+    index.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    current = get_version(conn)
+    for version, (description, steps) in enumerate(get_migrations(), start=1):
+        if version <= current:
+            continue
+        for step in steps:
+            if progress:
+                progress(f"{version}. {description}: {step.description}")
+            step.run(conn, batch_size=batch_size, progress=progress)
+        conn.execute(f"PRAGMA user_version={version}")
+        conn.commit()
+    return CaseInsensitiveIndexes().run(conn, batch_size=batch_size, progress=progress)
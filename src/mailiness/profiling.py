@@ -0,0 +1,156 @@
+import json
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Callable, Optional, TextIO
+
+MODES = ("timings", "cprofile")
+
+# Statements longer than this are truncated in reports.
+MAX_STATEMENT_LENGTH = 100
+
+
+class Timings:
+    """
+    Time spent and number of calls per phase of a command.
+
+    Recording is a dict update so it's cheap enough to leave on.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+
+    def record(self, phase: str, seconds: float):
+        calls, total = self.phases.get(phase, (0, 0.0))
+        self.phases[phase] = (calls + 1, total + seconds)
+
+    @contextmanager
+    def _measure(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def phase(self, name: str):
+        """
+        Context manager timing its block as phase name, when enabled.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name)
+
+    def timed(self, name: str, fn: Callable) -> Callable:
+        """
+        Wrap fn so every call is timed as phase name.
+        """
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def rows(self) -> list:
+        """
+        Return (phase, calls, seconds) sorted by time spent, slowest first.
+        """
+        return sorted(
+            ((phase, calls, total) for phase, (calls, total) in self.phases.items()),
+            key=lambda row: row[2],
+            reverse=True,
+        )
+
+    def write_report(self, fp: TextIO):
+        # Everything else happens inside one of these.
+        total = sum(
+            self.phases.get(phase, (0, 0.0))[1]
+            for phase in ("imports", "config load", "command")
+        )
+        fp.write(
+            f"{'Phase':<{MAX_STATEMENT_LENGTH + 5}} {'Calls':>7} {'ms':>10} {'%':>6}\n"
+        )
+        for phase, calls, seconds in self.rows():
+            share = 100 * seconds / total if total else 0
+            fp.write(
+                f"{phase:<{MAX_STATEMENT_LENGTH + 5}} {calls:>7} {1000 * seconds:>10.3f} {share:>6.1f}\n"
+            )
+
+    def write_json_line(self, fp: TextIO, argv: list):
+        """
+        Append the timings as a single JSON line, handy for cron jobs.
+        """
+        record = {
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "argv": argv,
+            "phases": {
+                phase: {"calls": calls, "ms": round(1000 * total, 3)}
+                for phase, calls, total in self.rows()
+            },
+        }
+        fp.write(json.dumps(record) + "\n")
+
+
+timings = Timings()
+
+
+def statement_phase(sql: str) -> str:
+    statement = " ".join(sql.split())
+    if len(statement) > MAX_STATEMENT_LENGTH:
+        statement = statement[: MAX_STATEMENT_LENGTH - 3] + "..."
+    return f"sql: {statement}"
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        with timings.phase(statement_phase(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with timings.phase(statement_phase(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    Connection timing every statement run through it or its cursors.
+    """
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        with timings.phase(statement_phase(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with timings.phase(statement_phase(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+
+def connect(dsn: str, **kwargs) -> sqlite3.Connection:
+    if not timings.enabled:
+        return sqlite3.connect(dsn, **kwargs)
+    with timings.phase("db connect"):
+        return sqlite3.connect(dsn, factory=ProfiledConnection, **kwargs)
+
+
+def run_cprofile(fn: Callable[[], None], output: Optional[str], fp: TextIO):
+    """
+    Run fn under cProfile. Dump the raw stats to output if given, otherwise
+    write the 30 most expensive calls to fp.
+    """
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(fn)
+    finally:
+        if output:
+            profile.dump_stats(output)
+        else:
+            stats = pstats.Stats(profile, stream=fp)
+            stats.sort_stats("cumulative").print_stats(30)
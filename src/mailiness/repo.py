@@ -1,24 +1,199 @@
-import sqlite3
-from typing import Optional, Union
+import functools
+import re
+import threading
+from typing import Callable, Iterator, Optional, Union
 
 import bcrypt
 from rich.table import Table
 
 from mailiness import g
 
+from . import cache, connections, metrics, profiling
 
-def get_db_conn(dsn=g.config["db"]["connection_string"]):
-    return sqlite3.connect(dsn)
+# Maximum alias chain length followed when resolving an address.
+MAX_ALIAS_DEPTH = 32
+
+DEFAULT_SEARCH_LIMIT = 50
+
+
+def split_alias_targets(to_address: str) -> list[str]:
+    """
+    Split a comma separated to_address into its individual targets.
+    """
+    return [target.strip() for target in to_address.split(",") if target.strip()]
+
+
+def alias_targets_table_name() -> str:
+    """
+    Lookup table holding each target of aliases with several comma separated targets.
+    """
+    return g.config["db"]["aliases_table_name"] + "_targets"
+
+
+def normalize_address(address: str) -> str:
+    """
+    Addresses, lists of them and domain names are stored in lower case, like
+    the MTA looks them up.
+    """
+    return address.strip().lower()
+
+
+def search_table_name(table: str) -> str:
+    """
+    FTS5 trigram index over the addresses of table, see migrations.
+    """
+    return table + "_search"
+
+
+def search_pattern(pattern: str) -> str:
+    """
+    Patterns without wildcards match addresses containing them.
+    """
+    if "*" in pattern or "?" in pattern:
+        return pattern
+    return f"*{pattern}*"
+
+
+def _glob_regex(pattern: str) -> re.Pattern:
+    return re.compile(
+        "".join(
+            ".*" if char == "*" else "." if char == "?" else re.escape(char)
+            for char in pattern
+        ),
+        re.IGNORECASE | re.DOTALL,
+    )
+
+
+def get_db_conn(dsn=g.config["db"]["connection_string"], read_only: bool = False):
+    if read_only:
+        return connections.connect_read_only(dsn)
+    return profiling.connect(dsn)
+
+
+def writes(method: Callable) -> Callable:
+    """
+    Serialise a repository method through its provider's write lock.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.provider is None:
+            return method(self, *args, **kwargs)
+        # Lease the connection first, waiting for one while holding the
+        # lock would deadlock with threads waiting for the lock.
+        self.provider.connection()
+        with self.provider.write_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class BaseRepository:
-    def __init__(self, conn=None):
-        if conn is None:
-            self.db_conn = get_db_conn()
+    headers = ("ID (rowid)", "Name")
+
+    def __init__(
+        self,
+        conn=None,
+        provider: Optional[connections.ConnectionProvider] = None,
+        read_only: bool = False,
+    ):
+        """
+        Use conn, or each calling thread's connection from provider so the
+        same repository can be used by several threads at once.
+
+        Without either, open the configured database, read-only if the
+        caller only lists or looks things up.
+        """
+        self.provider = provider
+        if conn is None and provider is None:
+            conn = get_db_conn(read_only=read_only)
+        self._conn = conn
+        self._local = threading.local()
+
+    @property
+    def db_conn(self):
+        if self.provider is not None:
+            return self.provider.connection()
+        return self._conn
+
+    @property
+    def cursor(self) -> metrics.InstrumentedCursor:
+        conn = self.db_conn
+        if getattr(self._local, "conn", None) is not conn:
+            self._local.conn = conn
+            self._local.cursor = metrics.InstrumentedCursor(conn.cursor())
+        return self._local.cursor
+
+    @property
+    def data(self) -> dict:
+        data = getattr(self._local, "data", None)
+        if data is None:
+            data = {"headers": self.headers, "rows": []}
+            self._local.data = data
+        return data
+
+    def _iterate(self, table: str, columns: str, batch_size: int) -> Iterator[tuple]:
+        """
+        Yield (rowid, *columns) for every row in rowid order.
+
+        Rows are read batch_size at a time with keyset pagination so memory
+        use doesn't grow with the table and no read transaction is held
+        between batches.
+        """
+        last_rowid = 0
+        while True:
+            rows = self.cursor.execute(
+                f"SELECT rowid, {columns} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                [last_rowid, batch_size],
+            ).fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_rowid = rows[-1][0]
+
+    def _search(
+        self,
+        table: str,
+        columns: str,
+        column: str,
+        pattern: str,
+        limit: Optional[int],
+        split: bool = False,
+    ) -> list[tuple]:
+        """
+        Return rows whose column matches the glob pattern, ordered by column.
+
+        The trigram index turns the pattern into a LIKE that narrows the rows
+        down, the exact match is checked here since "_" and "%" can't be
+        escaped for it. Without the index, SQLite older than 3.34, the table
+        is scanned. column must be the second of columns. If split is true,
+        matching any of the comma separated addresses is enough.
+        """
+        pattern = search_pattern(pattern)
+        regex = _glob_regex(pattern)
+        like = pattern.replace("*", "%").replace("?", "_")
+        if split:
+            # Any target of the list may match, not just the first or last.
+            like = f"%{like.strip('%')}%"
+        stmt = f"SELECT {columns} FROM {table} WHERE "
+        search_table = search_table_name(table)
+        if self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+            [search_table],
+        ).fetchone():
+            stmt += f"rowid IN (SELECT rowid FROM {search_table} WHERE {column} LIKE ?)"
         else:
-            self.db_conn = conn
-        self.cursor = self.db_conn.cursor()
-        self.data = {"headers": ("ID (rowid)", "Name"), "rows": []}
+            stmt += f"{column} LIKE ?"
+        stmt += f" ORDER BY {column}"
+
+        rows = []
+        for row in self.cursor.execute(stmt, [like]):
+            addresses = split_alias_targets(row[1]) if split else [row[1]]
+            if any(regex.fullmatch(address) for address in addresses):
+                rows.append(row)
+                if len(rows) == limit:
+                    break
+        return rows
 
     def _prettify_data(self) -> Table:
         table = Table(title="Domains")
@@ -44,6 +219,13 @@ class DomainRepository(BaseRepository):
         self.data["rows"] = result.fetchall()
         return self._prettify_data() if pretty else self.data
 
+    def iterate(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """
+        Yield (rowid, name) for every domain without loading the table.
+        """
+        return self._iterate(g.config["db"]["domains_table_name"], "name", batch_size)
+
+    @writes
     def create(self, name: str, pretty=True) -> Union[dict, Table]:
         """
         Add a domain name to the database and return the result.
@@ -52,41 +234,145 @@ class DomainRepository(BaseRepository):
         """
         result = self.cursor.execute(
             f"INSERT INTO {g.config['db']['domains_table_name']} VALUES(?) RETURNING rowid, name",
-            [name],
+            [normalize_address(name)],
         )
         self.data["rows"] = result.fetchall()
         self.db_conn.commit()
         return self._prettify_data() if pretty else self.data
 
+    def get_name(self, name: str) -> Optional[str]:
+        """
+        Return the domain's name as stored, or None if there's no such domain.
+        """
+        result = self.cursor.execute(
+            f"SELECT name FROM {g.config['db']['domains_table_name']} WHERE lower(name)=?",
+            [normalize_address(name)],
+        )
+        row = result.fetchone()
+        return row[0] if row else None
+
+    @writes
     def edit(self, what: str, old: str, new: str, pretty=True) -> Union[dict, Table]:
         """
         Change a domain's "what" attribute from old to new.
+
+        Renaming a domain also renames every user and alias address on it, as
+        well as alias targets pointing at it, in the same transaction.
         """
         if what in ("name",):
+            old, new = normalize_address(old), normalize_address(new)
             result = self.cursor.execute(
-                f"UPDATE {g.config['db']['domains_table_name']} SET {what}=? WHERE {what}=? RETURNING rowid, name",
+                f"UPDATE {g.config['db']['domains_table_name']} SET {what}=? WHERE lower({what})=? RETURNING rowid, name",
                 [new, old],
             )
         else:
             raise ValueError(f"I don't know what {what} is.")
         self.data["rows"] = result.fetchall()
+        for domain_id, _ in self.data["rows"]:
+            self._rename_addresses(domain_id, old, new)
         self.db_conn.commit()
         return self._prettify_data() if pretty else self.data
 
-    def delete(self, name):
+    def _rename_addresses(self, domain_id: int, old: str, new: str):
         """
-        Delete a domain name.
+        Rewrite the domain part of every address using set based updates.
         """
+        users_table = g.config["db"]["users_table_name"]
+        aliases_table = g.config["db"]["aliases_table_name"]
+        bindings = {"domain_id": domain_id, "old": old, "new": new}
+        # The domain part is everything after the last "@", replace it in place.
+        new_address = "substr({column}, 1, length({column}) - length(:old)) || :new"
+        has_old_domain = "lower(substr({column}, -length(:old) - 1)) = '@' || :old"
+
+        self.cursor.execute(
+            f"UPDATE {users_table} SET email = {new_address.format(column='email')} "
+            f"WHERE domain_id = :domain_id AND {has_old_domain.format(column='email')}",
+            bindings,
+        )
         self.cursor.execute(
-            f"DELETE FROM {g.config['db']['domains_table_name']} WHERE name=?", [name]
+            f"UPDATE {aliases_table} SET from_address = {new_address.format(column='from_address')} "
+            f"WHERE domain_id = :domain_id AND {has_old_domain.format(column='from_address')}",
+            bindings,
         )
+        # Targets can live on any domain and hold several comma separated addresses.
+        self.cursor.execute(
+            f"UPDATE {aliases_table} "
+            "SET to_address = trim(replace(',' || to_address || ',', '@' || :old || ',', '@' || :new || ','), ',') "
+            "WHERE instr(',' || to_address || ',', '@' || :old || ',') > 0",
+            bindings,
+        )
+        self.cursor.execute(
+            f"UPDATE {alias_targets_table_name()} SET address = {new_address.format(column='address')} "
+            f"WHERE {has_old_domain.format(column='address')}",
+            bindings,
+        )
+
+    @writes
+    def delete(
+        self,
+        name: str,
+        batch_size: Optional[int] = None,
+        progress: Optional[Callable[[str, int], None]] = None,
+    ):
+        """
+        Delete a domain name along with its users and aliases.
+
+        The documented schema references domains(rowid), which SQLite can't
+        enforce as a foreign key, so ON DELETE CASCADE never fires and the
+        cascade is done here instead.
+
+        If batch_size is given, aliases and users are deleted that many rows at
+        a time, each batch in its own short transaction, so that mail server
+        lookups aren't stalled. The domain row goes last which means an
+        interrupted delete is resumed by running it again.
+
+        progress is called with the table name and the number of rows deleted
+        from it so far after every batch.
+        """
+        domains_table = g.config["db"]["domains_table_name"]
+        aliases_table = g.config["db"]["aliases_table_name"]
+        row = self.cursor.execute(
+            f"SELECT rowid FROM {domains_table} WHERE lower(name)=?",
+            [normalize_address(name)],
+        ).fetchone()
+        if row is None:
+            return
+        domain_id = row[0]
+
+        for table in (aliases_table, g.config["db"]["users_table_name"]):
+            deleted = 0
+            while True:
+                # A negative limit means no limit at all.
+                ids = self.cursor.execute(
+                    f"SELECT rowid FROM {table} WHERE domain_id=? ORDER BY rowid LIMIT ?",
+                    [domain_id, batch_size or -1],
+                ).fetchall()
+                if not ids:
+                    break
+                bindings = [domain_id, ids[0][0], ids[-1][0]]
+                if table == aliases_table:
+                    self.cursor.execute(
+                        f"DELETE FROM {alias_targets_table_name()} WHERE alias_id IN "
+                        f"(SELECT rowid FROM {table} WHERE domain_id=? AND rowid BETWEEN ? AND ?)",
+                        bindings,
+                    )
+                self.cursor.execute(
+                    f"DELETE FROM {table} WHERE domain_id=? AND rowid BETWEEN ? AND ?",
+                    bindings,
+                )
+                deleted += len(ids)
+                if batch_size:
+                    self.db_conn.commit()
+                if progress:
+                    progress(table, deleted)
+
+        self.cursor.execute(f"DELETE FROM {domains_table} WHERE rowid=?", [domain_id])
         self.db_conn.commit()
+        cache.credentials.clear()
 
 
 class UserRepository(BaseRepository):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.data["headers"] = ("ID (Row id)", "Email", "Quota (GB)")
+    headers = ("ID (Row id)", "Email", "Quota (GB)")
 
     def _set_data(self, rows: list[tuple]):
 
@@ -106,12 +392,12 @@ class UserRepository(BaseRepository):
         stmt = f"SELECT rowid, email, quota FROM {g.config['db']['users_table_name']}"
         if domain:
             result = self.cursor.execute(
-                f"SELECT rowid FROM {g.config['db']['domains_table_name']} WHERE name=?",
-                [domain],
+                f"SELECT rowid FROM {g.config['db']['domains_table_name']} WHERE lower(name)=?",
+                [normalize_address(domain)],
             )
             row = result.fetchone()
-            if len(row) < 0:
-                raise Exception(f"Domain {domain} doesn't exist")
+            if row is None:
+                raise ValueError(f"Domain {domain} doesn't exist.")
             domain_id = int(row[0])
             stmt += f" WHERE domain_id={domain_id}"
 
@@ -120,8 +406,54 @@ class UserRepository(BaseRepository):
         self._set_data(result.fetchall())
         return self._prettify_data() if pretty else self.data
 
+    def iterate(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """
+        Yield (rowid, email, password hash, quota in bytes) for every user
+        without loading the table.
+        """
+        return self._iterate(
+            g.config["db"]["users_table_name"], "email, password, quota", batch_size
+        )
+
+    def search(
+        self, pattern: str, limit: Optional[int] = DEFAULT_SEARCH_LIMIT, pretty=True
+    ) -> Union[dict, Table]:
+        """
+        Return up to limit users whose email matches the glob pattern.
+
+        "*" matches anything and "?" a single character, matching ignores
+        case. A pattern without either matches emails containing it.
+        """
+        self._set_data(
+            self._search(
+                g.config["db"]["users_table_name"],
+                "rowid, email, quota",
+                "email",
+                pattern,
+                limit,
+            )
+        )
+        return self._prettify_data() if pretty else self.data
+
+    def quotas(self, domain: Optional[str] = None) -> list[tuple]:
+        """
+        Return (email, quota in bytes) for every user, or this domain's users only.
+        """
+        users_table = g.config["db"]["users_table_name"]
+        if domain:
+            result = self.cursor.execute(
+                f"SELECT u.email, u.quota FROM {users_table} AS u "
+                f"JOIN {g.config['db']['domains_table_name']} AS d ON d.rowid = u.domain_id "
+                "WHERE lower(d.name)=?",
+                [normalize_address(domain)],
+            )
+        else:
+            result = self.cursor.execute(f"SELECT email, quota FROM {users_table}")
+        return [(email, int(quota or 0)) for email, quota in result]
+
     def _hash_password(self, password: str) -> str:
-        h = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+        with profiling.timings.phase("bcrypt"):
+            h = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
 
         s = h.decode("utf-8")
 
@@ -130,15 +462,41 @@ class UserRepository(BaseRepository):
 
         return s
 
+    def verify_password(self, password: str, password_hash: str) -> bool:
+        """
+        Check a plaintext password against a hash produced by _hash_password.
+        """
+        prefix = g.config["users"]["password_hash_prefix"]
+        if password_hash.startswith(prefix):
+            password_hash = password_hash[len(prefix) :]
+        try:
+            with profiling.timings.phase("bcrypt"):
+                return bcrypt.checkpw(
+                    password.encode("utf-8"), password_hash.encode("utf-8")
+                )
+        except ValueError:
+            return False
+
+    def get_password_hash(self, email: str) -> Optional[str]:
+        """
+        Return the stored password hash for this user or None if there's no such user.
+        """
+        result = self.cursor.execute(
+            f"SELECT password FROM {g.config['db']['users_table_name']} WHERE lower(email)=?",
+            [normalize_address(email)],
+        )
+        row = result.fetchone()
+        return row[0] if row else None
+
     def _get_domain_id_from_email(self, email: str) -> int:
         _, domain = email.split("@")
         result = self.cursor.execute(
-            f"SELECT rowid FROM {g.config['db']['domains_table_name']} WHERE name=?",
-            [domain],
+            f"SELECT rowid FROM {g.config['db']['domains_table_name']} WHERE lower(name)=?",
+            [normalize_address(domain)],
         )
         row = result.fetchone()
-        if len(row) < 1:
-            raise Exception(f"Domain {domain} doesn't exist.")
+        if row is None:
+            raise ValueError(f"Domain {domain} doesn't exist.")
 
         return int(row[0])
 
@@ -150,15 +508,23 @@ class UserRepository(BaseRepository):
         """
         return quota * 1_000_000_000
 
+    @writes
     def create(
-        self, email: str, password: str, quota: int, pretty=True
+        self,
+        email: str,
+        password: Optional[str],
+        quota: int,
+        pretty=True,
+        password_hash: Optional[str] = None,
     ) -> Union[dict, Table]:
         """
         Create a new user using the parameters.
 
-        Password will be hashed before being being stored.
+        Password will be hashed before being being stored, unless the hash
+        is already given as password_hash.
         """
-        hashed_password = self._hash_password(password)
+        email = normalize_address(email)
+        hashed_password = password_hash or self._hash_password(password)
         domain_id = self._get_domain_id_from_email(email)
         quota_bytes = self._quota_gb_to_bytes(quota)
         result = self.cursor.execute(
@@ -170,23 +536,28 @@ class UserRepository(BaseRepository):
 
         return self._prettify_data() if pretty else self.data
 
+    @writes
     def edit(
         self,
         email: str,
         new_email: Optional[str] = None,
         password: Optional[str] = None,
         quota: Optional[int] = None,
+        password_hash: Optional[str] = None,
     ):
-        stmt = f"UPDATE {g.config['db']['users_table_name']} SET %s WHERE email=?"
+        stmt = (
+            f"UPDATE {g.config['db']['users_table_name']} SET %s WHERE lower(email)=?"
+        )
         placeholders = []
         bindings = []
         if new_email:
+            new_email = normalize_address(new_email)
             domain_id = self._get_domain_id_from_email(new_email)
             placeholders.append("domain_id=?")
             placeholders.append("email=?")
             bindings += [domain_id, new_email]
-        if password:
-            hashed_password = self._hash_password(password)
+        if password or password_hash:
+            hashed_password = password_hash or self._hash_password(password)
             placeholders.append("password=?")
             bindings.append(hashed_password)
         if quota:
@@ -196,31 +567,35 @@ class UserRepository(BaseRepository):
 
         stmt = stmt % ",".join(placeholders)
 
-        bindings.append(email)
+        bindings.append(normalize_address(email))
 
         self.cursor.execute(stmt, *[bindings])
         self.db_conn.commit()
 
+        if new_email or password or password_hash:
+            cache.credentials.invalidate(email)
+
+    @writes
     def delete(self, email: str):
         self.cursor.execute(
-            f"DELETE FROM {g.config['db']['users_table_name']} WHERE email=?", [email]
+            f"DELETE FROM {g.config['db']['users_table_name']} WHERE lower(email)=?",
+            [normalize_address(email)],
         )
         self.db_conn.commit()
+        cache.credentials.invalidate(email)
 
 
 class AliasRepository(BaseRepository):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.data["headers"] = ("ID (Row id)", "From", "To")
+    headers = ("ID (Row id)", "From", "To")
 
     def _get_domain_id(self, domain: str) -> int:
         result = self.cursor.execute(
-            f"SELECT rowid FROM {g.config['db']['domains_table_name']} WHERE name=?",
-            [domain],
+            f"SELECT rowid FROM {g.config['db']['domains_table_name']} WHERE lower(name)=?",
+            [normalize_address(domain)],
         )
         row = result.fetchone()
-        if len(row) < 1:
-            raise Exception(f"Domain {domain} doesn't exist.")
+        if row is None:
+            raise ValueError(f"Domain {domain} doesn't exist.")
 
         return int(row[0])
 
@@ -228,38 +603,122 @@ class AliasRepository(BaseRepository):
         _, domain = email.split("@")
         return self._get_domain_id(domain)
 
-    def index(self, domain: Optional[str] = None, pretty=True) -> Union[dict, Table]:
+    def _set_targets(self, alias_id: int, to_address: Optional[str]):
+        """
+        Keep the lookup table in sync for aliases with several targets.
+
+        Single target aliases are found through the index on to_address.
+        """
+        targets_table = alias_targets_table_name()
+        self.cursor.execute(
+            f"DELETE FROM {targets_table} WHERE alias_id=?",
+            [alias_id],
+        )
+        if to_address and "," in to_address:
+            self.cursor.executemany(
+                f"INSERT INTO {targets_table} VALUES (?,?)",
+                [(alias_id, target) for target in split_alias_targets(to_address)],
+            )
+
+    def index(
+        self,
+        domain: Optional[str] = None,
+        to_address: Optional[str] = None,
+        pretty=True,
+    ) -> Union[dict, Table]:
         """
         List all aliases.
 
         If domain is provided, filter the list to show only this domain's aliases.
+
+        If to_address is provided, show only aliases delivering to this address.
         """
-        stmt = f"SELECT rowid, from_address, to_address FROM {g.config['db']['aliases_table_name']}"
+        aliases_table = g.config["db"]["aliases_table_name"]
+        stmt = f"SELECT rowid, from_address, to_address FROM {aliases_table}"
+        conditions = []
+        bindings = []
         if domain:
             domain_id = self._get_domain_id(domain)
-            stmt += f" WHERE domain_id={domain_id}"
+            conditions.append(f"domain_id={domain_id}")
+        if to_address:
+            to_address = normalize_address(to_address)
+            conditions.append(
+                f"(to_address=? OR rowid IN (SELECT alias_id FROM {alias_targets_table_name()} WHERE address=?))"
+            )
+            bindings += [to_address, to_address]
+        if conditions:
+            stmt += " WHERE " + " AND ".join(conditions)
 
-        result = self.cursor.execute(stmt)
+        result = self.cursor.execute(stmt, bindings)
+        # resolve() and check() replace the headers.
+        self.data["headers"] = self.headers
         self.data["rows"] = result.fetchall()
 
         return self._prettify_data() if pretty else self.data
 
+    def search(
+        self,
+        pattern: str,
+        to: bool = False,
+        limit: Optional[int] = DEFAULT_SEARCH_LIMIT,
+        pretty=True,
+    ) -> Union[dict, Table]:
+        """
+        Return up to limit aliases whose from address matches the glob pattern.
+
+        If to is true, match the targets instead, aliases with several
+        targets match if one of them does. See UserRepository.search.
+        """
+        aliases_table = g.config["db"]["aliases_table_name"]
+        if to:
+            columns, column = "rowid, to_address, from_address", "to_address"
+        else:
+            columns, column = "rowid, from_address, to_address", "from_address"
+        rows = self._search(aliases_table, columns, column, pattern, limit, split=to)
+        self.data["headers"] = self.headers
+        self.data["rows"] = (
+            [
+                (rowid, from_address, to_address)
+                for rowid, to_address, from_address in rows
+            ]
+            if to
+            else rows
+        )
+        return self._prettify_data() if pretty else self.data
+
+    def iterate(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """
+        Yield (rowid, from_address, to_address) for every alias without
+        loading the table.
+        """
+        return self._iterate(
+            g.config["db"]["aliases_table_name"],
+            "from_address, to_address",
+            batch_size,
+        )
+
+    @writes
     def create(
         self, from_address: str, to_address: str, pretty=True
     ) -> Union[dict, Table]:
         """
         Create a new alias pointing from from_address to to_address.
         """
+        from_address = normalize_address(from_address)
+        to_address = normalize_address(to_address)
         domain_id = self._get_domain_id_from_email(from_address)
         result = self.cursor.execute(
             f"INSERT INTO {g.config['db']['aliases_table_name']} VALUES (?,?,?) RETURNING rowid, from_address, to_address",
             [domain_id, from_address, to_address],
         )
         self.data["rows"] = result.fetchall()
+        for alias_id, _, _ in self.data["rows"]:
+            self._set_targets(alias_id, to_address)
         self.db_conn.commit()
 
         return self._prettify_data() if pretty else self.data
 
+    @writes
     def edit(
         self,
         from_address: str,
@@ -267,12 +726,14 @@ class AliasRepository(BaseRepository):
         to_address: Optional[str] = None,
         pretty=True,
     ) -> Union[dict, Table]:
-        stmt = f"UPDATE {g.config['db']['aliases_table_name']} SET %s WHERE from_address=? RETURNING rowid, from_address, to_address"
+        stmt = f"UPDATE {g.config['db']['aliases_table_name']} SET %s WHERE lower(from_address)=? RETURNING rowid, from_address, to_address"
         placeholders = []
         bindings = []
+        from_address = normalize_address(from_address)
         if new_from:
+            new_from = normalize_address(new_from)
             _, old_domain = from_address.split("@")
-            _, new_domain = from_address.split("@")
+            _, new_domain = new_from.split("@")
             if old_domain != new_domain:
                 domain_id = self._get_domain_id_from_email(new_from)
                 placeholders.append("domain_id=?")
@@ -281,6 +742,7 @@ class AliasRepository(BaseRepository):
             bindings.append(new_from)
 
         if to_address:
+            to_address = normalize_address(to_address)
             placeholders.append("to_address=?")
             bindings.append(to_address)
 
@@ -288,13 +750,206 @@ class AliasRepository(BaseRepository):
         bindings.append(from_address)
         result = self.cursor.execute(stmt, bindings)
         self.data["rows"] = result.fetchall()
+        if to_address:
+            for alias_id, _, _ in self.data["rows"]:
+                self._set_targets(alias_id, to_address)
         self.db_conn.commit()
 
         return self._prettify_data() if pretty else self.data
 
+    @writes
     def delete(self, from_address: str):
-        self.cursor.execute(
-            f"DELETE FROM {g.config['db']['aliases_table_name']} WHERE from_address=?",
-            [from_address],
+        result = self.cursor.execute(
+            f"DELETE FROM {g.config['db']['aliases_table_name']} WHERE lower(from_address)=? RETURNING rowid",
+            [normalize_address(from_address)],
         )
+        for (alias_id,) in result.fetchall():
+            self._set_targets(alias_id, None)
         self.db_conn.commit()
+
+    def resolve(
+        self, address: str, max_depth: int = MAX_ALIAS_DEPTH, pretty=True
+    ) -> Union[dict, Table]:
+        """
+        Follow the alias chain starting at address and return every final target.
+
+        The whole chain is expanded by a single recursive query. Each target is
+        reported as a local mailbox, an external address, a dangling address on
+        one of our domains with no mailbox, a cycle, or an alias too deep to
+        be followed past max_depth.
+        """
+        aliases = g.config["db"]["aliases_table_name"]
+        users = g.config["db"]["users_table_name"]
+        domains = g.config["db"]["domains_table_name"]
+        # Rows with a NULL address hold a comma separated list still to be
+        # split, rows with an address are nodes to expand through the aliases.
+        # Addresses are lowered as they're split and compared with lower() of
+        # the columns, like every other lookup, over the case-insensitive
+        # indexes.
+        stmt = f"""
+            WITH RECURSIVE walk(address, rest, depth, path) AS (
+                SELECT NULL, :address, 0, ','
+                UNION ALL
+                SELECT
+                    CASE WHEN walk.address IS NULL AND k.n = 0 THEN
+                        lower(trim(substr(walk.rest, 1, instr(walk.rest || ',', ',') - 1)))
+                    END,
+                    CASE WHEN walk.address IS NOT NULL THEN a.to_address
+                        WHEN k.n = 1 THEN substr(walk.rest, instr(walk.rest || ',', ',') + 1)
+                    END,
+                    walk.depth + (walk.address IS NOT NULL),
+                    CASE WHEN walk.address IS NULL THEN walk.path
+                        ELSE walk.path || walk.address || ','
+                    END
+                FROM walk
+                JOIN (SELECT 0 AS n UNION ALL SELECT 1) AS k
+                LEFT JOIN {aliases} AS a
+                    ON walk.address IS NOT NULL AND lower(a.from_address) = walk.address
+                WHERE (walk.address IS NULL AND walk.rest <> '')
+                    OR (walk.address IS NOT NULL AND k.n = 0 AND a.rowid IS NOT NULL
+                        AND walk.depth < :max_depth
+                        AND instr(walk.path, ',' || walk.address || ',') = 0)
+            )
+            SELECT
+                walk.address,
+                walk.path,
+                walk.depth,
+                a.rowid IS NOT NULL,
+                instr(walk.path, ',' || walk.address || ',') > 0,
+                substr(walk.path, -length(walk.address) - 2) = ',' || walk.address || ',',
+                u.rowid IS NOT NULL,
+                d.rowid IS NOT NULL
+            FROM walk
+            LEFT JOIN {aliases} AS a ON lower(a.from_address) = walk.address
+            LEFT JOIN {users} AS u ON lower(u.email) = walk.address
+            LEFT JOIN {domains} AS d
+                ON lower(d.name) = substr(walk.address, instr(walk.address, '@') + 1)
+            WHERE walk.address IS NOT NULL AND walk.address <> ''
+        """
+        result = self.cursor.execute(
+            stmt, {"address": normalize_address(address), "max_depth": max_depth}
+        )
+
+        rows = {}
+        for row in result:
+            target, path, depth, is_alias, seen, self_reference, is_user, is_local = row
+            if is_alias and not seen:
+                if depth < max_depth:
+                    # Expanded further down the chain.
+                    continue
+                status = "too deep"
+            elif seen and not self_reference:
+                status = "cycle"
+            elif is_user:
+                status = "mailbox"
+            elif is_local:
+                status = "dangling"
+            else:
+                status = "external"
+            via = " -> ".join(path.strip(",").split(",")) if path != "," else ""
+            rows.setdefault((target, status), via)
+
+        self.data["headers"] = ("Address", "Status", "Via")
+        self.data["rows"] = [
+            (target, status, via) for (target, status), via in sorted(rows.items())
+        ]
+        return self._prettify_data() if pretty else self.data
+
+    def check(self, pretty=True) -> Union[dict, Table]:
+        """
+        Find cycles and dangling targets across every alias.
+
+        Each table is read once and the alias graph is resolved in memory, so
+        the cost doesn't depend on how long the chains are.
+        """
+        users = {
+            row[0]
+            for row in self.cursor.execute(
+                f"SELECT lower(email) FROM {g.config['db']['users_table_name']}"
+            )
+        }
+        domains = {
+            row[0]
+            for row in self.cursor.execute(
+                f"SELECT lower(name) FROM {g.config['db']['domains_table_name']}"
+            )
+        }
+        # Addresses are compared in lower case, like the MTA looks them up.
+        graph = {}
+        for from_address, to_address in self.cursor.execute(
+            f"SELECT lower(from_address), lower(to_address) FROM {g.config['db']['aliases_table_name']}"
+        ):
+            graph.setdefault(from_address, []).extend(split_alias_targets(to_address))
+
+        # Tarjan's strongly connected components, iteratively. Components are
+        # emitted after every component reachable from them.
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        component_of = {}
+        components = []
+        counter = 0
+        for root in graph:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, child = work.pop()
+                if child == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack.add(node)
+                targets = graph[node]
+                while child < len(targets):
+                    target = targets[child]
+                    child += 1
+                    if target == node or target not in graph:
+                        continue
+                    if target not in index:
+                        work.append((node, child))
+                        work.append((target, 0))
+                        break
+                    if target in on_stack:
+                        lowlink[node] = min(lowlink[node], index[target])
+                else:
+                    if lowlink[node] == index[node]:
+                        members = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component_of[member] = len(components)
+                            members.append(member)
+                            if member == node:
+                                break
+                        components.append(members)
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+        # Only dangling targets are propagated up the chains; carrying every
+        # final mailbox along would make wide distribution lists quadratic.
+        rows = []
+        dangling = []
+        for members in components:
+            component_dangling = set()
+            for member in members:
+                for target in graph[member]:
+                    if target == member or target not in graph:
+                        if target not in users and target.rpartition("@")[2] in domains:
+                            component_dangling.add(target)
+                    elif component_of[target] != component_of[member]:
+                        component_dangling |= dangling[component_of[target]]
+            dangling.append(component_dangling)
+
+            if len(members) > 1:
+                detail = ", ".join(sorted(members))
+                rows += [(member, "cycle", detail) for member in members]
+            if component_dangling:
+                detail = ", ".join(sorted(component_dangling))
+                rows += [(member, "dangling", detail) for member in members]
+
+        self.data["headers"] = ("From", "Problem", "Detail")
+        self.data["rows"] = sorted(rows)
+        return self._prettify_data() if pretty else self.data
@@ -8,6 +8,7 @@ def get_default_config() -> configparser.ConfigParser:
     config = configparser.ConfigParser()
     config["mail"] = {
         "vmail_directory": "/var/vmail",
+        "usage_index_path": "/var/local/mailiness-usage.db",
     }
     config["db"] = {
         "connection_string": "/var/local/mailserver.db",
@@ -55,3 +56,17 @@ RSA_PUBLIC_EXPONENT = 65537
 
 # Use 2048 for maximum compatibility as at year 2022.
 DKIM_KEY_SIZE = 2048
+
+# Defaults the command line shows, kept here so building its parser doesn't
+# import the modules using them.
+
+# Rows each migration backfill transaction touches.
+MIGRATION_BATCH_SIZE = 2000
+
+# Where the HTTP API listens, only reachable from this machine.
+API_BIND = "127.0.0.1:8025"
+
+EXPORT_FORMATS = ("jsonl",)
+
+# Export compressions and the modules implementing them.
+EXPORT_COMPRESSIONS = {"gzip": "gzip", "bz2": "bz2", "xz": "lzma"}
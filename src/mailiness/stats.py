@@ -0,0 +1,77 @@
+from typing import Optional
+
+from mailiness import g
+
+from . import dkim, repo
+
+HEADERS = ("Domain", "Users", "Aliases", "Quota (GB)", "DKIM")
+
+
+def dkim_status(domain: str, dkim_map: dict, key_files: set) -> str:
+    """
+    The domain's DKIM selector, "no key file" if its key is gone or "none".
+    """
+    selector = dkim_map.get(domain)
+    if selector is None:
+        return "none"
+    if f"{domain}.{selector}.key" not in key_files:
+        return "no key file"
+    return selector
+
+
+def domain_stats(conn=None, domain: Optional[str] = None) -> list[tuple]:
+    """
+    Return (domain, users, aliases, quota in bytes, DKIM status) per domain.
+
+    Users and aliases are counted with a single GROUP BY query each, over
+    the domain_id indexes, and joined with the DKIM map in memory. If domain
+    is given only its row is returned.
+    """
+    conn = conn if conn is not None else repo.get_db_conn(read_only=True)
+    cursor = conn.cursor()
+    domains_table = g.config["db"]["domains_table_name"]
+    condition = ""
+    bindings = []
+    if domain:
+        condition = f" WHERE domain_id = (SELECT rowid FROM {domains_table} WHERE lower(name)=?)"
+        bindings = [repo.normalize_address(domain)]
+
+    domains = cursor.execute(
+        f"SELECT rowid, name FROM {domains_table}"
+        + (" WHERE lower(name)=?" if domain else "")
+        + " ORDER BY name",
+        bindings,
+    ).fetchall()
+    if domain and not domains:
+        raise ValueError(f"Domain {domain} doesn't exist.")
+    users = {
+        domain_id: (count, quota)
+        for domain_id, count, quota in cursor.execute(
+            f"SELECT domain_id, count(*), total(quota) FROM {g.config['db']['users_table_name']}"
+            f"{condition} GROUP BY domain_id",
+            bindings,
+        )
+    }
+    aliases = dict(
+        cursor.execute(
+            f"SELECT domain_id, count(*) FROM {g.config['db']['aliases_table_name']}"
+            f"{condition} GROUP BY domain_id",
+            bindings,
+        )
+    )
+
+    dkim_map = dkim.read_dkim_map()
+    key_files = dkim.list_key_files()
+    rows = []
+    for domain_id, name in domains:
+        user_count, quota = users.get(domain_id, (0, 0))
+        rows.append(
+            (
+                name,
+                user_count,
+                aliases.get(domain_id, 0),
+                int(quota),
+                dkim_status(name, dkim_map, key_files),
+            )
+        )
+    return rows
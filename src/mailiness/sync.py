@@ -0,0 +1,284 @@
+import json
+from typing import Union
+
+from mailiness import g
+
+from . import cache, repo
+
+
+def load_inventory(path: str) -> dict:
+    """
+    Read the desired state from a JSON inventory file.
+
+    The inventory looks like::
+
+        {
+            "domains": ["smith.com"],
+            "users": [
+                {"email": "john@smith.com", "password": "secret", "quota": 10}
+            ],
+            "aliases": [{"from": "info@smith.com", "to": "john@smith.com"}]
+        }
+
+    Users may give a password_hash instead of a plaintext password. Alias
+    targets may be a list instead of a comma separated string.
+
+    Plaintext passwords are only compared with those of existing users when
+    asked to, since each comparison costs a bcrypt verification. Otherwise
+    change them through password_hash.
+    """
+    with open(path, "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def _alias_to_address(to_address: Union[str, list]) -> str:
+    if isinstance(to_address, list):
+        return ",".join(to_address)
+    return to_address
+
+
+class Synchronizer:
+    """
+    Bring the domains, users and aliases tables to the state described by an inventory.
+
+    Current state is loaded with one query per table and compared to the
+    inventory with dict and set operations.
+    """
+
+    def __init__(self, conn=None, delete: bool = True, check_passwords: bool = False):
+        self.db_conn = conn if conn is not None else repo.get_db_conn()
+        self.cursor = self.db_conn.cursor()
+        self.user_repo = repo.UserRepository(conn=self.db_conn)
+        self.delete = delete
+        self.check_passwords = check_passwords
+
+    def _desired(self, inventory: dict) -> tuple:
+        domains = {
+            repo.normalize_address(name) for name in inventory.get("domains", [])
+        }
+        users = {}
+        for user in inventory.get("users", []):
+            if not isinstance(user.get("email"), str) or "@" not in user["email"]:
+                raise ValueError(f"User {user} has no valid email.")
+            email = repo.normalize_address(user["email"])
+            if email.split("@")[1] not in domains:
+                raise ValueError(f"User {email} belongs to an unlisted domain.")
+            if "password" not in user and "password_hash" not in user:
+                raise ValueError(f"User {email} has no password or password_hash.")
+            quota = user.get("quota")
+            if isinstance(quota, bool) or not isinstance(quota, (int, float)):
+                raise ValueError(f"User {email} has no quota or it isn't a number.")
+            users[email] = user
+        aliases = {}
+        for alias in inventory.get("aliases", []):
+            if not isinstance(alias.get("from"), str) or "@" not in alias["from"]:
+                raise ValueError(f"Alias {alias} has no valid from address.")
+            if not alias.get("to"):
+                raise ValueError(f"Alias {alias['from']} has no to address.")
+            from_address = repo.normalize_address(alias["from"])
+            if from_address.split("@")[1] not in domains:
+                raise ValueError(f"Alias {from_address} belongs to an unlisted domain.")
+            aliases[from_address] = repo.normalize_address(
+                _alias_to_address(alias["to"])
+            )
+        return domains, users, aliases
+
+    def _current(self) -> tuple:
+        domains = {
+            name
+            for (name,) in self.cursor.execute(
+                f"SELECT name FROM {g.config['db']['domains_table_name']}"
+            )
+        }
+        users = {
+            email: (password_hash, int(quota or 0))
+            for email, password_hash, quota in self.cursor.execute(
+                f"SELECT email, password, quota FROM {g.config['db']['users_table_name']}"
+            )
+        }
+        aliases = dict(
+            self.cursor.execute(
+                f"SELECT from_address, to_address FROM {g.config['db']['aliases_table_name']}"
+            )
+        )
+        return domains, users, aliases
+
+    def _password_changed(self, user: dict, password_hash: str) -> bool:
+        if "password_hash" in user:
+            return user["password_hash"] != password_hash
+        if not self.check_passwords:
+            return False
+        return not self.user_repo.verify_password(user["password"], password_hash)
+
+    def plan(self, inventory: dict) -> dict:
+        """
+        Return the changes needed to reach the inventory's state.
+
+        Passwords never appear in the plan, only the names of changed fields.
+        """
+        domains, users, aliases = self._desired(inventory)
+        current_domains, current_users, current_aliases = self._current()
+
+        user_updates = []
+        for email in sorted(users.keys() & current_users.keys()):
+            password_hash, quota = current_users[email]
+            fields = []
+            if self._password_changed(users[email], password_hash):
+                fields.append("password")
+            if self.user_repo._quota_gb_to_bytes(users[email]["quota"]) != quota:
+                fields.append("quota")
+            if fields:
+                user_updates.append({"email": email, "fields": fields})
+
+        plan = {
+            "domains": {"create": sorted(domains - current_domains), "delete": []},
+            "users": {
+                "create": sorted(users.keys() - current_users.keys()),
+                "update": user_updates,
+                "delete": [],
+            },
+            "aliases": {
+                "create": sorted(aliases.keys() - current_aliases.keys()),
+                "update": sorted(
+                    from_address
+                    for from_address in aliases.keys() & current_aliases.keys()
+                    if aliases[from_address] != current_aliases[from_address]
+                ),
+                "delete": [],
+            },
+        }
+        if self.delete:
+            plan["domains"]["delete"] = sorted(current_domains - domains)
+            plan["users"]["delete"] = sorted(current_users.keys() - users.keys())
+            plan["aliases"]["delete"] = sorted(current_aliases.keys() - aliases.keys())
+        return plan
+
+    def apply(self, inventory: dict) -> dict:
+        """
+        Plan and apply the changes in a single transaction, then return the plan.
+
+        Only new and changed plaintext passwords are hashed.
+        """
+        plan = self.plan(inventory)
+        _, users, aliases = self._desired(inventory)
+        domains_table = g.config["db"]["domains_table_name"]
+        users_table = g.config["db"]["users_table_name"]
+        aliases_table = g.config["db"]["aliases_table_name"]
+        targets_table = repo.alias_targets_table_name()
+
+        def password_hash(email: str) -> str:
+            user = users[email]
+            if "password_hash" in user:
+                return user["password_hash"]
+            return self.user_repo._hash_password(user["password"])
+
+        def quota(email: str) -> int:
+            return self.user_repo._quota_gb_to_bytes(users[email]["quota"])
+
+        # bcrypt is slow, hash before the first statement takes the write lock.
+        password_hashes = {
+            email: password_hash(email)
+            for email in plan["users"]["create"]
+            + [
+                update["email"]
+                for update in plan["users"]["update"]
+                if "password" in update["fields"]
+            ]
+        }
+
+        try:
+            # Deletions go first so a renamed address can be recreated.
+            deleted_aliases = [(address,) for address in plan["aliases"]["delete"]]
+            changed_aliases = deleted_aliases + [
+                (address,) for address in plan["aliases"]["update"]
+            ]
+            self.cursor.executemany(
+                f"DELETE FROM {targets_table} WHERE alias_id IN "
+                f"(SELECT rowid FROM {aliases_table} WHERE from_address=?)",
+                changed_aliases,
+            )
+            self.cursor.executemany(
+                f"DELETE FROM {aliases_table} WHERE from_address=?", deleted_aliases
+            )
+            self.cursor.executemany(
+                f"DELETE FROM {users_table} WHERE email=?",
+                [(email,) for email in plan["users"]["delete"]],
+            )
+            # Users and aliases of deleted domains are unlisted, so they're
+            # already gone.
+            self.cursor.executemany(
+                f"DELETE FROM {domains_table} WHERE name=?",
+                [(name,) for name in plan["domains"]["delete"]],
+            )
+
+            self.cursor.executemany(
+                f"INSERT INTO {domains_table} VALUES (?)",
+                [(name,) for name in plan["domains"]["create"]],
+            )
+            domain_ids = {
+                name: rowid
+                for rowid, name in self.cursor.execute(
+                    f"SELECT rowid, name FROM {domains_table}"
+                )
+            }
+
+            self.cursor.executemany(
+                f"INSERT INTO {users_table} VALUES (?,?,?,?)",
+                [
+                    (
+                        domain_ids[email.split("@")[1]],
+                        email,
+                        password_hashes[email],
+                        quota(email),
+                    )
+                    for email in plan["users"]["create"]
+                ],
+            )
+            password_updates = []
+            quota_updates = []
+            for update in plan["users"]["update"]:
+                email = update["email"]
+                if "password" in update["fields"]:
+                    password_updates.append((password_hashes[email], email))
+                if "quota" in update["fields"]:
+                    quota_updates.append((quota(email), email))
+            self.cursor.executemany(
+                f"UPDATE {users_table} SET password=? WHERE email=?", password_updates
+            )
+            self.cursor.executemany(
+                f"UPDATE {users_table} SET quota=? WHERE email=?", quota_updates
+            )
+
+            self.cursor.executemany(
+                f"INSERT INTO {aliases_table} VALUES (?,?,?)",
+                [
+                    (domain_ids[address.split("@")[1]], address, aliases[address])
+                    for address in plan["aliases"]["create"]
+                ],
+            )
+            self.cursor.executemany(
+                f"UPDATE {aliases_table} SET to_address=? WHERE from_address=?",
+                [(aliases[address], address) for address in plan["aliases"]["update"]],
+            )
+            self.cursor.executemany(
+                f"INSERT INTO {targets_table} SELECT rowid, ? FROM {aliases_table} WHERE from_address=?",
+                [
+                    (target, address)
+                    for address in plan["aliases"]["create"] + plan["aliases"]["update"]
+                    if "," in aliases[address]
+                    for target in repo.split_alias_targets(aliases[address])
+                ],
+            )
+        except Exception:
+            self.db_conn.rollback()
+            raise
+        self.db_conn.commit()
+
+        for email in plan["users"]["delete"]:
+            cache.credentials.invalidate(email)
+        for update in plan["users"]["update"]:
+            cache.credentials.invalidate(update["email"])
+        if plan["domains"]["delete"]:
+            cache.credentials.clear()
+
+        return plan
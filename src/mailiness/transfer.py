@@ -0,0 +1,178 @@
+import importlib
+import json
+import sqlite3
+import sys
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from mailiness import g
+
+from . import cache, migrations, repo, settings
+
+FORMATS = settings.EXPORT_FORMATS
+
+COMPRESSIONS = {
+    name: importlib.import_module(module)
+    for name, module in settings.EXPORT_COMPRESSIONS.items()
+}
+
+EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+MAGIC_NUMBERS = {b"\x1f\x8b": "gzip", b"BZh": "bz2", b"\xfd7zXZ": "xz"}
+
+
+def compression_from_path(path: str) -> Optional[str]:
+    for extension, compression in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def open_output(path: str, compression: Optional[str] = None) -> BinaryIO:
+    """
+    Open path, or stdout if path is "-", for writing, compressed if asked to.
+    """
+    if path == "-":
+        raw = sys.stdout.buffer
+        return COMPRESSIONS[compression].open(raw, "wb") if compression else raw
+    if compression:
+        return COMPRESSIONS[compression].open(path, "wb")
+    return open(path, "wb")
+
+
+def open_input(path: str) -> BinaryIO:
+    """
+    Open path, or stdin if path is "-", for reading.
+
+    Compression is detected from the first bytes of the stream.
+    """
+    stream = sys.stdin.buffer if path == "-" else open(path, "rb")
+    head = stream.peek(6)
+    for magic, compression in MAGIC_NUMBERS.items():
+        if head.startswith(magic):
+            if path == "-":
+                return COMPRESSIONS[compression].open(stream, "rb")
+            # Opening by name lets closing the decompressor close the file.
+            stream.close()
+            return COMPRESSIONS[compression].open(path, "rb")
+    return stream
+
+
+def iter_records(conn: sqlite3.Connection, batch_size: int = 1000) -> Iterator[dict]:
+    """
+    Yield every domain, then every user, then every alias as a dict.
+    """
+    for _, name in repo.DomainRepository(conn=conn).iterate(batch_size):
+        yield {"type": "domain", "name": name}
+    for _, email, password, quota in repo.UserRepository(conn=conn).iterate(batch_size):
+        yield {"type": "user", "email": email, "password": password, "quota": quota}
+    for _, from_address, to_address in repo.AliasRepository(conn=conn).iterate(
+        batch_size
+    ):
+        yield {"type": "alias", "from": from_address, "to": to_address}
+
+
+def export_all(conn: sqlite3.Connection, fp: BinaryIO, batch_size: int = 1000) -> int:
+    """
+    Write every record as a line of JSON to fp and return the number written.
+
+    The tables are read inside a single read transaction so the output is a
+    consistent snapshot, every user and alias comes with its domain. With a
+    rollback journal, writers wait for the export to finish. In WAL mode
+    they don't.
+    """
+    count = 0
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        for record in iter_records(conn, batch_size):
+            fp.write(json.dumps(record).encode("utf-8") + b"\n")
+            count += 1
+    finally:
+        if own_transaction:
+            conn.rollback()
+    return count
+
+
+def _batches(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_all(
+    conn: sqlite3.Connection, fp: BinaryIO, batch_size: int = 10_000
+) -> dict:
+    """
+    Insert the records read from fp and return how many of each type were imported.
+
+    Records are inserted batch_size at a time with executemany inside a
+    single transaction, so a failed import leaves the database untouched.
+    Users and aliases find their domain with a subquery instead of an
+    in-memory map, keeping memory use constant. Domains must come before
+    their users and aliases, as they do in export_all's output.
+    """
+    domains_table = g.config["db"]["domains_table_name"]
+    users_table = g.config["db"]["users_table_name"]
+    aliases_table = g.config["db"]["aliases_table_name"]
+    targets_table = repo.alias_targets_table_name()
+    domain_id = f"(SELECT rowid FROM {domains_table} WHERE name=?)"
+    statements = {
+        "domain": (
+            f"INSERT INTO {domains_table} VALUES (?)",
+            lambda record: (record["name"],),
+        ),
+        "user": (
+            f"INSERT INTO {users_table} VALUES ({domain_id},?,?,?)",
+            lambda record: (
+                record["email"].split("@")[1],
+                record["email"],
+                record["password"],
+                record["quota"],
+            ),
+        ),
+        "alias": (
+            f"INSERT INTO {aliases_table} VALUES ({domain_id},?,?)",
+            lambda record: (
+                record["from"].split("@")[1],
+                record["from"],
+                record["to"],
+            ),
+        ),
+    }
+    counts = {"domain": 0, "user": 0, "alias": 0}
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    try:
+        records = (json.loads(line) for line in fp if line.strip())
+        with migrations.search_indexes_suspended(cursor):
+            for batch in _batches(records, batch_size):
+                for record_type, (stmt, params) in statements.items():
+                    rows = [
+                        params(record)
+                        for record in batch
+                        if record["type"] == record_type
+                    ]
+                    if rows:
+                        cursor.executemany(stmt, rows)
+                        counts[record_type] += len(rows)
+                cursor.executemany(
+                    f"INSERT INTO {targets_table} SELECT rowid, ? FROM {aliases_table} WHERE from_address=?",
+                    [
+                        (target, record["from"])
+                        for record in batch
+                        if record["type"] == "alias" and "," in record["to"]
+                        for target in repo.split_alias_targets(record["to"])
+                    ],
+                )
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    cache.credentials.clear()
+    return counts
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import IsolatedAsyncioTestCase, mock
+
+import bcrypt
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import aio, connections, migrations  # noqa: E402
+
+fast_gensalt = bcrypt.gensalt
+
+
+class AioTest(IsolatedAsyncioTestCase):
+    def setUp(self):
+        dsn = os.path.join(tempfile.mkdtemp(), "mailserver.db")
+        provider = connections.ConnectionProvider(dsn)
+        migrations.migrate(provider.connection())
+        provider.release()
+        self.workers = aio.Workers(provider, readers=2, hashers=2)
+        self.domains = aio.DomainRepository(self.workers)
+        self.users = aio.UserRepository(self.workers)
+        self.aliases = aio.AliasRepository(self.workers)
+        patcher = mock.patch("bcrypt.gensalt", lambda: fast_gensalt(4))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.workers.close()
+
+    async def test_repositories(self):
+        await self.domains.create("smith.com")
+        data = await self.users.create("john@smith.com", "secret", 1)
+        self.assertEqual(data["rows"][0][1], "john@smith.com")
+        await self.aliases.create("info@smith.com", "john@smith.com")
+
+        self.assertEqual((await self.domains.index())["rows"], [(1, "smith.com")])
+        self.assertEqual(len((await self.users.index("smith.com"))["rows"]), 1)
+        resolved = await self.aliases.resolve("info@smith.com")
+        self.assertEqual(resolved["rows"][0][:2], ("john@smith.com", "mailbox"))
+        aliases = await self.aliases.index()
+        self.assertEqual(aliases["headers"], aio.repo.AliasRepository.headers)
+
+    async def test_passwords_are_hashed_off_the_writer(self):
+        await self.domains.create("smith.com")
+        await self.users.create("john@smith.com", "secret", 1)
+        self.assertTrue(await self.users.verify_password("john@smith.com", "secret"))
+        self.assertFalse(await self.users.verify_password("john@smith.com", "wrong"))
+        self.assertFalse(await self.users.verify_password("jane@smith.com", "secret"))
+
+        await self.users.edit("john@smith.com", password="changed")
+        self.assertTrue(await self.users.verify_password("john@smith.com", "changed"))
+
+    async def test_concurrent_requests(self):
+        await self.domains.create("smith.com")
+        await asyncio.gather(
+            *(self.users.create(f"user{i}@smith.com", "secret", 1) for i in range(50)),
+            *(self.users.index() for _ in range(50)),
+        )
+        self.assertEqual(len((await self.users.index())["rows"]), 50)
+
+    async def test_jobs_past_the_limit_wait_on_the_loop(self):
+        self.workers.close()
+        self.workers = aio.Workers(
+            connections.ConnectionProvider(), readers=1, pending_per_worker=1
+        )
+        release = threading.Event()
+        tasks = [
+            asyncio.ensure_future(self.workers.read(release.wait)) for _ in range(5)
+        ]
+        await asyncio.sleep(0.1)
+        # One job runs, the others haven't reached the executor.
+        self.assertEqual(self.workers._executors["read"]._work_queue.qsize(), 0)
+        release.set()
+        self.assertEqual(await asyncio.gather(*tasks), [True] * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,230 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.client import HTTPConnection
+from pathlib import Path
+from unittest import TestCase, mock
+
+import bcrypt
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import api, connections, migrations, repo  # noqa: E402
+
+fast_gensalt = bcrypt.gensalt
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        dsn = os.path.join(tempfile.mkdtemp(), "mailserver.db")
+        self.provider = connections.ConnectionProvider(dsn)
+        migrations.migrate(self.provider.connection())
+        self.provider.release()
+        self.server = api.ApiServer(
+            ("127.0.0.1", 0), api.Api(self.provider), quiet=True
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.conn = HTTPConnection(*self.server.server_address, timeout=10)
+        patcher = mock.patch("bcrypt.gensalt", lambda: fast_gensalt(4))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.provider.close()
+
+    def request(self, method: str, path: str, body=None) -> tuple:
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        self.conn.request(method, path, body=data, headers=headers)
+        response = self.conn.getresponse()
+        raw = response.read().decode("utf-8")
+        content_type = response.getheader("Content-Type", "")
+        if content_type == "application/x-ndjson":
+            return response.status, [json.loads(line) for line in raw.splitlines()]
+        if content_type == "application/json":
+            return response.status, json.loads(raw)
+        return response.status, raw
+
+    def test_crud_over_a_single_connection(self):
+        self.assertEqual(
+            self.request("POST", "/domains", {"name": "smith.com"}),
+            (201, {"id": 1, "name": "smith.com"}),
+        )
+        status, user = self.request(
+            "POST",
+            "/users",
+            {"email": "john@smith.com", "password": "secret", "quota": 2},
+        )
+        self.assertEqual(status, 201)
+        self.assertEqual(user["quota"], 2)
+        self.assertEqual(
+            self.request("POST", "/aliases", {"from": "a@smith.com", "to": "b@x.com"}),
+            (201, {"id": 1, "from": "a@smith.com", "to": "b@x.com"}),
+        )
+        self.assertEqual(
+            self.request("PATCH", "/users/john@smith.com", {"quota": 5})[0], 204
+        )
+        self.assertEqual(
+            self.request("GET", "/users"),
+            (200, [{"id": 1, "email": "john@smith.com", "quota": 5}]),
+        )
+        self.assertEqual(self.request("DELETE", "/aliases/a@smith.com")[0], 204)
+        self.assertEqual(self.request("GET", "/aliases"), (200, []))
+
+        self.assertEqual(self.request("GET", "/nothing")[0], 404)
+        status, error = self.request(
+            "POST", "/users", {"email": "jane@nowhere.com", "password": "x", "quota": 1}
+        )
+        self.assertEqual(status, 400)
+        self.assertIn("nowhere.com", error["error"])
+        self.assertEqual(
+            self.request("POST", "/domains", {"name": "smith.com"})[0], 409
+        )
+
+    def test_lists_are_streamed(self):
+        names = [f"domain{i}.com" for i in range(api.STREAM_BATCH_SIZE + 5)]
+        status, _ = self.request(
+            "POST",
+            "/bulk",
+            [
+                {"method": "POST", "path": "/domains", "body": {"name": n}}
+                for n in names
+            ],
+        )
+        self.assertEqual(status, 200)
+        status, domains = self.request("GET", "/domains")
+        self.assertEqual([domain["name"] for domain in domains], names)
+
+    def test_bulk_requests_are_all_or_nothing(self):
+        status, result = self.request(
+            "POST",
+            "/bulk",
+            [
+                {"method": "POST", "path": "/domains", "body": {"name": "smith.com"}},
+                {
+                    "method": "POST",
+                    "path": "/users",
+                    "body": {"email": "john@smith.com", "password": "s", "quota": 1},
+                },
+                {"method": "POST", "path": "/domains", "body": {"name": "smith.com"}},
+            ],
+        )
+        self.assertEqual(status, 409)
+        self.assertTrue(result["error"].startswith("Request 2:"))
+        self.assertEqual(self.request("GET", "/domains"), (200, []))
+        self.assertEqual(self.request("GET", "/users"), (200, []))
+
+        status, result = self.request(
+            "POST",
+            "/bulk",
+            [
+                {"method": "POST", "path": "/domains", "body": {"name": "smith.com"}},
+                {
+                    "method": "POST",
+                    "path": "/users",
+                    "body": {"email": "john@smith.com", "password": "s", "quota": 1},
+                },
+                {
+                    "method": "PATCH",
+                    "path": "/domains/smith.com",
+                    "body": {"name": "s.com"},
+                },
+            ],
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual([r["status"] for r in result["results"]], [201, 201, 200])
+        self.assertEqual(self.request("GET", "/users")[1][0]["email"], "john@s.com")
+
+    def test_renames_keep_existing_mail_directories(self):
+        self.request("POST", "/domains", {"name": "smith.com"})
+        vmail_directory = Path(g.config["mail"]["vmail_directory"])
+        (vmail_directory / "jones.com").mkdir(parents=True)
+        self.assertEqual(
+            self.request("PATCH", "/domains/Smith.COM", {"name": "jones.com"})[0], 409
+        )
+        self.assertEqual(
+            self.request("PATCH", "/domains/typo.com", {"name": "doe.com"})[0], 404
+        )
+        self.assertEqual(
+            self.request("PATCH", "/domains/Smith.COM", {"name": "Doe.com"}),
+            (200, {"id": 1, "name": "doe.com"}),
+        )
+
+    def test_dkim(self):
+        self.request("POST", "/domains", {"name": "smith.com"})
+        self.assertEqual(self.request("GET", "/dkim/smith.com")[0], 404)
+        with mock.patch("mailiness.dkim.debug", True):
+            status, key = self.request("POST", "/dkim/Smith.COM", {"selector": "s1"})
+            self.assertEqual(status, 201)
+            self.assertEqual((key["domain"], key["selector"]), ("smith.com", "s1"))
+            self.assertEqual(self.request("GET", "/dkim/smith.com"), (200, key))
+            self.assertEqual(self.request("DELETE", "/dkim/smith.com")[0], 204)
+        self.assertEqual(self.request("GET", "/dkim/smith.com")[0], 404)
+
+    def test_metrics(self):
+        self.request("GET", "/domains")
+        status, text = self.request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertIn("mailiness_sql_queries_total", text)
+
+    def test_passwords_are_hashed_outside_the_write_lock(self):
+        hash_password = repo.UserRepository._hash_password
+        lock_held = []
+
+        def record(user_repo, password):
+            acquired = []
+
+            def probe():
+                if self.provider.write_lock.acquire(blocking=False):
+                    acquired.append(True)
+                    self.provider.write_lock.release()
+
+            thread = threading.Thread(target=probe)
+            thread.start()
+            thread.join()
+            lock_held.append(not acquired)
+            return hash_password(user_repo, password)
+
+        self.request("POST", "/domains", {"name": "smith.com"})
+        with mock.patch.object(repo.UserRepository, "_hash_password", record):
+            user = {"email": "john@smith.com", "password": "secret", "quota": 1}
+            self.assertEqual(self.request("POST", "/users", user)[0], 201)
+            self.assertEqual(
+                self.request("PATCH", "/users/john@smith.com", {"password": "x"})[0],
+                204,
+            )
+        self.assertEqual(lock_held, [False, False])
+
+    def test_invalid_content_length(self):
+        self.conn.putrequest("POST", "/domains")
+        self.conn.putheader("Content-Length", "ten")
+        self.conn.endheaders()
+        response = self.conn.getresponse()
+        self.assertEqual(response.status, 400)
+        self.assertEqual(
+            json.loads(response.read()), {"error": "Invalid Content-Length."}
+        )
+
+    def test_is_loopback(self):
+        for host in ("localhost", "127.0.0.1", "127.1.2.3", "::1"):
+            self.assertTrue(api.is_loopback(host), host)
+        for host in ("", "0.0.0.0", "::", "192.168.1.10", "mail.example.com"):
+            self.assertFalse(api.is_loopback(host), host)
+
+
+if __name__ == "__main__":
+    unittest.main()
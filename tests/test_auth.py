@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import auth  # noqa: E402
+from mailiness.cache import CredentialCache  # noqa: E402
+from mailiness.repo import DomainRepository, UserRepository  # noqa: E402
+
+
+class CredentialCacheTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = CredentialCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_hit_requires_same_password_and_hash(self):
+        self.cache.put("john@smith.com", "secret", "hash1")
+        self.assertTrue(self.cache.get("john@smith.com", "secret", "hash1"))
+        self.assertFalse(self.cache.get("john@smith.com", "wrong", "hash1"))
+        self.assertFalse(self.cache.get("john@smith.com", "secret", "hash2"))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_plaintext_is_not_stored(self):
+        self.cache.put("john@smith.com", "secret", "hash1")
+        digest, _, _ = self.cache._entries["john@smith.com"]
+        self.assertNotIn(b"secret", digest)
+
+    def test_entries_expire(self):
+        self.cache.put("john@smith.com", "secret", "hash1")
+        self.now = 11
+        self.assertFalse(self.cache.get("john@smith.com", "secret", "hash1"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put("a@smith.com", "secret", "hash")
+        self.cache.put("b@smith.com", "secret", "hash")
+        self.cache.get("a@smith.com", "secret", "hash")
+        self.cache.put("c@smith.com", "secret", "hash")
+        self.assertTrue(self.cache.get("a@smith.com", "secret", "hash"))
+        self.assertFalse(self.cache.get("b@smith.com", "secret", "hash"))
+        self.assertEqual(self.cache.evictions, 1)
+
+
+class AuthenticatorTest(TestCase):
+    def setUp(self):
+        db_conn = sqlite3.connect(":memory:", check_same_thread=False)
+        db_conn.execute(
+            f"CREATE TABLE {test_config['db']['domains_table_name']}(name TEXT)"
+        )
+        db_conn.execute(
+            f"CREATE TABLE {test_config['db']['users_table_name']}(domain_id INTEGER, email TEXT, password TEXT, quota INTEGER)"
+        )
+        DomainRepository(conn=db_conn).create("smith.com")
+        self.user_repo = UserRepository(conn=db_conn)
+        self.user_repo.create("john@smith.com", "secret", 1)
+        self.cache = CredentialCache()
+        self.authenticator = auth.Authenticator(self.cache, conn=db_conn)
+
+    def test_successful_verification_is_cached(self):
+        self.assertTrue(self.authenticator.verify("john@smith.com", "secret"))
+        self.assertTrue(self.authenticator.verify("john@smith.com", "secret"))
+        self.assertEqual(self.authenticator.verifications, 1)
+        self.assertEqual(self.authenticator.stats()["cache_hits"], 1)
+
+    def test_wrong_password_and_unknown_user_fail(self):
+        self.assertFalse(self.authenticator.verify("john@smith.com", "wrong"))
+        self.assertFalse(self.authenticator.verify("jane@smith.com", "secret"))
+        self.assertEqual(self.authenticator.failures, 2)
+
+    def test_password_change_invalidates_cache(self):
+        self.assertTrue(self.authenticator.verify("john@smith.com", "secret"))
+        self.user_repo.edit("john@smith.com", password="newsecret")
+        self.assertFalse(self.authenticator.verify("john@smith.com", "secret"))
+        self.assertTrue(self.authenticator.verify("john@smith.com", "newsecret"))
+
+    def test_server_answers_auth_and_stats_requests(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), "auth.sock")
+        server = auth.AuthServer(socket_path, self.authenticator)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            self.assertEqual(
+                auth.request(socket_path, "AUTH\tjohn@smith.com\tsecret"), "OK"
+            )
+            self.assertEqual(
+                auth.request(socket_path, "AUTH\tjohn@smith.com\twrong"), "FAIL"
+            )
+            self.assertTrue(auth.request(socket_path, "STATS").startswith("STATS\t"))
+            self.assertIn(
+                "mailiness_auth_requests_total 2", auth.request_metrics(socket_path)
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
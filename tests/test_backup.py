@@ -0,0 +1,61 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import TestCase
+
+from mailiness import backup
+
+
+class BackupTest(TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.conn = sqlite3.connect(self.directory / "mailserver.db")
+        self.conn.execute("CREATE TABLE users(email TEXT)")
+        self.conn.executemany(
+            "INSERT INTO users VALUES (?)",
+            [(f"user{i}@smith.com" * 10,) for i in range(2000)],
+        )
+        self.conn.commit()
+
+    def test_backup_copies_in_steps(self):
+        dest = self.directory / "copy.db"
+        steps = []
+
+        pages, _ = backup.backup(
+            self.conn,
+            dest,
+            pages=5,
+            sleep=0,
+            progress=lambda copied, total: steps.append(copied),
+        )
+
+        self.assertGreater(len(steps), 1)
+        self.assertEqual(steps[-1], pages)
+        self.assertEqual(backup.verify(dest), [])
+        copy = sqlite3.connect(dest)
+        self.assertEqual(copy.execute("SELECT count(*) FROM users").fetchone(), (2000,))
+
+    def test_directory_backups_are_rotated(self):
+        backups = self.directory / "backups"
+        backups.mkdir()
+        for timestamp in ("20220101000000", "20220102000000", "20220103000000"):
+            (backups / f"mailiness-{timestamp}.db").touch()
+        (backups / "unrelated.db").touch()
+
+        dest = backup.get_backup_path(str(backups))
+        backup.backup(self.conn, dest, sleep=0)
+        deleted = backup.rotate(backups, keep=2)
+
+        self.assertEqual(
+            [path.name for path in deleted],
+            ["mailiness-20220101000000.db", "mailiness-20220102000000.db"],
+        )
+        self.assertEqual(
+            sorted(path.name for path in backups.iterdir()),
+            ["mailiness-20220103000000.db", dest.name, "unrelated.db"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
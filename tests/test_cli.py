@@ -1,3 +1,4 @@
+import os
 import sqlite3
 import tempfile
 import unittest
@@ -15,7 +16,7 @@ test_config = utils.get_test_config()
 
 g.config = test_config
 g.debug = True
-from mailiness import cli, dkim, repo  # noqa
+from mailiness import cli, dkim, migrations, repo  # noqa
 
 mock_settings = MagicMock()
 mock_settings.get_config.return_value = test_config
@@ -37,6 +38,7 @@ class CLITestCase(unittest.TestCase):
             f"CREATE TABLE {test_config['db']['aliases_table_name']}(domain_id INTEGER NOT NULL, from_address TEXT NOT NULL UNIQUE, to_address TEXT NOT NULL, FOREIGN KEY(domain_id) REFERENCES {test_config['db']['domains_table_name']}(rowid) ON DELETE CASCADE)"
         )
         db_conn.commit()
+        migrations.migrate(db_conn)
 
     def tearDown(self):
         self.cursor.execute(f"DROP TABLE {test_config['db']['aliases_table_name']}")
@@ -166,10 +168,27 @@ class DomainInterfaceTest(CLITestCase):
 
             self.assertTrue(pkey_file.exists())
 
+    def test_domain_add_dkim_uses_the_stored_name(self):
+        args = ["domain", "add", "Mixed.ORG", "--dkim", "--selector", "s1"]
+
+        with patch(
+            "mailiness.handlers.repo.DomainRepository", return_value=self.domain_repo
+        ), patch("mailiness.dkim.shutil"), patch("mailiness.dkim.subprocess"):
+            cli.main(args)
+
+        self.assertEqual(self.domain_repo.get_name("mixed.org"), "mixed.org")
+        self.assertEqual(dkim.read_dkim_map().get("mixed.org"), "s1")
+        key_directory = Path(g.config["spam"]["dkim_private_key_directory"])
+        self.assertTrue((key_directory / "mixed.org.s1.key").exists())
+
     def test_domain_edit_name_changes_name_in_db(self):
         args = ["domain", "edit", "name", self.domain_name, "example.com"]
 
-        with patch("mailiness.handlers.repo.DomainRepository") as mock_repo_class:
+        with patch(
+            "mailiness.handlers.repo.DomainRepository"
+        ) as mock_repo_class, patch(
+            "mailiness.handlers.g.config", new=utils.get_test_config()
+        ):
 
             mock_repo_class.return_value = self.domain_repo
             self.domain_repo.create(self.domain_name)
@@ -180,6 +199,73 @@ class DomainInterfaceTest(CLITestCase):
             row = result.fetchone()
             self.assertIn("example.com", row)
 
+    def test_domain_edit_name_moves_mailboxes_and_dkim_key(self):
+        args = ["domain", "edit", "name", self.domain_name, "example.com"]
+        selector = "myselector"
+        config = utils.get_test_config()
+        vmail_directory = Path(config["mail"]["vmail_directory"])
+        (vmail_directory / self.domain_name / "john").mkdir(parents=True)
+        dkim_private_key_dir = Path(config["spam"]["dkim_private_key_directory"])
+        (dkim_private_key_dir / f"{self.domain_name}.{selector}.key").touch()
+        with open(config["spam"]["dkim_maps_path"], "w") as fp:
+            fp.write(f"{self.domain_name} {selector}\n")
+
+        with patch(
+            "mailiness.handlers.repo.DomainRepository"
+        ) as mock_repo_class, patch("mailiness.handlers.g.config", new=config):
+            mock_repo_class.return_value = self.domain_repo
+            self.domain_repo.create(self.domain_name)
+
+            cli.main(args)
+
+            self.assertTrue((vmail_directory / "example.com" / "john").exists())
+            self.assertFalse((vmail_directory / self.domain_name).exists())
+            self.assertTrue(
+                (dkim_private_key_dir / f"example.com.{selector}.key").exists()
+            )
+            self.assertEqual(dkim.read_dkim_map(), {"example.com": selector})
+
+    def test_domain_edit_name_uses_the_stored_name(self):
+        args = ["domain", "edit", "name", self.domain_name.upper(), "Example.COM"]
+        config = utils.get_test_config()
+        vmail_directory = Path(config["mail"]["vmail_directory"])
+        (vmail_directory / self.domain_name / "john").mkdir(parents=True)
+
+        with patch(
+            "mailiness.handlers.repo.DomainRepository"
+        ) as mock_repo_class, patch("mailiness.handlers.g.config", new=config):
+            mock_repo_class.return_value = self.domain_repo
+            self.domain_repo.create(self.domain_name)
+
+            cli.main(args)
+
+            self.assertTrue((vmail_directory / "example.com" / "john").exists())
+            self.assertEqual(self._get_domain_row().fetchone(), ("example.com",))
+
+    def test_domain_edit_name_refuses_unknown_domains_and_existing_directories(self):
+        config = utils.get_test_config()
+        vmail_directory = Path(config["mail"]["vmail_directory"])
+        (vmail_directory / "example.com").mkdir(parents=True)
+
+        with patch(
+            "mailiness.handlers.repo.DomainRepository"
+        ) as mock_repo_class, patch("mailiness.handlers.g.config", new=config), patch(
+            "sys.stdout", new=StringIO()
+        ) as mock_stdout:
+            mock_repo_class.return_value = self.domain_repo
+            self.domain_repo.create(self.domain_name)
+
+            for old_name, message in (
+                ("typo.com", "doesn't exist"),
+                (self.domain_name, "already exists"),
+            ):
+                with self.assertRaises(SystemExit) as cm:
+                    cli.main(["domain", "edit", "name", old_name, "example.com"])
+                self.assertEqual(cm.exception.code, 1)
+                self.assertIn(message, mock_stdout.getvalue())
+
+            self.assertEqual(self._get_domain_row().fetchone(), (self.domain_name,))
+
     def test_domain_delete_removes_from_db(self):
         args = ["domain", "delete", self.domain_name, "--yes"]
 
@@ -264,6 +350,37 @@ class DomainInterfaceTest(CLITestCase):
 
             self.assertIn(self.domain_name, mock_stdout.getvalue())
 
+    def test_domain_list_with_profile(self):
+        with patch(
+            "mailiness.handlers.repo.DomainRepository"
+        ) as mock_repo_class, patch("sys.stdout", new=StringIO()) as mock_stdout, patch(
+            "sys.stderr", new=StringIO()
+        ) as mock_stderr:
+
+            mock_repo_class.return_value = self.domain_repo
+
+            cli.main(["--profile", "domain", "list"])
+
+            self.assertIn("Domains", mock_stdout.getvalue())
+            report = mock_stderr.getvalue()
+            self.assertIn("command", report)
+            self.assertIn("rendering", report)
+            self.assertIn("imports", report)
+
+    def test_metrics_file_is_written(self):
+        path = os.path.join(tempfile.mkdtemp(), "mailiness.prom")
+        with patch(
+            "mailiness.handlers.repo.DomainRepository"
+        ) as mock_repo_class, patch("sys.stdout", new=StringIO()):
+            mock_repo_class.return_value = self.domain_repo
+
+            cli.main(["--metrics-file", path, "domain", "list"])
+
+        with open(path) as fp:
+            text = fp.read()
+        self.assertIn("mailiness_command_success 1", text)
+        self.assertIn("mailiness_sql_queries_total{statement=", text)
+
 
 @patch("mailiness.cli.settings", mock_settings)
 class UserInterfaceTestCase(CLITestCase):
@@ -447,6 +564,35 @@ class UserInterfaceTestCase(CLITestCase):
 
             self.assertFalse(vmail_user_directory.exists())
 
+    def test_user_delete_mail_directory_of_mixed_case_address(self):
+        self.user_repo.create("jane@" + self.domain_name, "secret", 2)
+        vmail_user_directory = (
+            Path(test_config["mail"]["vmail_directory"]) / self.domain_name / "jane"
+        )
+        vmail_user_directory.mkdir(parents=True)
+
+        with patch(
+            "mailiness.handlers.repo.UserRepository", return_value=self.user_repo
+        ), patch("mailiness.handlers.g.config", new=test_config):
+            cli.main(["user", "delete", "Jane@Smith.COM", "--mail"])
+
+        self.assertEqual(self.user_repo.index(pretty=False)["rows"], [])
+        self.assertFalse(vmail_user_directory.exists())
+
+    def test_quota_report(self):
+        email = "john@" + self.domain_name
+        self.user_repo.create(email, "secret", 1)
+        mailbox_path = Path(g.config["mail"]["vmail_directory"]) / self.domain_name
+        (mailbox_path / "john" / "cur").mkdir(parents=True)
+        (mailbox_path / "john" / "cur" / "1.eml").write_bytes(b"x" * 1000)
+
+        with patch(
+            "mailiness.handlers.repo.UserRepository", return_value=self.user_repo
+        ), patch("sys.stdout", new=StringIO()) as fake_stdout:
+            cli.main(["quota", "report", "--domain", self.domain_name])
+
+            self.assertIn(email, fake_stdout.getvalue())
+
 
 @patch("mailiness.cli.settings", mock_settings)
 class AliasInterfaceTest(CLITestCase):
@@ -470,6 +616,18 @@ class AliasInterfaceTest(CLITestCase):
 
             self.assertIn("joe@west.com", mock_stdout.getvalue())
 
+    def test_alias_add_needs_a_migrated_database(self):
+        self.db_conn.execute("PRAGMA user_version=0")
+        with patch(
+            "mailiness.handlers.repo.AliasRepository", return_value=self.alias_repo
+        ), patch("sys.stdout", StringIO()) as mock_stdout:
+            with self.assertRaises(SystemExit) as cm:
+                cli.main(["alias", "add", self.from_address, "joe@west.com"])
+
+            self.assertEqual(cm.exception.code, 1)
+            self.assertIn("mailiness db migrate", mock_stdout.getvalue())
+        self.assertEqual(self.alias_repo.index(pretty=False)["rows"], [])
+
     def test_alias_edit_to_address(self):
         with patch(
             "mailiness.handlers.repo.AliasRepository", return_value=self.alias_repo
@@ -565,6 +723,57 @@ class AliasInterfaceTest(CLITestCase):
             self.assertIn("jane@" + domain, contents)
             self.assertNotIn(self.from_address, contents)
 
+    def test_alias_list_with_to_address(self):
+        self.alias_repo.create(self.from_address, "joe@gmail.net")
+        self.alias_repo.create(
+            "team@" + self.domain_name, "jack@gmail.net,joe@gmail.net"
+        )
+        self.alias_repo.create("info@" + self.domain_name, "jack@gmail.net")
+
+        args = ["alias", "list", "--to", "joe@gmail.net"]
+
+        with patch(
+            "mailiness.handlers.repo.AliasRepository", return_value=self.alias_repo
+        ), patch("sys.stdout", StringIO()) as mock_stdout:
+            cli.main(args)
+
+            contents = mock_stdout.getvalue()
+            self.assertIn(self.from_address, contents)
+            self.assertIn("team@" + self.domain_name, contents)
+            self.assertNotIn("info@" + self.domain_name, contents)
+
+
+class ChangesInterfaceTest(CLITestCase):
+    def test_changes_need_a_migrated_database(self):
+        self.db_conn.execute("PRAGMA user_version=3")
+        with patch(
+            "mailiness.handlers.repo.get_db_conn", return_value=self.db_conn
+        ), patch("sys.stdout", StringIO()) as mock_stdout, patch(
+            "sys.stderr", StringIO()
+        ) as mock_stderr:
+            with self.assertRaises(SystemExit) as cm:
+                cli.main(["changes", "since", "0"])
+            self.assertEqual(cm.exception.code, 1)
+            self.assertIn("mailiness db migrate", mock_stderr.getvalue())
+
+            with self.assertRaises(SystemExit) as cm:
+                cli.main(["changes", "head"])
+            self.assertEqual(cm.exception.code, 1)
+            self.assertIn("mailiness db migrate", mock_stdout.getvalue())
+
+
+class ApiInterfaceTest(unittest.TestCase):
+    def test_remote_bind_needs_to_be_allowed(self):
+        with patch("sys.stdout", StringIO()) as mock_stdout, patch(
+            "mailiness.api.ApiServer"
+        ) as mock_server:
+            with self.assertRaises(SystemExit) as cm:
+                cli.main(["api", "serve", "--bind", "0.0.0.0:8025"])
+
+            self.assertEqual(cm.exception.code, 2)
+            self.assertIn("--allow-remote", mock_stdout.getvalue())
+            mock_server.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import connections, migrations  # noqa: E402
+from mailiness.repo import DomainRepository, UserRepository  # noqa: E402
+
+
+class ConnectionProviderTest(TestCase):
+    def setUp(self):
+        self.dsn = os.path.join(tempfile.mkdtemp(), "mailserver.db")
+        self.provider = connections.ConnectionProvider(
+            self.dsn, max_connections=2, timeout=0.2
+        )
+
+    def tearDown(self):
+        self.provider.close()
+
+    def _in_thread(self, fn):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(fn()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_each_thread_gets_its_own_connection(self):
+        conn = self.provider.connection()
+        self.assertIs(self.provider.connection(), conn)
+        other = self._in_thread(self.provider.connection)
+        self.assertIsNot(other, conn)
+
+    def test_connections_are_reused_once_their_thread_ends(self):
+        first = self._in_thread(self.provider.connection)
+        second = self._in_thread(self.provider.connection)
+        self.assertIs(first, second)
+
+    def test_pool_is_bounded(self):
+        self.provider.connection()
+        holding = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            self.provider.connection()
+            holding.set()
+            done.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        holding.wait()
+        try:
+            self.assertIsInstance(
+                self._in_thread(self._connection_or_error), connections.PoolExhausted
+            )
+        finally:
+            done.set()
+            thread.join()
+
+    def _connection_or_error(self):
+        try:
+            return self.provider.connection()
+        except connections.PoolExhausted as e:
+            return e
+
+    def test_repository_is_shared_by_threads(self):
+        # Fewer connections than threads, some have to wait for one.
+        self.provider = connections.ConnectionProvider(self.dsn, max_connections=3)
+        migrations.migrate(self.provider.connection())
+        DomainRepository(provider=self.provider).create("smith.com")
+        user_repo = UserRepository(provider=self.provider)
+        user_repo._hash_password = lambda password: password
+        errors = []
+
+        def create_users(worker: int):
+            try:
+                for i in range(10):
+                    user_repo.create(f"user{worker}-{i}@smith.com", "secret", 1)
+                    user_repo.index(pretty=False)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.provider.release()
+
+        threads = [
+            threading.Thread(target=create_users, args=(worker,)) for worker in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(user_repo.index(pretty=False)["rows"]), 40)
+
+    def test_only_domain_renames_take_the_write_lock(self):
+        migrations.migrate(self.provider.connection())
+        domain_repo = DomainRepository(provider=self.provider)
+        domain_repo.create("smith.com")
+        renamed = threading.Event()
+
+        def rename():
+            domain_repo.edit("name", "smith.com", "jones.com")
+            renamed.set()
+
+        names = []
+        lookup = threading.Thread(
+            target=lambda: names.append(domain_repo.get_name("Smith.com"))
+        )
+        thread = threading.Thread(target=rename)
+        with self.provider.write_lock:
+            lookup.start()
+            lookup.join(1)
+            self.assertEqual(names, ["smith.com"])
+            thread.start()
+            self.assertFalse(renamed.wait(0.1))
+        thread.join()
+        self.assertEqual(domain_repo.get_name("jones.com"), "jones.com")
+
+
+class ReadOnlyConnectionTest(TestCase):
+    def setUp(self):
+        self.dsn = os.path.join(tempfile.mkdtemp(), "mail server.db")
+        self.writer = sqlite3.connect(self.dsn)
+        migrations.migrate(self.writer)
+        self.writer.execute("INSERT INTO domains VALUES ('smith.com')")
+        self.writer.commit()
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_reads_while_the_writer_holds_the_lock(self):
+        conn = connections.connect_read_only(self.dsn, timeout=0.1)
+        self.writer.execute("BEGIN IMMEDIATE")
+        self.writer.execute("INSERT INTO domains VALUES ('jones.com')")
+        data = DomainRepository(conn=conn).index(pretty=False)
+        self.assertEqual(data["rows"], [(1, "smith.com")])
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM domains")
+
+    def test_in_memory_databases_refuse_writes(self):
+        conn = connections.connect_read_only(":memory:")
+        self.assertEqual(conn.execute("PRAGMA query_only").fetchone(), (1,))
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("CREATE TABLE t(x)")
+
+    def test_uri(self):
+        self.assertEqual(
+            connections.read_only_uri("file:/var/mail.db?cache=shared"),
+            "file:/var/mail.db?cache=shared&mode=ro",
+        )
+        self.assertEqual(
+            connections.read_only_uri("/var/mail server.db"),
+            "file:/var/mail%20server.db?mode=ro",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
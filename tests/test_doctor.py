@@ -0,0 +1,96 @@
+import sqlite3
+import unittest
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import dkim, doctor, migrations  # noqa: E402
+from mailiness.repo import (  # noqa: E402
+    AliasRepository,
+    DomainRepository,
+    UserRepository,
+)
+
+
+class DoctorTest(TestCase):
+    def setUp(self):
+        self.config = utils.get_test_config()
+        self.original_config = g.config
+        g.config = self.config
+        self.db_conn = sqlite3.connect(":memory:")
+        migrations.migrate(self.db_conn)
+        DomainRepository(conn=self.db_conn).create("smith.com")
+        user_repo = UserRepository(conn=self.db_conn)
+        user_repo.create("john@smith.com", "secret", 1)
+        user_repo.create("jane@smith.com", "secret", 1)
+        AliasRepository(conn=self.db_conn).create("info@smith.com", "john@smith.com")
+
+        self.vmail_directory = Path(self.config["mail"]["vmail_directory"])
+        (self.vmail_directory / "smith.com" / "john" / "cur").mkdir(parents=True)
+        (self.vmail_directory / "smith.com" / "gone" / "cur").mkdir(parents=True)
+        (self.vmail_directory / "old.com" / "joe").mkdir(parents=True)
+        (self.vmail_directory / ".trash").mkdir()
+
+        key_directory = Path(self.config["spam"]["dkim_private_key_directory"])
+        (key_directory / "smith.com.20220101.key").write_text("key")
+        (key_directory / "old.com.20200101.key").write_text("key")
+        with open(self.config["spam"]["dkim_maps_path"], "w") as fp:
+            fp.write("smith.com 20220101\nmissing.com 20220101\n")
+
+    def tearDown(self):
+        g.config = self.original_config
+
+    def test_diagnose_reports_every_difference(self):
+        problems = doctor.Doctor(conn=self.db_conn).diagnose()
+
+        self.assertEqual(problems["users_without_mailbox"], ["jane@smith.com"])
+        self.assertEqual(
+            problems["mailboxes_without_user"], ["gone@smith.com", "joe@old.com"]
+        )
+        self.assertEqual(problems["domain_directories_without_domain"], ["old.com"])
+        self.assertEqual(problems["orphan_users"], [])
+        self.assertEqual(problems["orphan_aliases"], [])
+        self.assertEqual(problems["case_duplicates"], [])
+        self.assertEqual(problems["dkim_map_missing_key"], ["missing.com 20220101"])
+        self.assertEqual(problems["dkim_map_unknown_domain"], ["missing.com"])
+        self.assertEqual(problems["dkim_keys_unknown_domain"], ["old.com.20200101.key"])
+        self.assertEqual(problems["dkim_keys_not_in_map"], ["old.com.20200101.key"])
+
+    def test_diagnose_reports_case_duplicates(self):
+        # Written before addresses were normalised.
+        self.db_conn.execute("DROP INDEX users_email_lower_idx")
+        self.db_conn.execute(
+            "INSERT INTO users VALUES (1, 'John@Smith.com', 'secret', 1)"
+        )
+        problems = doctor.Doctor(conn=self.db_conn).diagnose()
+        self.assertEqual(
+            problems["case_duplicates"], ["John@Smith.com = john@smith.com"]
+        )
+
+    def test_fix_repairs_safe_problems(self):
+        self.db_conn.execute("DELETE FROM domains")
+        self.db_conn.commit()
+        checker = doctor.Doctor(conn=self.db_conn)
+
+        with patch("mailiness.doctor.subprocess"):
+            fixed = checker.fix(checker.diagnose())
+
+        self.assertEqual(fixed["orphan_users"], 2)
+        self.assertEqual(fixed["orphan_aliases"], 1)
+        self.assertFalse((self.vmail_directory / "smith.com" / "gone").exists())
+        self.assertEqual(dkim.read_dkim_map(), {"smith.com": "20220101"})
+
+        problems = checker.diagnose()
+        self.assertEqual(problems["orphan_users"], [])
+        self.assertEqual(problems["mailboxes_without_user"], ["john@smith.com"])
+        self.assertEqual(problems["dkim_map_missing_key"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
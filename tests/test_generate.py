@@ -0,0 +1,77 @@
+import sqlite3
+import unittest
+from pathlib import Path
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import dkim, generate, migrations, transfer  # noqa: E402
+from mailiness.repo import AliasRepository, UserRepository  # noqa: E402
+
+
+class GeneratorTest(TestCase):
+    def setUp(self):
+        self.config = utils.get_test_config()
+        self.original_config = g.config
+        g.config = self.config
+
+    def tearDown(self):
+        g.config = self.original_config
+
+    def _generate(self, seed: int = 0) -> tuple:
+        conn = sqlite3.connect(":memory:")
+        migrations.migrate(conn)
+        generator = generate.Generator(
+            domains=3, users_per_domain=4, aliases=20, seed=seed, conn=conn
+        )
+        return conn, generator, generator.run()
+
+    def test_same_seed_same_data(self):
+        first, _, counts = self._generate()
+        second, _, _ = self._generate()
+        third, _, _ = self._generate(seed=1)
+
+        self.assertEqual(counts, {"domains": 3, "users": 12, "aliases": 20})
+        records = list(transfer.iter_records(first))
+        self.assertEqual(records, list(transfer.iter_records(second)))
+        self.assertNotEqual(records, list(transfer.iter_records(third)))
+
+    def test_generated_users_can_log_in(self):
+        conn, _, _ = self._generate()
+        user_repo = UserRepository(conn=conn)
+        password_hash = user_repo.get_password_hash(generate.user_email(2, 3))
+        self.assertTrue(
+            user_repo.verify_password(generate.TEST_PASSWORD, password_hash)
+        )
+        alias_repo = AliasRepository(conn=conn)
+        self.assertEqual(alias_repo.check(pretty=False)["rows"], [])
+
+    def test_refuses_database_with_domains(self):
+        conn, generator, _ = self._generate()
+        with self.assertRaises(ValueError):
+            generator.run()
+
+    def test_maildirs_and_dkim_keys(self):
+        _, generator, _ = self._generate()
+
+        self.assertEqual(generator.create_maildirs(messages=2), 24)
+        # A fresh setup without a DKIM map.
+        dkim_maps_path = Path(self.config["spam"]["dkim_maps_path"])
+        dkim_maps_path.unlink()
+        self.assertEqual(generator.create_dkim_keys(), 3)
+        self.assertFalse(Path(f"{dkim_maps_path}.bak").exists())
+
+        cur = Path(self.config["mail"]["vmail_directory"]) / "domain1.test/user2/cur"
+        self.assertEqual(len(list(cur.iterdir())), 2)
+        self.assertEqual(
+            dkim.read_dkim_map(),
+            {generate.domain_name(i): "generated" for i in range(3)},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import sqlite3
+import unittest
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import journal, migrations  # noqa: E402
+from mailiness.repo import (  # noqa: E402
+    AliasRepository,
+    DomainRepository,
+    UserRepository,
+)
+
+
+class JournalTest(TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        migrations.migrate(self.db_conn)
+        self.user_repo = UserRepository(conn=self.db_conn)
+        self.user_repo._hash_password = lambda password: password
+
+    def _changes(self, seq: int = 0) -> list[tuple]:
+        return [row[1:5] for row in journal.since(self.db_conn, seq)]
+
+    def test_writes_are_journaled(self):
+        DomainRepository(conn=self.db_conn).create("smith.com")
+        self.user_repo.create("john@smith.com", "secret", 1)
+        AliasRepository(conn=self.db_conn).create("info@smith.com", "john@smith.com")
+        seq = journal.head(self.db_conn)
+        self.assertEqual(seq, 3)
+
+        self.user_repo.edit("john@smith.com", quota=2)
+        self.user_repo.edit("john@smith.com", new_email="joe@smith.com")
+        AliasRepository(conn=self.db_conn).delete("info@smith.com")
+        self.assertEqual(
+            self._changes(seq),
+            [
+                ("update", "users", "john@smith.com", None),
+                ("update", "users", "joe@smith.com", "john@smith.com"),
+                ("delete", "aliases", "info@smith.com", None),
+            ],
+        )
+
+    def test_rolled_back_writes_are_not_journaled(self):
+        self.db_conn.execute("INSERT INTO domains VALUES ('smith.com')")
+        self.db_conn.rollback()
+        self.assertEqual(self._changes(), [])
+        self.assertEqual(journal.head(self.db_conn), 0)
+
+    def test_compaction(self):
+        domain_repo = DomainRepository(conn=self.db_conn)
+        for name in ("a.com", "b.com", "c.com", "d.com"):
+            domain_repo.create(name)
+
+        self.assertEqual(journal.compact(self.db_conn, before=3, batch_size=2), 3)
+        self.assertEqual(self._changes(3), [("insert", "domains", "d.com", None)])
+        with self.assertRaises(ValueError):
+            self._changes(2)
+        with self.assertRaises(ValueError):
+            self._changes(5)
+
+        self.assertEqual(journal.compact(self.db_conn, older_than=-60), 1)
+        # Sequence numbers aren't reused once the journal is empty.
+        self.assertEqual(self._changes(4), [])
+        domain_repo.create("e.com")
+        self.assertEqual(journal.head(self.db_conn), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
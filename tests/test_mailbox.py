@@ -0,0 +1,160 @@
+import os
+import time
+import unittest
+from pathlib import Path
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import mailbox  # noqa: E402
+
+
+class TrashTest(TestCase):
+    def setUp(self):
+        self.config = utils.get_test_config()
+        self.original_config = g.config
+        g.config = self.config
+        self.vmail_directory = Path(self.config["mail"]["vmail_directory"])
+
+    def tearDown(self):
+        g.config = self.original_config
+
+    def _make_mailbox(self, path: Path, messages: int):
+        for folder in ("cur", "new", "tmp", ".Sent/cur"):
+            (path / folder).mkdir(parents=True)
+        for i in range(messages):
+            (path / "cur" / f"{i}.eml").write_text("hello")
+            (path / ".Sent" / "cur" / f"{i}.eml").write_text("hello")
+
+    def test_move_to_trash_renames_mailbox(self):
+        mailbox_path = self.vmail_directory / "smith.com" / "john"
+        self._make_mailbox(mailbox_path, 3)
+
+        dest = mailbox.move_to_trash(mailbox_path)
+
+        self.assertFalse(mailbox_path.exists())
+        self.assertEqual(dest.parent, mailbox.get_trash_directory())
+        self.assertTrue((dest / "cur" / "0.eml").exists())
+
+    def test_purge_removes_everything_in_trash(self):
+        for user in ("john", "jane"):
+            mailbox_path = self.vmail_directory / "smith.com" / user
+            self._make_mailbox(mailbox_path, 5)
+            mailbox.move_to_trash(mailbox_path)
+
+        files, directories = mailbox.purge_trash(workers=3)
+
+        self.assertEqual(files, 20)
+        self.assertEqual(directories, 12)
+        self.assertEqual(os.listdir(mailbox.get_trash_directory()), [])
+
+    def test_purge_without_trash_does_nothing(self):
+        self.assertEqual(mailbox.purge_trash(), (0, 0))
+
+    def test_rate_limiter_spaces_out_operations(self):
+        limiter = mailbox.RateLimiter(rate=100)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class QuotaUsageTest(TestCase):
+    def setUp(self):
+        self.config = utils.get_test_config()
+        self.original_config = g.config
+        g.config = self.config
+
+    def tearDown(self):
+        g.config = self.original_config
+
+    def _make_mailbox(self, email: str, size: int, maildirsize: str = None):
+        path = mailbox.get_mailbox_path(email)
+        (path / "cur").mkdir(parents=True)
+        (path / "cur" / "1.eml").write_bytes(b"x" * size)
+        if maildirsize is not None:
+            (path / "maildirsize").write_text(maildirsize)
+
+    def test_maildirsize_is_preferred_over_walking(self):
+        self._make_mailbox("john@smith.com", 100, "1000S,10C\n300 2\n-50 -1\n")
+        self._make_mailbox("jane@smith.com", 100)
+
+        self.assertEqual(
+            mailbox.mailbox_usage(mailbox.get_mailbox_path("john@smith.com")), 250
+        )
+        self.assertEqual(
+            mailbox.mailbox_usage(mailbox.get_mailbox_path("jane@smith.com")), 100
+        )
+
+    def test_top_usage_orders_by_share_of_quota(self):
+        self._make_mailbox("john@smith.com", 100)
+        self._make_mailbox("jane@smith.com", 300)
+        self._make_mailbox("joe@smith.com", 90)
+        users = [
+            ("john@smith.com", 1000),
+            ("jane@smith.com", 10_000),
+            ("joe@smith.com", 100),
+            ("jack@smith.com", 100),
+        ]
+
+        rows = mailbox.top_usage(users, top=2, workers=2)
+
+        self.assertEqual(
+            rows, [("joe@smith.com", 90, 100), ("john@smith.com", 100, 1000)]
+        )
+
+
+class UsageIndexTest(TestCase):
+    def setUp(self):
+        self.config = utils.get_test_config()
+        self.original_config = g.config
+        g.config = self.config
+        self.paths = []
+        for user in ("john", "jane"):
+            path = mailbox.get_mailbox_path(f"{user}@smith.com")
+            for folder in ("cur", "new", "tmp", ".Sent/cur", ".Sent/new", ".Sent/tmp"):
+                (path / folder).mkdir(parents=True)
+            (path / "cur" / "1.eml").write_bytes(b"x" * 100)
+            (path / ".Sent" / "cur" / "1.eml").write_bytes(b"x" * 10)
+            self.paths.append(path)
+        # Pretend every directory was last modified a while ago.
+        for path in self.paths:
+            for directory in path.glob("**/*"):
+                os.utime(directory, ns=(1_000_000_000, 1_000_000_000))
+
+    def tearDown(self):
+        g.config = self.original_config
+
+    def test_update_skips_unchanged_directories(self):
+        index = mailbox.UsageIndex()
+        self.assertEqual(index.update(self.paths), [110, 110])
+        self.assertEqual((index.scanned, index.skipped), (12, 0))
+        index.close()
+
+        (self.paths[0] / "new" / "2.eml").write_bytes(b"x" * 5)
+        index = mailbox.UsageIndex()
+        self.assertEqual(index.update(self.paths), [115, 110])
+        self.assertEqual((index.scanned, index.skipped), (1, 11))
+
+        stats = index.stats()
+        self.assertEqual(stats["mailboxes"], 2)
+        self.assertEqual(stats["directories"], 12)
+        self.assertEqual(stats["size"], 225)
+        self.assertEqual(stats["files"], 5)
+        index.close()
+
+    def test_rebuild_scans_everything(self):
+        index = mailbox.UsageIndex()
+        index.update(self.paths)
+        index.scanned = 0
+        index.rebuild(self.paths)
+        self.assertEqual(index.scanned, 12)
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from mailiness import metrics
+
+
+class InstrumentedCursorTest(TestCase):
+    def setUp(self):
+        self.stats = metrics.QueryStats()
+        conn = sqlite3.connect(":memory:")
+        self.cursor = metrics.InstrumentedCursor(conn.cursor(), self.stats)
+        self.cursor.execute("CREATE TABLE users(email TEXT)")
+        self.cursor.executemany(
+            "INSERT INTO users VALUES (?)", [("a@smith.com",), ("b@smith.com",)]
+        )
+
+    def test_queries_and_rows_are_counted_per_template(self):
+        self.cursor.execute("SELECT email FROM users").fetchall()
+        rows = list(self.cursor.execute("SELECT email FROM users"))
+        self.cursor.execute("SELECT email FROM users WHERE email=?", ["a@smith.com"])
+        self.cursor.fetchone()
+
+        self.assertEqual(len(rows), 2)
+        count, _, _, total_rows, errors = self.stats.statements[
+            "SELECT email FROM users"
+        ]
+        self.assertEqual((count, total_rows, errors), (2, 4, 0))
+        self.assertEqual(
+            self.stats.statements["SELECT email FROM users WHERE email=?"][3], 1
+        )
+
+    def test_locked_database_is_not_retried(self):
+        cursor = MagicMock()
+        cursor.executemany.side_effect = sqlite3.OperationalError("database is locked")
+        instrumented = metrics.InstrumentedCursor(cursor, self.stats)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            instrumented.executemany("INSERT INTO users VALUES (?)", [("c@smith.com",)])
+
+        self.assertEqual(cursor.executemany.call_count, 1)
+        self.assertEqual(self.stats.lock_timeouts, 1)
+        self.assertEqual(self.stats.statements["INSERT INTO users VALUES (?)"][4], 1)
+
+    def test_other_errors_are_counted_and_raised(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.cursor.execute("SELECT nope FROM users")
+        self.assertEqual(self.stats.statements["SELECT nope FROM users"][4], 1)
+        self.assertEqual(self.stats.lock_timeouts, 0)
+
+
+class TextfileTest(TestCase):
+    def test_render_and_write(self):
+        stats = metrics.QueryStats()
+        stats.record('SELECT "x" FROM users', 0.5, rows=3)
+
+        text = metrics.render(
+            stats, extra={"mailiness_command_success": ("gauge", "Success.", 1)}
+        )
+
+        self.assertIn(
+            'mailiness_sql_queries_total{statement="SELECT \\"x\\" FROM users"} 1',
+            text,
+        )
+        self.assertIn(
+            'mailiness_sql_rows_total{statement="SELECT \\"x\\" FROM users"} 3', text
+        )
+        self.assertIn("# TYPE mailiness_sql_lock_timeouts_total counter", text)
+        self.assertIn("mailiness_command_success 1", text)
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "mailiness.prom")
+        metrics.write_textfile(path, text)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), text)
+        self.assertEqual(os.listdir(directory), ["mailiness.prom"])
+
+
+if __name__ == "__main__":
+    unittest.main()
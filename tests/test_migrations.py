@@ -0,0 +1,111 @@
+import sqlite3
+import unittest
+from unittest import TestCase, mock
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import migrations  # noqa: E402
+
+
+class CaseInsensitiveIndexTest(TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        # A database written before addresses were normalised.
+        for stmt in migrations.get_statements():
+            self.db_conn.execute(stmt)
+        self.db_conn.execute("INSERT INTO domains VALUES ('smith.com')")
+        self.db_conn.executemany(
+            "INSERT INTO users VALUES (1, ?, 'secret', 1)",
+            [("john@smith.com",), ("John@Smith.com",), ("jane@smith.com",)],
+        )
+
+    def _index_is_unique(self) -> bool:
+        for _, name, unique, *_ in self.db_conn.execute("PRAGMA index_list(users)"):
+            if name == "users_email_lower_idx":
+                return bool(unique)
+        self.fail("users_email_lower_idx is missing")
+
+    def test_duplicates_are_reported_and_indexed_once_gone(self):
+        duplicates = migrations.migrate(self.db_conn)
+        self.assertEqual(
+            duplicates,
+            {
+                "domains": [],
+                "users": [["John@Smith.com", "john@smith.com"]],
+                "aliases": [],
+            },
+        )
+        self.assertFalse(self._index_is_unique())
+
+        self.db_conn.execute("DELETE FROM users WHERE email='John@Smith.com'")
+        self.assertEqual(migrations.migrate(self.db_conn)["users"], [])
+        self.assertTrue(self._index_is_unique())
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db_conn.execute(
+                "INSERT INTO users VALUES (1, 'JANE@smith.com', 'secret', 1)"
+            )
+
+    def test_lookups_use_the_index(self):
+        migrations.migrate(self.db_conn)
+        plan = self.db_conn.execute(
+            "EXPLAIN QUERY PLAN SELECT password FROM users WHERE lower(email)=?",
+            ["jane@smith.com"],
+        ).fetchall()
+        self.assertIn("users_email_lower_idx", plan[0][3])
+
+
+class VersionedMigrationTest(TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+
+    def test_migrations_are_recorded(self):
+        latest = len(migrations.get_migrations())
+        self.assertEqual([row[0] for row in migrations.plan(self.db_conn)][-1], latest)
+        migrations.migrate(self.db_conn)
+        self.assertEqual(migrations.get_version(self.db_conn), latest)
+        self.assertEqual(migrations.plan(self.db_conn), [])
+
+    def test_backfills_run_in_batches(self):
+        # A database from before the alias targets table.
+        for stmt in migrations.get_table_statements():
+            self.db_conn.execute(stmt)
+        self.db_conn.execute("INSERT INTO domains VALUES ('smith.com')")
+        self.db_conn.executemany(
+            "INSERT INTO aliases VALUES (1, ?, ?)",
+            [(f"team{i}@smith.com", "john@smith.com,jane@smith.com") for i in range(5)]
+            + [("info@smith.com", "john@smith.com")],
+        )
+        self.db_conn.execute("PRAGMA user_version=1")
+        self.db_conn.commit()
+
+        self.assertIn(
+            (2, "Alias targets lookup table", "Fill alias targets", 6),
+            migrations.plan(self.db_conn),
+        )
+        messages = []
+        with mock.patch("mailiness.migrations.PROGRESS_INTERVAL", 0):
+            migrations.migrate(self.db_conn, batch_size=2, progress=messages.append)
+        self.assertIn("Fill alias targets: 6/6 rows", messages)
+
+        # Running the backfill again doesn't duplicate targets.
+        self.db_conn.execute("PRAGMA user_version=1")
+        migrations.migrate(self.db_conn, batch_size=4)
+        self.assertEqual(
+            self.db_conn.execute("SELECT count(*) FROM aliases_targets").fetchone(),
+            (10,),
+        )
+
+    def test_steps_have_to_implement_run(self):
+        class Incomplete(migrations.Step):
+            description = "Incomplete"
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+if __name__ == "__main__":
+    unittest.main()
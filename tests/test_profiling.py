@@ -0,0 +1,38 @@
+import unittest
+from unittest import TestCase
+
+from mailiness import profiling
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.original_timings = profiling.timings
+        profiling.timings = profiling.Timings()
+
+    def tearDown(self):
+        profiling.timings = self.original_timings
+
+    def test_disabled_timings_record_nothing(self):
+        conn = profiling.connect(":memory:")
+        conn.execute("SELECT 1")
+        with profiling.timings.phase("bcrypt"):
+            pass
+        self.assertEqual(profiling.timings.phases, {})
+
+    def test_statements_are_timed_per_template(self):
+        profiling.timings.enabled = True
+        conn = profiling.connect(":memory:")
+        conn.execute("CREATE TABLE users(email TEXT)")
+        cursor = conn.cursor()
+        for email in ("a@smith.com", "b@smith.com"):
+            cursor.execute("INSERT INTO users VALUES (?)", [email])
+        cursor.executemany("INSERT INTO users VALUES (?)", [("c@smith.com",)])
+
+        phases = profiling.timings.phases
+        self.assertEqual(phases["db connect"][0], 1)
+        self.assertEqual(phases["sql: INSERT INTO users VALUES (?)"][0], 3)
+        self.assertEqual(phases["sql: CREATE TABLE users(email TEXT)"][0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,10 +11,13 @@ from . import utils
 
 test_config = utils.get_test_config()
 g.config = test_config
+from mailiness import migrations  # noqa: E402
 from mailiness.repo import (  # noqa: E402
     AliasRepository,
     DomainRepository,
     UserRepository,
+    alias_targets_table_name,
+    search_table_name,
 )
 
 
@@ -25,6 +28,7 @@ class DomainRepositoryTest(TestCase):
         self.repo.cursor.execute(
             f"CREATE TABLE {test_config['db']['domains_table_name']}(name TEXT)"
         )
+        migrations.migrate(db_conn)
 
     def tearDown(self):
         self.repo.cursor.execute(
@@ -64,6 +68,32 @@ class DomainRepositoryTest(TestCase):
         pretty_data = self.repo.edit("name", "example.net", "example.org")
         self.assertIsInstance(pretty_data, Table)
 
+    def test_edit_domain_name_renames_user_and_alias_addresses(self):
+        self.repo.create("example.org")
+        self.repo.create("example.net")
+        user_repo = UserRepository(conn=self.repo.db_conn)
+        user_repo._hash_password = lambda password: password
+        alias_repo = AliasRepository(conn=self.repo.db_conn)
+        user_repo.create("john@example.org", "secret", 1)
+        user_repo.create("jane@example.net", "secret", 1)
+        alias_repo.create("info@example.org", "john@example.org")
+        alias_repo.create("team@example.net", "jane@example.net, john@example.org")
+
+        self.repo.edit("name", "example.org", "example.com")
+
+        users = [row[1] for row in user_repo.index(pretty=False)["rows"]]
+        self.assertEqual(users, ["john@example.com", "jane@example.net"])
+        aliases = [row[1:] for row in alias_repo.index(pretty=False)["rows"]]
+        self.assertEqual(
+            aliases,
+            [
+                ("info@example.com", "john@example.com"),
+                ("team@example.net", "jane@example.net, john@example.com"),
+            ],
+        )
+        data = alias_repo.index(to_address="john@example.com", pretty=False)
+        self.assertEqual(len(data["rows"]), 2)
+
     def test_delete_domain_name(self):
         name = "example.org"
         self.repo.create(name)
@@ -74,6 +104,45 @@ class DomainRepositoryTest(TestCase):
         domains = self.repo.index(pretty=False)
         self.assertEqual(len(domains["rows"]), 0)
 
+    def test_delete_domain_removes_users_and_aliases_in_batches(self):
+        self.repo.create("example.org")
+        self.repo.create("example.net")
+        user_repo = UserRepository(conn=self.repo.db_conn)
+        user_repo._hash_password = lambda password: password
+        alias_repo = AliasRepository(conn=self.repo.db_conn)
+        for i in range(5):
+            user_repo.create(f"user{i}@example.org", "secret", 1)
+            alias_repo.create(f"alias{i}@example.org", "a@example.org,b@example.org")
+        user_repo.create("john@example.net", "secret", 1)
+        progress = []
+
+        self.repo.delete(
+            "example.org",
+            batch_size=2,
+            progress=lambda table, deleted: progress.append((table, deleted)),
+        )
+
+        self.assertEqual(
+            progress,
+            [
+                ("aliases", 2),
+                ("aliases", 4),
+                ("aliases", 5),
+                ("users", 2),
+                ("users", 4),
+                ("users", 5),
+            ],
+        )
+        users = user_repo.index(pretty=False)["rows"]
+        self.assertEqual([row[1] for row in users], ["john@example.net"])
+        self.assertEqual(len(alias_repo.index(pretty=False)["rows"]), 0)
+        result = self.repo.cursor.execute(
+            f"SELECT count(*) FROM {alias_targets_table_name()}"
+        )
+        self.assertEqual(result.fetchone()[0], 0)
+        domains = self.repo.index(pretty=False)["rows"]
+        self.assertEqual([row[1] for row in domains], ["example.net"])
+
 
 class UserRepositoryTest(TestCase):
     def setUp(self):
@@ -188,6 +257,7 @@ class AliasRepositoryTest(TestCase):
         self.repo.cursor.execute(
             f"CREATE TABLE {test_config['db']['aliases_table_name']}(domain_id INTEGER, from_address TEXT, to_address TEXT, FOREIGN KEY(domain_id) REFERENCES domains(rowid))"
         )
+        migrations.migrate(db_conn)
         self.domain_repo = DomainRepository(conn=db_conn)
         self.domain_name = "smith.com"
         domain_data = self.domain_repo.create(self.domain_name, pretty=False)
@@ -268,6 +338,263 @@ class AliasRepositoryTest(TestCase):
         data = self.repo.index(pretty=False)
         self.assertEqual(len(data["rows"]), 0)
 
+    def test_multiple_targets_are_kept_in_lookup_table(self):
+        targets_table = alias_targets_table_name()
+        from_address = "team@" + self.domain_name
+
+        self.repo.create(from_address, "john@smith.com, jane@smith.com")
+        data = self.repo.index(to_address="jane@smith.com", pretty=False)
+        self.assertIn(from_address, data["rows"][0])
+
+        self.repo.edit(from_address, to_address="john@smith.com,joe@smith.com")
+        data = self.repo.index(to_address="jane@smith.com", pretty=False)
+        self.assertEqual(len(data["rows"]), 0)
+        data = self.repo.index(to_address="joe@smith.com", pretty=False)
+        self.assertEqual(len(data["rows"]), 1)
+
+        self.repo.delete(from_address)
+        result = self.repo.cursor.execute(f"SELECT count(*) FROM {targets_table}")
+        self.assertEqual(result.fetchone()[0], 0)
+
+    def test_migrate_fills_lookup_table_for_existing_aliases(self):
+        targets_table = alias_targets_table_name()
+        # A database from before the lookup table existed.
+        self.repo.cursor.execute(f"DROP TABLE {targets_table}")
+        self.repo.cursor.execute("PRAGMA user_version=0")
+        self.repo.cursor.execute(
+            f"INSERT INTO {test_config['db']['aliases_table_name']} VALUES (?,?,?)",
+            [self.domain_id, "team@smith.com", "john@smith.com,jane@smith.com"],
+        )
+
+        migrations.migrate(self.db_conn)
+
+        data = self.repo.index(to_address="jane@smith.com", pretty=False)
+        self.assertIn("team@smith.com", data["rows"][0])
+
+
+class AliasResolutionTest(TestCase):
+    def setUp(self):
+        db_conn = sqlite3.connect(":memory:")
+        self.repo = AliasRepository(conn=db_conn)
+        self.repo.cursor.execute(
+            f"CREATE TABLE {test_config['db']['domains_table_name']}(name TEXT)"
+        )
+        self.repo.cursor.execute(
+            f"CREATE TABLE {test_config['db']['users_table_name']}(domain_id INTEGER, email TEXT, password TEXT, quota INTEGER)"
+        )
+        self.repo.cursor.execute(
+            f"CREATE TABLE {test_config['db']['aliases_table_name']}(domain_id INTEGER, from_address TEXT, to_address TEXT)"
+        )
+        migrations.migrate(db_conn)
+        DomainRepository(conn=db_conn).create("smith.com")
+        user_repo = UserRepository(conn=db_conn)
+        user_repo._hash_password = lambda password: password
+        user_repo.create("john@smith.com", "secret", 1)
+        user_repo.create("jane@smith.com", "secret", 1)
+
+    def _statuses(self, address):
+        data = self.repo.resolve(address, pretty=False)
+        return {target: status for target, status, _ in data["rows"]}
+
+    def test_resolve_follows_chains_and_multiple_targets(self):
+        self.repo.create("team@smith.com", "devs@smith.com, joe@gmail.com")
+        self.repo.create("devs@smith.com", "john@smith.com,jane@smith.com")
+
+        self.assertEqual(
+            self._statuses("team@smith.com"),
+            {
+                "john@smith.com": "mailbox",
+                "jane@smith.com": "mailbox",
+                "joe@gmail.com": "external",
+            },
+        )
+
+    def test_resolve_reports_cycles_and_dangling_targets(self):
+        self.repo.create("a@smith.com", "b@smith.com")
+        self.repo.create("b@smith.com", "a@smith.com,ghost@smith.com")
+        self.repo.create("john@smith.com", "john@smith.com,jane@smith.com")
+
+        statuses = self._statuses("a@smith.com")
+        self.assertEqual(statuses["a@smith.com"], "cycle")
+        self.assertEqual(statuses["ghost@smith.com"], "dangling")
+
+        statuses = self._statuses("john@smith.com")
+        self.assertEqual(statuses["john@smith.com"], "mailbox")
+        self.assertEqual(statuses["jane@smith.com"], "mailbox")
+
+    def test_resolve_reports_chains_cut_off_at_max_depth(self):
+        for i in range(5):
+            self.repo.create(f"link{i}@smith.com", f"link{i + 1}@smith.com")
+        self.repo.create("link5@smith.com", "john@smith.com")
+
+        data = self.repo.resolve("link0@smith.com", max_depth=3, pretty=False)
+        self.assertEqual(
+            [row[:2] for row in data["rows"]], [("link3@smith.com", "too deep")]
+        )
+        self.assertEqual(
+            self._statuses("link0@smith.com"), {"john@smith.com": "mailbox"}
+        )
+
+    def test_check_finds_problems_across_all_aliases(self):
+        self.repo.create("a@smith.com", "b@smith.com")
+        self.repo.create("b@smith.com", "a@smith.com")
+        self.repo.create("sales@smith.com", "info@smith.com")
+        self.repo.create("info@smith.com", "ghost@smith.com")
+        self.repo.create("team@smith.com", "john@smith.com,info@gmail.com")
+
+        data = self.repo.check(pretty=False)
+
+        self.assertIn(
+            ("a@smith.com", "cycle", "a@smith.com, b@smith.com"), data["rows"]
+        )
+        self.assertIn(
+            ("b@smith.com", "cycle", "a@smith.com, b@smith.com"), data["rows"]
+        )
+        self.assertIn(("sales@smith.com", "dangling", "ghost@smith.com"), data["rows"])
+        self.assertIn(("info@smith.com", "dangling", "ghost@smith.com"), data["rows"])
+        self.assertNotIn("team@smith.com", [row[0] for row in data["rows"]])
+
+    def test_mixed_case_rows_are_resolved_case_insensitively(self):
+        # Rows written by plain SQL before addresses were normalised.
+        self.repo.cursor.execute(
+            f"INSERT INTO {test_config['db']['aliases_table_name']} VALUES (1, 'Team@Smith.com', 'Devs@smith.com')"
+        )
+        self.repo.cursor.execute(
+            f"INSERT INTO {test_config['db']['aliases_table_name']} VALUES (1, 'devs@smith.com', 'John@Smith.com,ghost@smith.com')"
+        )
+
+        self.assertEqual(
+            self._statuses("team@smith.com"),
+            {"john@smith.com": "mailbox", "ghost@smith.com": "dangling"},
+        )
+        data = self.repo.check(pretty=False)
+        self.assertEqual(
+            data["rows"],
+            [
+                ("devs@smith.com", "dangling", "ghost@smith.com"),
+                ("team@smith.com", "dangling", "ghost@smith.com"),
+            ],
+        )
+
+
+class NormalisationTest(TestCase):
+    def setUp(self):
+        db_conn = sqlite3.connect(":memory:")
+        migrations.migrate(db_conn)
+        self.db_conn = db_conn
+        self.domain_repo = DomainRepository(conn=db_conn)
+        self.user_repo = UserRepository(conn=db_conn)
+        self.user_repo._hash_password = lambda password: password
+        self.alias_repo = AliasRepository(conn=db_conn)
+
+    def test_addresses_are_stored_in_lower_case(self):
+        self.domain_repo.create("Smith.COM")
+        self.user_repo.create(" John@Smith.com", "secret", 1)
+        self.alias_repo.create("Info@smith.com", "John@Smith.com, Jane@Example.com")
+        self.assertEqual(
+            self.domain_repo.index(pretty=False)["rows"], [(1, "smith.com")]
+        )
+        self.assertEqual(
+            self.user_repo.index(pretty=False)["rows"][0][1], "john@smith.com"
+        )
+        self.assertEqual(
+            self.alias_repo.index(to_address="JANE@example.com", pretty=False)["rows"],
+            [(1, "info@smith.com", "john@smith.com, jane@example.com")],
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.user_repo.create("JOHN@smith.com", "secret", 1)
+
+    def test_lookups_ignore_case(self):
+        self.domain_repo.create("smith.com")
+        self.user_repo.create("john@smith.com", "secret", 1)
+        self.alias_repo.create("info@smith.com", "john@smith.com")
+        self.assertEqual(self.user_repo.get_password_hash("John@SMITH.com"), "secret")
+        self.user_repo.edit("JOHN@smith.com", quota=2)
+        self.assertEqual(
+            self.user_repo.quotas("SMITH.COM"), [("john@smith.com", 2_000_000_000)]
+        )
+        self.alias_repo.edit("INFO@smith.com", to_address="Jane@Smith.com")
+        self.assertEqual(
+            self.alias_repo.resolve("Info@Smith.com", pretty=False)["rows"][0][0],
+            "jane@smith.com",
+        )
+        self.alias_repo.delete("Info@Smith.com")
+        self.user_repo.delete("John@Smith.com")
+        self.domain_repo.delete("Smith.com")
+        for table in ("domains", "users", "aliases"):
+            self.assertEqual(
+                self.db_conn.execute(f"SELECT count(*) FROM {table}").fetchone(), (0,)
+            )
+
+    def test_alias_moved_to_another_domain(self):
+        self.domain_repo.create("smith.com")
+        self.domain_repo.create("doe.com")
+        self.alias_repo.create("info@smith.com", "john@smith.com")
+        self.alias_repo.edit("info@smith.com", new_from="info@doe.com")
+        self.assertEqual(
+            self.alias_repo.index(domain="doe.com", pretty=False)["rows"][0][1],
+            "info@doe.com",
+        )
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        db_conn = sqlite3.connect(":memory:")
+        migrations.migrate(db_conn)
+        self.db_conn = db_conn
+        self.user_repo = UserRepository(conn=db_conn)
+        self.user_repo._hash_password = lambda password: password
+        self.alias_repo = AliasRepository(conn=db_conn)
+        DomainRepository(conn=db_conn).create("smith.com")
+        for name in ("john", "john_doe", "jane", "johnny"):
+            self.user_repo.create(f"{name}@smith.com", "secret", 1)
+        self.alias_repo.create("info@smith.com", "john@smith.com,jane@smith.com")
+        self.alias_repo.create("sales@smith.com", "johnny@smith.com")
+
+    def _emails(self, pattern: str, **kwargs) -> list[str]:
+        return [
+            row[1]
+            for row in self.user_repo.search(pattern, pretty=False, **kwargs)["rows"]
+        ]
+
+    def test_user_search(self):
+        self.assertEqual(
+            self._emails("john*"),
+            ["john@smith.com", "john_doe@smith.com", "johnny@smith.com"],
+        )
+        self.assertEqual(self._emails("*NY@SMITH.COM"), ["johnny@smith.com"])
+        self.assertEqual(self._emails("j??e@*"), ["jane@smith.com"])
+        # "_" is a literal, not LIKE's wildcard.
+        self.assertEqual(self._emails("*_*"), ["john_doe@smith.com"])
+        self.assertEqual(self._emails("doe"), ["john_doe@smith.com"])
+        self.assertEqual(len(self._emails("*@smith.com", limit=2)), 2)
+        self.assertIsInstance(self.user_repo.search("john"), Table)
+
+    def test_index_follows_writes(self):
+        self.user_repo.edit("jane@smith.com", new_email="janet@smith.com")
+        self.user_repo.delete("john_doe@smith.com")
+        self.assertEqual(self._emails("ja*"), ["janet@smith.com"])
+        self.assertEqual(self._emails("*doe*"), [])
+
+    def test_alias_search(self):
+        data = self.alias_repo.search("*@smith.com", pretty=False)
+        self.assertEqual(
+            [row[1] for row in data["rows"]], ["info@smith.com", "sales@smith.com"]
+        )
+        data = self.alias_repo.search("jane@*", to=True, pretty=False)
+        self.assertEqual(
+            data["rows"],
+            [(1, "info@smith.com", "john@smith.com,jane@smith.com")],
+        )
+        data = self.alias_repo.search("john*", to=True, pretty=False)
+        self.assertEqual(len(data["rows"]), 2)
+
+    def test_search_without_index(self):
+        self.db_conn.execute(
+            f"DROP TABLE {search_table_name(test_config['db']['users_table_name'])}"
+        )
+        self.assertEqual(self._emails("*ny@*"), ["johnny@smith.com"])
+
 
 if __name__ == "__main__":
     unittest.main()
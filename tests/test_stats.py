@@ -0,0 +1,69 @@
+import sqlite3
+import unittest
+from pathlib import Path
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import migrations, stats  # noqa: E402
+from mailiness.repo import (  # noqa: E402
+    AliasRepository,
+    DomainRepository,
+    UserRepository,
+)
+
+
+class DomainStatsTest(TestCase):
+    def setUp(self):
+        self.config = utils.get_test_config()
+        self.original_config = g.config
+        g.config = self.config
+        self.db_conn = sqlite3.connect(":memory:")
+        migrations.migrate(self.db_conn)
+        domain_repo = DomainRepository(conn=self.db_conn)
+        for name in ("smith.com", "doe.com", "empty.com"):
+            domain_repo.create(name)
+        user_repo = UserRepository(conn=self.db_conn)
+        user_repo._hash_password = lambda password: password
+        user_repo.create("john@smith.com", "secret", 1)
+        user_repo.create("jane@smith.com", "secret", 2)
+        user_repo.create("joe@doe.com", "secret", 5)
+        AliasRepository(conn=self.db_conn).create("info@smith.com", "john@smith.com")
+
+        key_directory = Path(self.config["spam"]["dkim_private_key_directory"])
+        (key_directory / "smith.com.20220101.key").write_text("key")
+        with open(self.config["spam"]["dkim_maps_path"], "w") as fp:
+            fp.write("smith.com 20220101\ndoe.com 20220101\n")
+
+    def tearDown(self):
+        g.config = self.original_config
+
+    def test_domain_stats(self):
+        self.assertEqual(
+            stats.domain_stats(self.db_conn),
+            [
+                ("doe.com", 1, 0, 5_000_000_000, "no key file"),
+                ("empty.com", 0, 0, 0, "none"),
+                ("smith.com", 2, 1, 3_000_000_000, "20220101"),
+            ],
+        )
+
+    def test_single_domain(self):
+        self.assertEqual(
+            stats.domain_stats(self.db_conn, domain="smith.com"),
+            [("smith.com", 2, 1, 3_000_000_000, "20220101")],
+        )
+        self.assertEqual(
+            stats.domain_stats(self.db_conn, domain=" Smith.COM"),
+            [("smith.com", 2, 1, 3_000_000_000, "20220101")],
+        )
+        with self.assertRaises(ValueError):
+            stats.domain_stats(self.db_conn, domain="nowhere.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import copy
+import sqlite3
+import unittest
+from unittest import TestCase, mock
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import migrations, sync  # noqa: E402
+from mailiness.repo import (  # noqa: E402
+    AliasRepository,
+    DomainRepository,
+    UserRepository,
+)
+
+
+class SynchronizerTest(TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        migrations.migrate(self.db_conn)
+        DomainRepository(conn=self.db_conn).create("smith.com")
+        DomainRepository(conn=self.db_conn).create("old.com")
+        self.user_repo = UserRepository(conn=self.db_conn)
+        self.user_repo.create("john@smith.com", "secret", 1)
+        self.user_repo.create("jane@smith.com", "secret", 1)
+        self.user_repo.create("joe@old.com", "secret", 1)
+        self.alias_repo = AliasRepository(conn=self.db_conn)
+        self.alias_repo.create("info@smith.com", "john@smith.com")
+        self.alias_repo.create("sales@old.com", "joe@old.com")
+        self.inventory = {
+            "domains": ["smith.com", "new.com"],
+            "users": [
+                {"email": "john@smith.com", "password": "secret", "quota": 1},
+                {"email": "jane@smith.com", "password": "changed", "quota": 2},
+                {"email": "bob@new.com", "password": "secret", "quota": 1},
+            ],
+            "aliases": [
+                {"from": "info@smith.com", "to": ["john@smith.com", "jane@smith.com"]},
+                {"from": "hello@new.com", "to": "bob@new.com"},
+            ],
+        }
+
+    def test_plan_lists_minimal_changes(self):
+        plan = sync.Synchronizer(conn=self.db_conn, check_passwords=True).plan(
+            self.inventory
+        )
+
+        self.assertEqual(
+            plan["domains"], {"create": ["new.com"], "delete": ["old.com"]}
+        )
+        self.assertEqual(
+            plan["users"],
+            {
+                "create": ["bob@new.com"],
+                "update": [
+                    {"email": "jane@smith.com", "fields": ["password", "quota"]}
+                ],
+                "delete": ["joe@old.com"],
+            },
+        )
+        self.assertEqual(
+            plan["aliases"],
+            {
+                "create": ["hello@new.com"],
+                "update": ["info@smith.com"],
+                "delete": ["sales@old.com"],
+            },
+        )
+
+    def test_plaintext_passwords_are_only_checked_on_request(self):
+        synchronizer = sync.Synchronizer(conn=self.db_conn)
+        with mock.patch.object(
+            synchronizer.user_repo, "verify_password", side_effect=AssertionError
+        ):
+            plan = synchronizer.plan(self.inventory)
+        self.assertEqual(
+            plan["users"]["update"], [{"email": "jane@smith.com", "fields": ["quota"]}]
+        )
+
+    def test_invalid_records_are_rejected(self):
+        for field in ("email", "quota"):
+            inventory = copy.deepcopy(self.inventory)
+            del inventory["users"][0][field]
+            with self.assertRaisesRegex(ValueError, field):
+                sync.Synchronizer(conn=self.db_conn).plan(inventory)
+        self.inventory["aliases"][0]["to"] = []
+        with self.assertRaisesRegex(ValueError, "info@smith.com"):
+            sync.Synchronizer(conn=self.db_conn).plan(self.inventory)
+
+    def test_keep_unmanaged_skips_deletions(self):
+        plan = sync.Synchronizer(conn=self.db_conn, delete=False).plan(self.inventory)
+        self.assertEqual(plan["domains"]["delete"], [])
+        self.assertEqual(plan["users"]["delete"], [])
+        self.assertEqual(plan["aliases"]["delete"], [])
+
+    def test_apply_reaches_desired_state(self):
+        synchronizer = sync.Synchronizer(conn=self.db_conn, check_passwords=True)
+        john_hash = self.user_repo.get_password_hash("john@smith.com")
+
+        synchronizer.apply(self.inventory)
+
+        self.assertEqual(self.user_repo.get_password_hash("john@smith.com"), john_hash)
+        self.assertTrue(
+            self.user_repo.verify_password(
+                "changed", self.user_repo.get_password_hash("jane@smith.com")
+            )
+        )
+        self.assertIsNone(self.user_repo.get_password_hash("joe@old.com"))
+        data = self.alias_repo.index(to_address="jane@smith.com", pretty=False)
+        self.assertEqual(
+            [row[1] for row in data["rows"]],
+            ["info@smith.com"],
+        )
+        plan = synchronizer.plan(self.inventory)
+        for changes in plan.values():
+            self.assertFalse(any(changes.values()))
+
+    def test_passwords_are_hashed_before_writing(self):
+        synchronizer = sync.Synchronizer(conn=self.db_conn, check_passwords=True)
+        hash_password = synchronizer.user_repo._hash_password
+        in_transaction = []
+
+        def record(password):
+            in_transaction.append(self.db_conn.in_transaction)
+            return hash_password(password)
+
+        with mock.patch.object(synchronizer.user_repo, "_hash_password", record):
+            synchronizer.apply(self.inventory)
+        self.assertEqual(in_transaction, [False, False])
+
+    def test_user_of_unlisted_domain_is_rejected(self):
+        self.inventory["users"].append(
+            {"email": "ann@other.com", "password": "secret", "quota": 1}
+        )
+        with self.assertRaises(ValueError):
+            sync.Synchronizer(conn=self.db_conn).plan(self.inventory)
+
+
+if __name__ == "__main__":
+    unittest.main()
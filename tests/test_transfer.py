@@ -0,0 +1,115 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import TestCase
+
+from mailiness import g
+
+from . import utils
+
+test_config = utils.get_test_config()
+g.config = test_config
+from mailiness import migrations, transfer  # noqa: E402
+from mailiness.repo import (  # noqa: E402
+    AliasRepository,
+    DomainRepository,
+    UserRepository,
+)
+
+
+class TransferTest(TestCase):
+    def setUp(self):
+        self.source = sqlite3.connect(":memory:")
+        migrations.migrate(self.source)
+        domain_repo = DomainRepository(conn=self.source)
+        user_repo = UserRepository(conn=self.source)
+        for domain in ("smith.com", "doe.com"):
+            domain_repo.create(domain)
+        for i in range(5):
+            self.source.execute(
+                "INSERT INTO users VALUES (1, ?, 'hash', 1000000000)",
+                [f"user{i}@smith.com"],
+            )
+        self.source.commit()
+        user_repo.create("john@doe.com", "secret", 2)
+        alias_repo = AliasRepository(conn=self.source)
+        alias_repo.create("info@smith.com", "user0@smith.com,john@doe.com")
+        alias_repo.create("hello@doe.com", "john@doe.com")
+
+        self.dest = sqlite3.connect(":memory:")
+        migrations.migrate(self.dest)
+
+    def _dump(self, conn) -> list:
+        return list(transfer.iter_records(conn))
+
+    def test_iterate_pages_through_every_row(self):
+        rows = list(UserRepository(conn=self.source).iterate(batch_size=2))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row[0] for row in rows], sorted(row[0] for row in rows))
+
+    def test_round_trip(self):
+        fp = io.BytesIO()
+        self.assertEqual(transfer.export_all(self.source, fp, batch_size=2), 10)
+        fp.seek(0)
+
+        counts = transfer.import_all(self.dest, fp, batch_size=3)
+
+        self.assertEqual(counts, {"domain": 2, "user": 6, "alias": 2})
+        self.assertEqual(self._dump(self.dest), self._dump(self.source))
+        data = AliasRepository(conn=self.dest).index(
+            to_address="john@doe.com", pretty=False
+        )
+        self.assertEqual(len(data["rows"]), 2)
+
+    def test_export_is_a_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), "mailserver.db")
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        migrations.migrate(conn)
+        DomainRepository(conn=conn).create("smith.com")
+        writer = sqlite3.connect(path)
+
+        class WritingOutput(io.BytesIO):
+            def write(self, data):
+                # A domain and its user added while the export runs.
+                if not self.tell():
+                    writer.execute("INSERT INTO domains VALUES ('late.com')")
+                    writer.execute(
+                        "INSERT INTO users VALUES (2, 'joe@late.com', 'hash', 1)"
+                    )
+                    writer.commit()
+                return super().write(data)
+
+        fp = WritingOutput()
+        self.assertEqual(transfer.export_all(conn, fp, batch_size=1), 1)
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(len(self._dump(conn)), 3)
+
+    def test_compressed_input_is_detected(self):
+        path = os.path.join(tempfile.mkdtemp(), "export.jsonl.gz")
+        fp = transfer.open_output(path, transfer.compression_from_path(path))
+        transfer.export_all(self.source, fp)
+        fp.close()
+        with open(path, "rb") as raw:
+            self.assertEqual(raw.read(2), b"\x1f\x8b")
+
+        fp = transfer.open_input(path)
+        transfer.import_all(self.dest, fp)
+        fp.close()
+
+        self.assertEqual(self._dump(self.dest), self._dump(self.source))
+
+    def test_failed_import_changes_nothing(self):
+        fp = io.BytesIO(
+            b'{"type": "domain", "name": "smith.com"}\n'
+            b'{"type": "user", "email": "john@unknown.com", "password": "x", "quota": 1}\n'
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            transfer.import_all(self.dest, fp)
+        self.assertEqual(self._dump(self.dest), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,7 @@ from mailiness.settings import get_default_config
 def get_test_config() -> ConfigParser:
     config = get_default_config()
     config["mail"]["vmail_directory"] = tempfile.mkdtemp()
+    _, config["mail"]["usage_index_path"] = tempfile.mkstemp()
     _, config["db"]["connection_string"] = tempfile.mkstemp()
     config["spam"]["dkim_private_key_directory"] = tempfile.mkdtemp()
     _, config["spam"]["dkim_maps_path"] = tempfile.mkstemp()